@@ -0,0 +1,167 @@
+# Authenticated requests per second with each session and user loading
+# setup, and the CPU a login storm costs with and without rate limiting (see
+# mainapp/auth.py).
+#
+# usage: python benchmarks/bench_auth.py [--requests 2000] [--attempts 200]
+#            [--endpoints usage,dashboard] [--json results.json]
+#
+# Configurations, each measured in a fresh process since the user cache is per
+# process:
+#   before          database sessions, the user loaded on every request, no
+#                   login rate limit (how the app used to run)
+#   db              database sessions and the user loaded, with a local memory
+#                   default cache (the default)
+#   cached_db       sessions read from the cache, the user still loaded
+#   cached_db+users sessions and users from the caches
+#   signed_cookies  sessions in the cookie, users from the cache
+# The last three use a file based default cache, standing in for the shared
+# cache they need with several worker processes.
+# One logged in client requests every endpoint --requests times through the
+# real routes and middleware. The login storm then posts --attempts wrong
+# passwords for one username from one address and reports how many of them
+# ran the password hasher and the CPU time spent.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from common import setup_django
+
+ENDPOINTS = {'usage': '/mainapp/api/usage/', 'dashboard': '/mainapp/upload/'}
+UNLIMITED = {'address': (10 ** 9, 60), 'username': (10 ** 9, 60)}
+CONFIGS = {
+    'before': {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.db', 'AUTH_USER_CACHE_SIZE': 0,
+        'LOGIN_RATE_LIMITS': UNLIMITED,
+    },
+    'db': {},
+    'cached_db': {'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db', 'AUTH_USER_CACHE_SIZE': 0},
+    'cached_db+users': {'SESSION_ENGINE': 'django.contrib.sessions.backends.cached_db'},
+    'signed_cookies': {'SESSION_ENGINE': 'django.contrib.sessions.backends.signed_cookies'},
+}
+PASSWORD = 'bench-Passw0rd'
+
+
+def requests_per_second(client, path, count):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    for _ in range(20):
+        client.get(path)
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        for _ in range(count):
+            response = client.get(path)
+            if response.status_code != 200:
+                raise RuntimeError(f'{path} answered {response.status_code}')
+        seconds = time.perf_counter() - start
+    return {'requests_per_sec': count / seconds, 'ms_per_request': seconds / count * 1000,
+            'queries_per_request': len(queries) / count}
+
+
+def login_storm(attempts):
+    from django.test import Client
+    from mainapp import views
+
+    hashed = 0
+    authenticate = views.authenticate
+
+    def counted(*args, **kwargs):
+        nonlocal hashed
+        hashed += 1
+        return authenticate(*args, **kwargs)
+
+    views.authenticate = counted
+    client = Client()
+    statuses = {}
+    start, cpu = time.perf_counter(), time.process_time()
+    for _ in range(attempts):
+        status = client.post('/mainapp/login/', {'username': 'bench', 'password': 'wrong'}).status_code
+        statuses[status] = statuses.get(status, 0) + 1
+    seconds, cpu = time.perf_counter() - start, time.process_time() - cpu
+    views.authenticate = authenticate
+    return {'attempts': attempts, 'hashed': hashed, 'rejected': statuses.get(429, 0),
+            'seconds': seconds, 'cpu_seconds': cpu}
+
+
+# one configuration, in this process; prints JSON lines for the parent
+def child(args):
+    overrides = dict(CONFIGS[args.child])
+    if 'SESSION_ENGINE' in overrides and args.child != 'before':
+        from hosting.settings import CACHES
+
+        # setup_django puts it in its temp dir
+        overrides['CACHES'] = {
+            **CACHES, 'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': ''},
+        }
+    workdir = setup_django(ALLOWED_HOSTS=['*'], **overrides)
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import Client
+
+    connection.settings_dict['TEST']['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        user = User.objects.create_user(username='bench', password=PASSWORD)
+        client = Client()
+        client.force_login(user)
+        for endpoint in args.endpoints.split(','):
+            result = requests_per_second(client, ENDPOINTS[endpoint], args.requests)
+            print(json.dumps({'config': args.child, 'endpoint': endpoint, **result}), flush=True)
+        print(json.dumps({'config': args.child, 'endpoint': 'login storm', **login_storm(args.attempts)}), flush=True)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per endpoint')
+    parser.add_argument('--attempts', type=int, default=200, help='failed logins in the storm')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--configs', default=','.join(CONFIGS))
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    results = []
+    print(f"{'config':<16} {'endpoint':<10} {'req/s':>8} {'ms/req':>7} {'queries':>8}")
+    storms = []
+    for config in args.configs.split(','):
+        output = subprocess.run(
+            [sys.executable, __file__, '--requests', str(args.requests), '--attempts', str(args.attempts),
+             '--endpoints', args.endpoints, '--child', config],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        # the login form prints debug output of its own
+        for line in output.splitlines():
+            if not line.startswith('{'):
+                continue
+            result = json.loads(line)
+            results.append(result)
+            if result['endpoint'] == 'login storm':
+                storms.append(result)
+            else:
+                print(
+                    f"{config:<16} {result['endpoint']:<10} {result['requests_per_sec']:>8.0f} "
+                    f"{result['ms_per_request']:>7.2f} {result['queries_per_request']:>8.1f}"
+                )
+
+    print(f"\n{'login storm':<16} {'attempts':>8} {'hashed':>7} {'429':>5} {'CPU s':>7}")
+    for storm in storms:
+        print(
+            f"{storm['config']:<16} {storm['attempts']:>8} {storm['hashed']:>7} {storm['rejected']:>5} "
+            f"{storm['cpu_seconds']:>7.2f}"
+        )
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Compression at rest: disk saved against CPU spent, per kind of content and
+# per encoding and level (see mainapp/compression.py).
+#
+# usage: python benchmarks/bench_compression.py [--size 64M] [--json results.json]
+#
+# For every sample the report shows whether the content sniff would compress
+# it at all, the stored size as a share of the original, compression and
+# decompression speed in CPU time, and the bytes of disk saved per CPU second
+# spent compressing. Decompression runs through open_decoded, the same path
+# downloads and the scrubber read compressed blobs with.
+import argparse
+import gzip
+import json
+import os
+import random
+import tempfile
+import time
+
+from common import setup_django, parse_size, human
+
+LEVELS = {'gzip': [1, 6, 9], 'zstd': [1, 3, 9, 19]}
+
+
+# content resembling what users upload, size bytes of each kind
+def samples(size):
+    rng = random.Random(0)
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR']
+    paths = ['/mainapp/upload/', '/mainapp/api/files/', '/mainapp/download/17/', '/mainapp/share/4/']
+
+    def fill(make_line):
+        lines, total = [], 0
+        while total < size:
+            line = make_line().encode()
+            lines.append(line)
+            total += len(line)
+        return b''.join(lines)[:size]
+
+    log = fill(lambda: (
+        f'2024-03-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:'
+        f'{rng.randint(0, 59):02d} {rng.choice(levels)} GET {rng.choice(paths)} '
+        f'{rng.choice([200, 200, 200, 206, 304, 404])} {rng.randint(100, 99999)}B {rng.random() * 300:.1f}ms\n'
+    ))
+    csv = fill(lambda: (
+        f'{rng.randint(1, 10 ** 6)},user{rng.randint(1, 5000)},{rng.random() * 1000:.2f},'
+        f'{rng.choice(["EUR", "USD", "GBP"])},2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}\n'
+    ))
+    dump = fill(lambda: json.dumps({
+        'id': rng.randint(1, 10 ** 6), 'name': f'file{rng.randint(1, 10 ** 4)}.txt',
+        'hash': '%064x' % rng.getrandbits(256), 'size': rng.randint(1, 10 ** 9), 'shared': rng.random() < 0.3,
+    }) + '\n')
+    return {
+        'log': log,
+        'csv': csv,
+        'json': dump,
+        'random': os.urandom(size),
+        'gzipped log': gzip.compress(log, 6),
+    }
+
+
+def measure(name, content, encoding, level, workdir):
+    from mainapp.compression import compressor, open_decoded
+
+    path = os.path.join(workdir, f'{name}.{encoding}')
+    start = time.process_time()
+    packer = compressor(encoding, level)
+    with open(path, 'wb') as destination:
+        for offset in range(0, len(content), 1024 * 1024):
+            destination.write(packer.compress(content[offset:offset + 1024 * 1024]))
+        destination.write(packer.flush())
+    compress_seconds = time.process_time() - start
+    stored = os.path.getsize(path)
+
+    start = time.process_time()
+    with open_decoded(path, encoding) as source:
+        while source.read(1024 * 1024):
+            pass
+    decompress_seconds = time.process_time() - start
+    os.remove(path)
+
+    return {
+        'sample': name, 'encoding': encoding, 'level': level, 'size': len(content), 'stored': stored,
+        'ratio': stored / len(content),
+        'compress_mb_per_cpu_sec': len(content) / 1e6 / compress_seconds,
+        'decompress_mb_per_cpu_sec': len(content) / 1e6 / decompress_seconds,
+        'saved_per_cpu_sec': (len(content) - stored) / compress_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', default='64M', help='size of each sample')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    workdir = setup_django()
+    from mainapp.compression import available_encodings, compressible
+
+    results = []
+    print(f"{'sample':<12} {'sniff':<6} {'encoding':<9} {'ratio':>6} {'comp MB/s':>10} {'decomp MB/s':>12} {'saved/CPU s':>12}")
+    for name, content in samples(parse_size(args.size)).items():
+        sniff = 'yes' if compressible(content[:64 * 1024]) else 'skip'
+        for encoding in available_encodings():
+            for level in LEVELS[encoding]:
+                result = measure(name, content, encoding, level, tempfile.mkdtemp(dir=workdir))
+                result['sniff'] = sniff
+                results.append(result)
+                print(
+                    f"{name:<12} {sniff:<6} {f'{encoding}-{level}':<9} {result['ratio']:>6.2f} "
+                    f"{result['compress_mb_per_cpu_sec']:>10.0f} {result['decompress_mb_per_cpu_sec']:>12.0f} "
+                    f"{human(result['saved_per_cpu_sec']):>12}"
+                )
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
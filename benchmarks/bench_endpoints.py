@@ -0,0 +1,360 @@
+# Throughput, latency, query counts and memory of the user-facing endpoints
+# under concurrent clients, on a seeded database.
+#
+# usage: python benchmarks/bench_endpoints.py [--database sqlite|postgres]
+#            [--users 1000] [--files-per-user 50] [--shares-per-user 20]
+#            [--clients 8] [--requests 50] [--endpoints dashboard,download]
+#            [--json results.json] [--compare baseline.json]
+#
+# The database is a throwaway test database (see bench_indexes.py), seeded
+# with users, files, direct shares and group shares. Every endpoint is then
+# driven through the real URL routes and middleware with django.test.Client,
+# by --clients threads at once, each logged in as a different user:
+#   signup, login, dashboard, file_list, upload, download, share, delete
+# For each endpoint the report shows requests per second, p50/p95/p99
+# latency, database queries per request and, from a separate single-client
+# pass with tracemalloc (which would distort the timings), the peak Python
+# memory allocated per request.
+#
+# --json saves the results with the commit they were measured at;
+# --compare prints the change against such a file and exits with status 1
+# when an endpoint got slower or runs more queries than --tolerance allows.
+# SQLite serialises writers, so there endpoints that write are driven by one
+# client; use PostgreSQL to load them concurrently.
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+from common import setup_django, parse_size, human
+
+ENDPOINTS = ('signup', 'login', 'dashboard', 'file_list', 'upload', 'download', 'share', 'delete')
+
+# endpoints whose transactions write; SQLite fails concurrent ones with
+# "database is locked" when a reader turns into a writer, so on SQLite they
+# are driven by a single client
+WRITE_ENDPOINTS = {'signup', 'login', 'upload', 'share', 'delete'}
+PASSWORD = 'bench-Passw0rd'
+
+
+def seed(args):
+    from django.contrib.auth.hashers import make_password
+    from django.contrib.auth.models import Group, User
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import storages
+    from django.db import transaction
+    from django.db.models import Count, F, Sum
+    from mainapp import access
+    from mainapp.models import Blob, GroupShare, SharedFile, Task, UploadedFile, UserUsage
+    from mainapp.uploads import store_upload
+
+    rng = random.Random(0)
+    fs = storages['uploads']
+    with transaction.atomic():
+        # hashing one password for every user keeps seeding fast
+        password = make_password(PASSWORD)
+        User.objects.bulk_create(
+            [User(username=f'bench{n}', password=password) for n in range(args.users)], batch_size=1000,
+        )
+        users = list(User.objects.filter(username__startswith='bench').order_by('id').values_list('id', flat=True))
+
+        # a pool of stored contents the files point at, as duplicate uploads do
+        first = User.objects.get(pk=users[0])
+        blobs = [
+            store_upload(first, ContentFile(rng.randbytes(args.file_size)), f'pool{n}.bin').blob
+            for n in range(args.blobs)
+        ]
+        UploadedFile.objects.all().delete()
+        Task.objects.all().delete()
+        Blob.objects.update(ref_count=0)
+
+        files = []
+        for user_id in users:
+            for n in range(args.files_per_user):
+                blob = rng.choice(blobs)
+                files.append(UploadedFile(
+                    user_id=user_id, file_url=fs.url(blob.name), file_hash=blob.file_hash,
+                    blob=blob, name=f'file{n}.bin', size=args.file_size,
+                    processing_status=UploadedFile.PROCESSED,
+                ))
+        UploadedFile.objects.bulk_create(files, batch_size=1000)
+        for blob_id, count in UploadedFile.objects.values_list('blob').annotate(count=Count('id')):
+            Blob.objects.filter(pk=blob_id).update(ref_count=F('ref_count') + count)
+
+        file_ids = list(UploadedFile.objects.values_list('id', 'user_id'))
+        shares = set()
+        for user_id in users:
+            for file_id, owner_id in rng.sample(file_ids, min(args.shares_per_user, len(file_ids))):
+                if owner_id != user_id:
+                    shares.add((file_id, user_id))
+        SharedFile.objects.bulk_create(
+            [SharedFile(uploadedfile_id=f, user_id=u) for f, u in shares], batch_size=1000,
+        )
+
+        # teams of 20 with a few files shared with each
+        for n in range(0, len(users), 20):
+            group = Group.objects.create(name=f'team{n // 20}')
+            group.user_set.add(*users[n:n + 20])
+            GroupShare.objects.bulk_create(
+                [GroupShare(uploadedfile_id=f, group=group) for f, _ in rng.sample(file_ids, min(10, len(file_ids)))],
+                ignore_conflicts=True,
+            )
+        access.rebuild()
+
+        UserUsage.objects.all().delete()
+        UserUsage.objects.bulk_create([
+            UserUsage(user_id=user_id, bytes_used=used, file_count=count)
+            for user_id, used, count in UploadedFile.objects.values_list('user').annotate(Sum('size'), Count('id'))
+        ])
+    return users
+
+
+# per client state: a logged in Client and the ids it works on
+class Worker:
+
+    def __init__(self, number, user_id):
+        from django.contrib.auth.models import User
+        from django.test import Client
+        from mainapp.models import UploadedFile
+
+        self.number = number
+        self.user = User.objects.get(pk=user_id)
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.anonymous = Client()
+        self.own_files = list(UploadedFile.objects.filter(user=self.user).values_list('id', flat=True))
+        self.sequence = 0
+        self.rng = random.Random(number)
+
+    def next_name(self, prefix):
+        self.sequence += 1
+        return f'{prefix}-{self.number}-{self.sequence}-{time.monotonic_ns()}'
+
+    # prepares what one request needs, untimed; returns the request to time
+    def prepare(self, endpoint, args):
+        from django.core.files.base import ContentFile
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from mainapp.uploads import store_upload
+
+        if endpoint == 'signup':
+            username = self.next_name('signup')
+            return lambda: self.anonymous.post('/mainapp/signup/', {
+                'username': username, 'password1': PASSWORD, 'password2': PASSWORD,
+            })
+        if endpoint == 'login':
+            return lambda: self.anonymous.post('/mainapp/login/', {'username': self.user.username, 'password': PASSWORD})
+        if endpoint == 'dashboard':
+            return lambda: self.client.get('/mainapp/upload/')
+        if endpoint == 'file_list':
+            return lambda: self.client.get('/mainapp/api/files/?limit=50')
+        if endpoint == 'upload':
+            document = SimpleUploadedFile(self.next_name('upload'), self.rng.randbytes(args.upload_size))
+            return lambda: self.client.post('/mainapp/upload/', {'document': document})
+        if endpoint == 'download':
+            file_id = self.rng.choice(self.own_files)
+
+            def download():
+                response = self.client.get(f'/mainapp/download/{file_id}/')
+                # reads the body, as a client would
+                for _ in response.streaming_content:
+                    pass
+                response.close()
+                return response
+            return download
+        if endpoint == 'share':
+            file_id = self.rng.choice(self.own_files)
+            recipient = f'bench{self.rng.randrange(args.users)}'
+            return lambda: self.client.post(f'/mainapp/share/{file_id}/', {'share_with': recipient})
+        if endpoint == 'delete':
+            uploaded_file = store_upload(self.user, ContentFile(self.rng.randbytes(1024)), 'doomed.bin')
+            return lambda: self.client.get(f'/mainapp/delete/{uploaded_file.id}/')
+        raise ValueError(endpoint)
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+# runs requests of endpoint on every worker at once; returns the timings
+def drive(workers, endpoint, args):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    timings, queries, errors = [], [], []
+    lock = threading.Lock()
+
+    def run(worker):
+        try:
+            for _ in range(args.requests):
+                request = worker.prepare(endpoint, args)
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    response = request()
+                    elapsed = time.perf_counter() - start
+                with lock:
+                    if response.status_code >= 400:
+                        errors.append(response.status_code)
+                    timings.append(elapsed)
+                    queries.append(len(captured))
+        except Exception as error:
+            with lock:
+                errors.append(repr(error))
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, queries, errors, time.perf_counter() - start
+
+
+# peak memory Python allocates while serving one request, over a few requests
+def memory_per_request(worker, endpoint, args, repeat=5):
+    peaks = []
+    for _ in range(repeat):
+        request = worker.prepare(endpoint, args)
+        tracemalloc.start()
+        request()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return statistics.median(peaks)
+
+
+def measure(users, args):
+    from django.db import connection
+
+    endpoints = args.endpoints.split(',') if args.endpoints else ENDPOINTS
+    results = {}
+    for endpoint in endpoints:
+        clients = 1 if connection.vendor == 'sqlite' and endpoint in WRITE_ENDPOINTS else args.clients
+        workers = [Worker(number, users[number * 7 % len(users)]) for number in range(clients)]
+        connection.close()
+        # one untimed request per client warms up caches and connections
+        drive(workers, endpoint, argparse.Namespace(**{**vars(args), 'requests': 1}))
+        timings, queries, errors, seconds = drive(workers, endpoint, args)
+        timings.sort()
+        if not timings:
+            raise RuntimeError(f'every {endpoint} request failed: {errors[:3]}')
+        results[endpoint] = {
+            'clients': clients,
+            'requests': len(timings),
+            'errors': len(errors),
+            'error_samples': [str(error) for error in errors[:3]],
+            'requests_per_sec': len(timings) / seconds,
+            'p50_ms': percentile(timings, 0.50) * 1000,
+            'p95_ms': percentile(timings, 0.95) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000,
+            'queries_per_request': statistics.mean(queries),
+            'peak_memory_per_request': memory_per_request(workers[0], endpoint, args),
+        }
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    print(f"{'endpoint':<10} {'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'memory':>10} {'errors':>7}")
+    for endpoint, result in report['endpoints'].items():
+        print(
+            f"{endpoint:<10} {result['clients']:>7} {result['requests_per_sec']:>8.1f} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+            f"{result['p99_ms']:>8.2f} {result['queries_per_request']:>8.1f} "
+            f"{human(result['peak_memory_per_request']):>10} {result['errors']:>7}"
+        )
+
+
+# prints the change of every endpoint against baseline; returns the regressions
+def compare(report, baseline, tolerance):
+    regressions = []
+    print(f"\nagainst {baseline['meta'].get('commit')}:")
+    for endpoint, result in report['endpoints'].items():
+        before = baseline['endpoints'].get(endpoint)
+        if before is None:
+            continue
+        p95 = result['p95_ms'] / before['p95_ms'] - 1
+        throughput = result['requests_per_sec'] / before['requests_per_sec'] - 1
+        queries = result['queries_per_request'] - before['queries_per_request']
+        print(f'{endpoint:<10} p95 {p95:+.0%}  req/s {throughput:+.0%}  queries {queries:+.1f}')
+        if p95 > tolerance or throughput < -tolerance or queries > 0.5:
+            regressions.append(endpoint)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', choices=['sqlite', 'postgres'], default='sqlite')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--files-per-user', type=int, default=50)
+    parser.add_argument('--shares-per-user', type=int, default=20)
+    parser.add_argument('--blobs', type=int, default=50, help='distinct stored contents the files share')
+    parser.add_argument('--file-size', type=parse_size, default='256K', help='size of the seeded files')
+    parser.add_argument('--upload-size', type=parse_size, default='256K')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=50, help='requests per client and endpoint')
+    parser.add_argument('--endpoints', help=f"comma separated subset of {','.join(ENDPOINTS)}")
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed slowdown before --compare fails')
+    args = parser.parse_args()
+
+    # test settings: real routes and middleware, but any host name, and no
+    # login rate limit for the clients that all log in from one address
+    workdir = setup_django(
+        args.database, ALLOWED_HOSTS=['*'], LOGIN_RATE_LIMITS={'address': (10 ** 9, 60), 'username': (10 ** 9, 60)},
+    )
+    from django.db import connection
+
+    if args.database == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+        # concurrent writers wait for the lock instead of failing at once
+        connection.settings_dict['OPTIONS']['timeout'] = 60
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        start = time.perf_counter()
+        users = seed(args)
+        seed_seconds = time.perf_counter() - start
+        endpoints = measure(users, args)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    report = {
+        'meta': {
+            'commit': commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'cpus': os.cpu_count(), 'seed_seconds': seed_seconds,
+            'args': vars(args),
+        },
+        'endpoints': endpoints,
+    }
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(report, out, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(report, json.load(baseline), args.tolerance)
+        if regressions:
+            print(f"\nregressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Hashing throughput for different content sizes and thread counts: the old
+# single-threaded SHA-256 loop against mainapp.hashing.ContentHasher, alone,
+# with the block manifest and sha256-tree fingerprint that uploads compute by
+# default (the same block digests serve both), and with each other available
+# fingerprint algorithm.
+#
+# usage: python benchmarks/bench_hashing.py [--sizes 64M,1G] [--threads 1,2,4,8]
+#                                           [--json results.json]
+#
+# Content is fed in 64 KiB pieces, as the upload handlers receive it. Each
+# thread count runs in a fresh process, since the hashing pool is per process.
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+from common import setup_django, parse_size
+
+PIECE_SIZE = 64 * 1024
+
+
+# row label -> (fingerprint, manifest) given to ContentHasher; None for the
+# plain loop
+def algorithms():
+    from mainapp.hashing import available_fingerprints
+
+    rows = {'sha256 loop': None, 'sha256': ('', False), 'sha256 + manifest/tree (default)': ('sha256-tree', True)}
+    for name in available_fingerprints():
+        if name != 'sha256-tree':
+            rows[f'sha256 + {name}'] = (name, False)
+    return rows
+
+
+def measure(size, config):
+    piece = os.urandom(PIECE_SIZE)
+    start = time.perf_counter()
+    if config is None:
+        hasher = hashlib.sha256()
+        for _ in range(size // PIECE_SIZE):
+            hasher.update(piece)
+        hasher.hexdigest()
+    else:
+        from mainapp.hashing import ContentHasher
+        hasher = ContentHasher(*config)
+        for _ in range(size // PIECE_SIZE):
+            hasher.update(piece)
+        hasher.digests()
+    return time.perf_counter() - start
+
+
+# one thread count, in this process; prints JSON lines for the parent
+def child(args):
+    setup_django(HASH_THREADS=args.child)
+
+    for size in args.sizes.split(','):
+        for algorithm, config in algorithms().items():
+            seconds = measure(parse_size(size), config)
+            print(json.dumps({
+                'size': size, 'threads': args.child, 'algorithm': algorithm,
+                'seconds': seconds, 'mb_per_sec': parse_size(size) / 1e6 / seconds,
+            }), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='64M,1G')
+    parser.add_argument('--threads', default=f'1,{os.cpu_count()}')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    results = []
+    print(f"{'size':>6} {'threads':>8} {'algorithm':<32} {'MB/s':>8}")
+    for threads in [int(t) for t in args.threads.split(',')]:
+        output = subprocess.run(
+            [sys.executable, __file__, '--sizes', args.sizes, '--child', str(threads)],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        for line in output.splitlines():
+            result = json.loads(line)
+            results.append(result)
+            print(f"{result['size']:>6} {threads:>8} {result['algorithm']:<32} {result['mb_per_sec']:>8.0f}")
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
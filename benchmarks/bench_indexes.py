@@ -0,0 +1,158 @@
+# Query plans and latency of the dashboard and hash lookups before and after
+# the indexes of migration 0005, on a seeded table.
+#
+# usage: python benchmarks/bench_indexes.py [--database sqlite|postgres]
+#                                           [--rows 10000000] [--users 10000]
+#
+# The benchmark runs in a throwaway test database (the PostgreSQL one is created
+# next to the database in hosting/settings.py and dropped afterwards). It seeds
+# at migration 0004, measures, migrates to 0005 and measures again.
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+
+from common import setup_django
+
+QUERIES = {
+    'hash lookup (hex)': (
+        'SELECT id FROM mainapp_uploadedfile WHERE file_hash = %s', 'hex'),
+    'hash lookup (binary)': (
+        'SELECT id FROM mainapp_uploadedfile WHERE file_digest = %s', 'digest'),
+    'owned files, newest 50': (
+        'SELECT id, file_url, file_hash FROM mainapp_uploadedfile '
+        'WHERE user_id = %s ORDER BY id DESC LIMIT 50', 'user'),
+    'shared with user, newest 50': (
+        'SELECT f.id, f.file_url FROM mainapp_uploadedfile f '
+        'JOIN mainapp_uploadedfile_shared_with s ON s.uploadedfile_id = f.id '
+        'WHERE s.user_id = %s ORDER BY s.uploadedfile_id DESC LIMIT 50', 'user'),
+}
+
+
+def seed(connection, rows, users, shares, batch=50000):
+    from django.db import transaction
+
+    rng = random.Random(0)
+    hashes = []
+    # one transaction, or SQLite syncs to disk after every row
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO auth_user (password, last_login, is_superuser, username, first_name, '
+            'last_name, email, is_staff, is_active, date_joined) '
+            "VALUES ('', NULL, %s, %s, '', '', '', %s, %s, '2023-11-13')",
+            [(False, f'user{n}', False, True) for n in range(users)],
+        )
+        cursor.execute('SELECT MIN(id) FROM auth_user')
+        first_user = cursor.fetchone()[0]
+
+        for start in range(0, rows, batch):
+            values = []
+            for n in range(start, min(start + batch, rows)):
+                file_hash = rng.randbytes(32).hex()
+                if n % 1000 == 0:
+                    hashes.append(file_hash)
+                values.append((first_user + rng.randrange(users), f'/media/file{n}', file_hash, f'file{n}'))
+            cursor.executemany(
+                'INSERT INTO mainapp_uploadedfile (user_id, file_url, file_hash, name) VALUES (%s, %s, %s, %s)',
+                values,
+            )
+
+        # random (file, user) pairs; duplicates are dropped by the unique index
+        pairs = {(rng.randrange(rows) + 1, first_user + rng.randrange(users)) for _ in range(shares)}
+        pairs = list(pairs)
+        for start in range(0, len(pairs), batch):
+            cursor.executemany(
+                'INSERT INTO mainapp_uploadedfile_shared_with (uploadedfile_id, user_id) VALUES (%s, %s)',
+                pairs[start:start + batch],
+            )
+    return first_user, hashes
+
+
+def explain(connection, sql, params):
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN ANALYZE '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return '\n'.join(' '.join(str(col) for col in row) for row in cursor.fetchall())
+
+
+def measure(connection, phase, first_user, users, hashes, repeat):
+    rng = random.Random(1)
+    results = {}
+    for label, (sql, kind) in QUERIES.items():
+        if kind == 'digest' and phase == 'before':
+            continue
+        timings = []
+        plan = None
+        for _ in range(repeat):
+            file_hash = rng.choice(hashes)
+            params = {
+                'hex': [file_hash],
+                'digest': [bytes.fromhex(file_hash)],
+                'user': [first_user + rng.randrange(users)],
+            }[kind]
+            if plan is None:
+                plan = explain(connection, sql, params)
+            with connection.cursor() as cursor:
+                start = time.perf_counter()
+                cursor.execute(sql, params)
+                cursor.fetchall()
+                timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        results[label] = {
+            'p50_ms': statistics.median(timings),
+            'p95_ms': timings[int(len(timings) * 0.95) - 1],
+            'plan': plan,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', choices=['sqlite', 'postgres'], default='sqlite')
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--shares', type=int, help='shared (file, user) pairs; default rows / 2')
+    parser.add_argument('--repeat', type=int, default=200, help='executions per query and phase')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    workdir = setup_django(args.database)
+    from django.core.management import call_command
+    from django.db import connection
+
+    if args.database == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        call_command('migrate', 'mainapp', '0004', verbosity=0)
+
+        start = time.perf_counter()
+        first_user, hashes = seed(connection, args.rows, args.users, args.shares or args.rows // 2)
+        report = {'seed_seconds': time.perf_counter() - start, 'rows': args.rows, 'database': args.database}
+
+        report['before'] = measure(connection, 'before', first_user, args.users, hashes, args.repeat)
+
+        start = time.perf_counter()
+        call_command('migrate', 'mainapp', '0005', verbosity=0)
+        report['migrate_seconds'] = time.perf_counter() - start
+
+        report['after'] = measure(connection, 'after', first_user, args.users, hashes, args.repeat)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    print(f"{args.rows} rows on {args.database}: seeded in {report['seed_seconds']:.1f}s, "
+          f"migrated in {report['migrate_seconds']:.1f}s")
+    for phase in ('before', 'after'):
+        for label, result in report[phase].items():
+            print(f"\n[{phase}] {label}: p50 {result['p50_ms']:.3f} ms, p95 {result['p95_ms']:.3f} ms")
+            print('    ' + result['plan'].replace('\n', '\n    '))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
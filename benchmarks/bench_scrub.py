@@ -0,0 +1,62 @@
+# Integrity scrub throughput in GB/min for different worker counts and read
+# sizes, on a seeded blob store.
+#
+# usage: python benchmarks/bench_scrub.py [--files 64] [--size 32M]
+#                                         [--workers 1,2,4,8] [--read-sizes 64K,1M,8M]
+#                                         [--json results.json]
+#
+# The files are written once and then read through the page cache, so the
+# numbers show the hashing side; drop the caches between runs
+# (echo 3 > /proc/sys/vm/drop_caches as root) to include the disk.
+import argparse
+import json
+import os
+
+from common import setup_django, migrate, parse_size, human
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=64)
+    parser.add_argument('--size', default='32M', help='size of each file')
+    parser.add_argument('--workers', default=f'1,{os.cpu_count()}')
+    parser.add_argument('--read-sizes', default='64K,1M,8M')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    workdir = setup_django()
+    migrate()
+
+    from django.contrib.auth.models import User
+    from django.core.files.base import ContentFile
+    import mainapp.scrub
+    from mainapp.uploads import store_upload
+
+    user = User.objects.create(username='bench')
+    size = parse_size(args.size)
+    for _ in range(args.files):
+        store_upload(user, ContentFile(os.urandom(size)), 'bench.bin')
+
+    results = []
+    print(f'{args.files} files of {human(size)}')
+    print(f"{'workers':>8} {'read size':>10} {'GB/min':>10} {'seconds':>8}")
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for read_size in args.read_sizes.split(','):
+            mainapp.scrub.READ_SIZE = parse_size(read_size)
+            checkpoint = os.path.join(workdir, 'checkpoint.json')
+            report = mainapp.scrub.scrub(checkpoint, workers=workers, rate=0)
+            assert report.complete and not report.corrupted and not report.missing
+
+            results.append({
+                'workers': workers, 'read_size': read_size,
+                'gb_per_min': report.gb_per_min, 'seconds': report.seconds,
+            })
+            print(f'{workers:>8} {read_size:>10} {report.gb_per_min:>10.1f} {report.seconds:>8.2f}')
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# Compares the old upload path (FileSystemStorage.save() followed by a second
+# pass over uploaded_file.chunks() for SHA-256) with the single-pass
+# mainapp.storage.save_and_hash pipeline.
+#
+# usage: python benchmarks/bench_upload.py [--sizes 10M 1G 5G] [--repeat 3]
+#
+# Every measurement runs in a fresh subprocess so the peak RSS reported is the
+# peak of that run alone. Each run parses a real multipart request body
+# streamed from disk, so the time spent receiving the upload is included.
+# Upload temp files live next to MEDIA_ROOT, as on a typical single disk host.
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import setup_django, parse_size, peak_rss, human
+
+METHODS = ('legacy', 'single_pass')
+
+# the upload handlers Django used before the hashing handler was installed
+LEGACY_HANDLERS = [
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+
+def make_source(path, size):
+    # repeat one random block so generating 5 GB stays cheap
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as source:
+        remaining = size
+        while remaining > 0:
+            source.write(block[:min(remaining, len(block))])
+            remaining -= len(block)
+
+
+def legacy_upload(fs, uploaded_file):
+    # the view as it was before the single-pass pipeline
+    name = fs.save(uploaded_file.name, uploaded_file)
+    sha256_hash = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        sha256_hash.update(chunk)
+    return name, sha256_hash.hexdigest()
+
+
+class MultipartBody:
+    # wsgi.input that streams a multipart body wrapped around the source file,
+    # so even a 5 GB request never has to be built in memory
+    def __init__(self, source, boundary):
+        head = (
+            f'--{boundary}\r\n'
+            'Content-Disposition: form-data; name="document"; filename="upload.bin"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.length = len(head) + os.path.getsize(source) + len(tail)
+        self.parts = [io.BytesIO(head), open(source, 'rb'), io.BytesIO(tail)]
+
+    def read(self, size=-1):
+        data = b''
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(-1 if size < 0 else size - len(data))
+            if not chunk:
+                self.parts.pop(0).close()
+                continue
+            data += chunk
+        return data
+
+    def readline(self, size=-1):
+        # only needed to satisfy LimitedStream; the multipart parser uses read()
+        line = b''
+        while not line.endswith(b'\n') and (size < 0 or len(line) < size):
+            char = self.read(1)
+            if not char:
+                break
+            line += char
+        return line
+
+
+def run_one(method, source, workdir):
+    setup_django(media_root=os.path.join(workdir, 'media'), FILE_UPLOAD_TEMP_DIR=workdir)
+    from django.core.files.storage import FileSystemStorage
+    from django.core.files.uploadhandler import load_handler
+    from django.core.handlers.wsgi import WSGIRequest
+    from mainapp.storage import save_and_hash
+    from mainapp.uploadhandlers import received_digests
+
+    boundary = 'benchmarkboundary'
+    body = MultipartBody(source, boundary)
+    request = WSGIRequest({
+        'REQUEST_METHOD': 'POST',
+        'CONTENT_TYPE': f'multipart/form-data; boundary={boundary}',
+        'CONTENT_LENGTH': str(body.length),
+        'PATH_INFO': '/mainapp/upload/',
+        'SERVER_NAME': 'bench',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': body,
+    })
+    if method == 'legacy':
+        request.upload_handlers = [load_handler(handler, request) for handler in LEGACY_HANDLERS]
+    fs = FileSystemStorage()
+
+    # the timed section covers receiving the body and everything the view does with the file
+    start = time.perf_counter()
+    uploaded_file = request.FILES['document']
+    if method == 'legacy':
+        legacy_upload(fs, uploaded_file)
+    else:
+        digests = received_digests(request, 'document')
+        save_and_hash(fs, uploaded_file.name, uploaded_file, digests.sha256 if digests else None)
+    elapsed = time.perf_counter() - start
+
+    uploaded_file.close()
+    print(json.dumps({'seconds': elapsed, 'peak_rss': peak_rss()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', default=['10M', '1G', '5G'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write the raw results to this file')
+    parser.add_argument('--run', nargs=3, metavar=('METHOD', 'SOURCE', 'WORKDIR'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(*args.run)
+        return
+
+    results = []
+    for text in args.sizes:
+        size = parse_size(text)
+        workdir = tempfile.mkdtemp(prefix='bench-upload-')
+        source = os.path.join(workdir, 'source.bin')
+        make_source(source, size)
+        try:
+            for method in METHODS:
+                for _ in range(args.repeat):
+                    rundir = tempfile.mkdtemp(dir=workdir)
+                    output = subprocess.run(
+                        [sys.executable, __file__, '--run', method, source, rundir],
+                        check=True, capture_output=True, text=True,
+                    ).stdout
+                    run = json.loads(output.strip().splitlines()[-1])
+                    results.append({'size': size, 'method': method, **run})
+                    shutil.rmtree(rundir)
+        finally:
+            shutil.rmtree(workdir)
+
+    print(f"{'size':>10} {'method':>12} {'best MB/s':>10} {'peak RSS':>10}")
+    for text in args.sizes:
+        size = parse_size(text)
+        for method in METHODS:
+            runs = [r for r in results if r['size'] == size and r['method'] == method]
+            best = min(r['seconds'] for r in runs)
+            rss = max(r['peak_rss'] for r in runs)
+            print(f'{human(size):>10} {method:>12} {size / best / 1024 ** 2:>10.1f} {human(rss):>10}')
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
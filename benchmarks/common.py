@@ -0,0 +1,74 @@
+# shared setup for the benchmark scripts in this folder
+import os
+import sys
+import tempfile
+
+# make the project importable when a script is run directly
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+
+# Configures Django from hosting/settings.py, overriding the database, MEDIA_ROOT
+# and file based caches so benchmarks never touch the development data.
+# database: 'sqlite' (a file in a temp dir) or 'postgres' (the settings entry)
+def setup_django(database='sqlite', media_root=None, **overrides):
+    import django
+    from django.conf import settings
+    from hosting import settings as project_settings
+
+    options = {key: getattr(project_settings, key) for key in dir(project_settings) if key.isupper()}
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    if database == 'sqlite':
+        options['DATABASES'] = {
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(workdir, 'bench.sqlite3'),
+            }
+        }
+    options['MEDIA_ROOT'] = media_root or os.path.join(workdir, 'media')
+    options['DEBUG'] = False
+    options.update(overrides)
+    # file based caches outlive a run, and the next one reuses the user ids
+    options['CACHES'] = {
+        name: {**config, 'LOCATION': os.path.join(workdir, f'cache-{name}')}
+        if config['BACKEND'].endswith('FileBasedCache') else config
+        for name, config in options['CACHES'].items()
+    }
+
+    settings.configure(**options)
+    django.setup()
+    return workdir
+
+
+# Creates the tables for the configured database.
+def migrate():
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0, interactive=False)
+
+
+# Parses sizes such as 10M, 1G or 4096 into bytes.
+def parse_size(text):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+# Peak resident set size of this process in bytes.
+def peak_rss():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Formats a byte count for the report tables.
+def human(num):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(num) < 1024:
+            return f'{num:.1f} {unit}'
+        num /= 1024
+    return f'{num:.1f} TB'
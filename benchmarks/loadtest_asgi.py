@@ -0,0 +1,227 @@
+# Load test: thousands of slow clients against the WSGI and the ASGI deployment.
+#
+# Slow downloaders read a file at a trickle, slow uploaders send resumable
+# upload chunks at a trickle, and meanwhile fast "probe" requests hit the JSON
+# listing. A server that ties a thread to every slow transfer runs out of
+# threads and the probes queue up; an async server keeps answering them.
+#
+# 1. prepare a user, a file and a login session in the configured database:
+#      python benchmarks/loadtest_asgi.py prepare --size 20M > loadtest.json
+# 2. start the server under test, for example
+#      gunicorn hosting.wsgi -w 4 --threads 16 -b 127.0.0.1:8000
+#      ASYNC_FILE_VIEWS=1 uvicorn hosting.asgi:application --workers 4 --port 8001
+# 3. run the load against it and save the numbers:
+#      python benchmarks/loadtest_asgi.py run loadtest.json --url http://127.0.0.1:8000 \
+#          --slow-clients 2000 --duration 60 --json wsgi.json
+#
+# Compare the JSON of both runs: bytes/sec moved by the slow clients, completed
+# probes per second and probe p50/p99 latency.
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from urllib.parse import urlsplit
+
+from common import BASE_DIR, parse_size
+
+
+def prepare(args):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hosting.settings')
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+    from django.contrib.auth.models import User
+    from django.core.files.base import ContentFile
+    from django.middleware.csrf import _get_new_csrf_string
+    from importlib import import_module
+    from mainapp.uploads import store_upload
+
+    user, _ = User.objects.get_or_create(username='loadtest')
+    user.set_password('loadtest')
+    user.save()
+    uploaded_file = store_upload(user, ContentFile(os.urandom(parse_size(args.size))), 'loadtest.bin')
+
+    # a logged in session, as django.contrib.auth.login() would create it
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+
+    json.dump({
+        'session': session.session_key,
+        'csrf': _get_new_csrf_string(),
+        'file_id': uploaded_file.id,
+        'chunk_size': settings.UPLOAD_CHUNK_SIZE_MIN,
+    }, sys.stdout)
+
+
+class Stats:
+    def __init__(self):
+        self.bytes = 0
+        self.probes = []
+        self.errors = 0
+
+
+async def http(url, method, path, config, body=None, headers=None):
+    # a minimal HTTP/1.1 client; returns (status, reader, writer) after the headers
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    lines = [
+        f'{method} {path} HTTP/1.1',
+        f'Host: {parts.netloc}',
+        f"Cookie: sessionid={config['session']}; csrftoken={config['csrf']}",
+        f"X-CSRFToken: {config['csrf']}",
+        f'Referer: {url}/',
+        'Connection: close',
+    ]
+    lines += [f'{key}: {value}' for key, value in (headers or {}).items()]
+    if body is not None:
+        lines.append(f'Content-Length: {len(body)}')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    return reader, writer
+
+
+async def read_status(reader):
+    status = int((await reader.readline()).split()[1])
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    return status
+
+
+async def slow_download(url, config, stats, deadline, rate):
+    # reads one block per tick, as a client on a slow link would
+    while time.monotonic() < deadline:
+        try:
+            reader, writer = await http(url, 'GET', f"/mainapp/download/{config['file_id']}/", config)
+            if await read_status(reader) != 200:
+                stats.errors += 1
+            while time.monotonic() < deadline:
+                data = await reader.read(rate)
+                if not data:
+                    break
+                stats.bytes += len(data)
+                await asyncio.sleep(1)
+            writer.close()
+        except (OSError, ValueError, IndexError):
+            stats.errors += 1
+            await asyncio.sleep(1)
+
+
+async def slow_upload(url, config, stats, deadline, rate):
+    chunk = os.urandom(config['chunk_size'])
+    while time.monotonic() < deadline:
+        try:
+            body = json.dumps({'name': 'slow.bin', 'size': len(chunk), 'chunk_size': len(chunk)}).encode()
+            reader, writer = await http(url, 'POST', '/mainapp/api/uploads/', config, body, {'Content-Type': 'application/json'})
+            writer.write(body)
+            status = await read_status(reader)
+            session_id = json.loads(await reader.read())['id'] if status == 201 else None
+            writer.close()
+            if session_id is None:
+                stats.errors += 1
+                await asyncio.sleep(1)
+                continue
+
+            # trickles the chunk body, one block per tick
+            reader, writer = await http(url, 'PUT', f'/mainapp/api/uploads/{session_id}/chunks/0/', config, chunk)
+            for start in range(0, len(chunk), rate):
+                if time.monotonic() >= deadline:
+                    break
+                writer.write(chunk[start:start + rate])
+                await writer.drain()
+                stats.bytes += len(chunk[start:start + rate])
+                await asyncio.sleep(1)
+            else:
+                if await read_status(reader) != 204:
+                    stats.errors += 1
+            writer.close()
+        except (OSError, ValueError, IndexError, KeyError):
+            stats.errors += 1
+            await asyncio.sleep(1)
+
+
+async def probe(url, config, stats, deadline):
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            reader, writer = await http(url, 'GET', '/mainapp/api/files/?limit=10', config)
+            status = await read_status(reader)
+            await reader.read()
+            writer.close()
+            if status == 200:
+                stats.probes.append((time.perf_counter() - start) * 1000)
+            else:
+                stats.errors += 1
+        except OSError:
+            stats.errors += 1
+        await asyncio.sleep(random.uniform(0, 0.1))
+
+
+async def run_load(args, config):
+    stats = Stats()
+    deadline = time.monotonic() + args.duration
+    uploaders = int(args.slow_clients * args.upload_share)
+    tasks = [slow_upload(args.url, config, stats, deadline, args.rate) for _ in range(uploaders)]
+    tasks += [slow_download(args.url, config, stats, deadline, args.rate) for _ in range(args.slow_clients - uploaders)]
+    tasks += [probe(args.url, config, stats, deadline) for _ in range(args.probes)]
+    await asyncio.gather(*tasks)
+    return stats
+
+
+def run(args):
+    with open(args.config) as config_file:
+        config = json.load(config_file)
+
+    start = time.monotonic()
+    stats = asyncio.run(run_load(args, config))
+    elapsed = time.monotonic() - start
+
+    probes = sorted(stats.probes)
+    report = {
+        'url': args.url,
+        'slow_clients': args.slow_clients,
+        'seconds': elapsed,
+        'slow_bytes_per_sec': stats.bytes / elapsed,
+        'probes_per_sec': len(probes) / elapsed,
+        'probe_p50_ms': statistics.median(probes) if probes else None,
+        'probe_p99_ms': probes[int(len(probes) * 0.99) - 1] if probes else None,
+        'errors': stats.errors,
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(report, out, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    prepare_parser = commands.add_parser('prepare', help='create the test user, file and session')
+    prepare_parser.add_argument('--size', default='20M', help='size of the file slow clients download')
+
+    run_parser = commands.add_parser('run', help='run the load against a server')
+    run_parser.add_argument('config', help='output of the prepare command')
+    run_parser.add_argument('--url', default='http://127.0.0.1:8000')
+    run_parser.add_argument('--slow-clients', type=int, default=2000)
+    run_parser.add_argument('--upload-share', type=float, default=0.5, help='fraction of slow clients uploading')
+    run_parser.add_argument('--rate', type=int, default=16 * 1024, help='bytes per second per slow client')
+    run_parser.add_argument('--probes', type=int, default=20, help='concurrent fast probe clients')
+    run_parser.add_argument('--duration', type=int, default=60)
+    run_parser.add_argument('--json', help='write the results to this file')
+
+    args = parser.parse_args()
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+    prepare(args) if args.command == 'prepare' else run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -45,11 +45,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so it times everything below (mainapp/metrics.py)
+    'mainapp.metrics.MetricsMiddleware',
+    # outside the session middleware, whose saves count as writes
+    'mainapp.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'mainapp.auth.CachedAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -75,6 +79,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'hosting.wsgi.application'
 
+# serve the upload, download, share and delete views as coroutines; turn on
+# when running under an ASGI server (hosting.asgi:application), e.g. with
+# ASYNC_FILE_VIEWS=1 uvicorn hosting.asgi:application
+ASYNC_FILE_VIEWS = os.environ.get('ASYNC_FILE_VIEWS') == '1'
+
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
@@ -98,17 +107,136 @@ DATABASES = {
         'PASSWORD': 'developer',
         'HOST': 'localhost',  # Set to the address of your PostgreSQL server
         'PORT': '5432',       # Set to the port your PostgreSQL server is running on
+        # connections stay open this many seconds (DATABASE_CONN_MAX_AGE, 0
+        # closes them after every request) and are checked before reuse;
+        # under ASGI persistent connections are not closed properly, so with
+        # ASYNC_FILE_VIEWS the default is 0
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 0 if ASYNC_FILE_VIEWS else 60)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
-# for tests.py usage only
+# Django 4.2 has no connection pool of its own; run PgBouncer in transaction
+# pooling mode in front of PostgreSQL and set DATABASE_PGBOUNCER=1, which
+# turns off the server side cursors such a pool cannot keep across queries
+if os.environ.get('DATABASE_PGBOUNCER') == '1':
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# read replicas of the default database (mainapp/routers.py), from
+# DATABASE_REPLICA_HOSTS as host[:port],host[:port]; listings and download
+# access checks read from them, and clients that just wrote are pinned to the
+# primary for REPLICA_PIN_SECONDS, which must exceed the replication lag
+DATABASE_REPLICAS = []
+for number, address in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',')), 1):
+    host, _, port = address.partition(':')
+    DATABASES[f'replica{number}'] = {
+        **DATABASES['default'], 'HOST': host, 'PORT': port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{number}')
+DATABASE_ROUTERS = ['mainapp.routers.PrimaryReplicaRouter']
+REPLICA_PIN_SECONDS = 5
+
+# for tests.py usage only; the replica mirrors the test database, and tests
+# turn it on with DATABASE_REPLICAS
 if 'test' in sys.argv or 'pytest' in sys.argv:
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
             'NAME': ':memory:',
-        }
+        },
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+            'TEST': {'MIRROR': 'default'},
+        },
     }
+    DATABASE_REPLICAS = []
+
+
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# "listings" holds the per-user dashboard listings and their rendered
+# fragments (mainapp/listing_cache.py). Every worker process has to see the
+# same entries, or an upload handled by one is missing from the listings of
+# the others, so it is a file based cache in LISTING_CACHE_DIR (from the
+# environment). It is shared by the processes of one host; with several hosts
+# use redis (needs the redis package)
+#   'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+#   'LOCATION': 'redis://127.0.0.1:6379',
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'listings': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('LISTING_CACHE_DIR', '/var/tmp/sharefile-listings'),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # login attempt counters (LOGIN_RATE_LIMITS below)
+    'ratelimit': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ratelimit',
+    },
+}
+LISTING_CACHE = 'listings'
+LISTING_CACHE_TIMEOUT = 10 * 60
+
+# tests reuse user ids after every rollback, so listings are not cached there
+if 'test' in sys.argv or 'pytest' in sys.argv:
+    CACHES['listings'] = {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+
+# Sessions and the authentication hot path (mainapp/auth.py)
+# https://docs.djangoproject.com/en/4.2/topics/http/sessions/#configuring-the-session-engine
+#
+# SESSION_ENGINE (also from the environment):
+#   '...backends.db'              a database query on every request (the
+#                                 default)
+#   '...backends.cached_db'       read from the default cache, written through
+#                                 to the database
+#   '...backends.signed_cookies'  no server side state at all, but a session
+#                                 cannot be revoked before it expires
+# cached_db needs a default cache shared by all worker processes (redis, see
+# above); with local memory a logout is only seen by the process that
+# handled it.
+SESSION_ENGINE = os.environ.get('SESSION_ENGINE', 'django.contrib.sessions.backends.db')
+
+# logged in users kept per process (0 to load the user on every request), and
+# the cache holding their version tokens; users are only kept when that cache
+# is shared between processes, not local memory
+AUTH_USER_CACHE_SIZE = 10000
+AUTH_CACHE = 'default'
+
+# addresses of the reverse proxies in front (nginx on the same host is
+# '127.0.0.1'); requests from them take the client address from the
+# X-Forwarded-For header they set:
+#   proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+TRUSTED_PROXIES = [address for address in os.environ.get('TRUSTED_PROXIES', '').split(',') if address]
+
+# login attempts allowed per (attempts, seconds), counted per client address
+# and per username in LOGIN_RATE_LIMIT_CACHE
+LOGIN_RATE_LIMITS = {'address': (20, 60), 'username': (10, 5 * 60)}
+LOGIN_RATE_LIMIT_CACHE = 'ratelimit'
+
+# every test logs in from the same address
+if 'test' in sys.argv or 'pytest' in sys.argv:
+    CACHES['ratelimit'] = {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+
+# /metrics (mainapp/metrics.py) answers staff users, scrapers sending
+# "Authorization: Bearer <METRICS_TOKEN>" (from the environment), and these
+# client addresses; behind a proxy left out of TRUSTED_PROXIES every client
+# has the proxy's address
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_ALLOWED_ADDRESSES = []
+
+# profiling of slow requests: the fraction of requests run under cProfile (0
+# turns it off), the seconds after which their profile is written to
+# METRICS_PROFILE_DIR, and how many profiles it may hold
+METRICS_PROFILE_RATE = 0
+METRICS_PROFILE_SLOW = 1.0
+METRICS_PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+METRICS_PROFILE_MAX_FILES = 100
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -150,6 +278,100 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# file storage; "uploads" holds user files, deduplicated by content hash
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+    'uploads': {
+        'BACKEND': 'mainapp.storage.ContentAddressedStorage',
+    },
+}
+
+# downloads can be handed to a front proxy instead of being streamed by django:
+# 'X-Accel-Redirect' (nginx, serving DOWNLOAD_ACCEL_REDIRECT_PREFIX from an
+# internal location aliased to MEDIA_ROOT) or 'X-Sendfile' (apache, lighttpd)
+# with STORAGE_COMPRESSION the proxy must pass the Content-Encoding header of
+# the response on (nginx: add_header Content-Encoding $upstream_http_content_encoding)
+DOWNLOAD_SENDFILE_HEADER = None
+DOWNLOAD_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+
+# most files one ZIP download (mainapp/archives.py) may hold
+ZIP_MAX_FILES = 10000
+
+# compression at rest for new blobs (mainapp.compression): None, 'gzip' or
+# 'zstd' (needs the zstandard package), and the level; None for the
+# encoding's default. Content that is compressed already is stored as is.
+STORAGE_COMPRESSION = None
+STORAGE_COMPRESSION_LEVEL = None
+
+# resumable uploads: default, smallest and largest chunk size, and how long an
+# idle upload session is kept before cleanup_upload_sessions deletes it
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE_MIN = 64 * 1024
+UPLOAD_CHUNK_SIZE_MAX = 64 * 1024 * 1024
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+
+# collect_orphans only removes unreferenced files older than this, in seconds,
+# so uploads that are still being committed are never touched
+ORPHAN_MIN_AGE = 60 * 60
+
+# background tasks (mainapp.tasks, run by the run_tasks command): how many
+# tasks of each queue may run at once across all workers, seconds before the
+# task of a worker that stopped is run again, the first retry delay, which
+# doubles with every attempt, and how often idle workers look for new tasks
+TASK_QUEUES = {'default': 4, 'uploads': 4}
+TASK_LEASE = 10 * 60
+TASK_RETRY_DELAY = 30
+TASK_POLL_INTERVAL = 1
+
+# steps run on every upload after the request returned (mainapp.processing)
+UPLOAD_PROCESSORS = ['mainapp.processing.verify_integrity', 'mainapp.previews.preview_upload']
+
+# previews (mainapp/previews.py): the cache directory (None for previews/ in
+# MEDIA_ROOT) and its size in bytes, the largest thumbnail side in pixels, the
+# lines of text shown, the largest file whose missing preview a request makes
+# itself, and how long browsers keep previews, in seconds
+PREVIEW_CACHE_DIR = None
+PREVIEW_CACHE_SIZE = 512 * 1024 * 1024
+PREVIEW_SIZE = 320
+PREVIEW_TEXT_LINES = 20
+PREVIEW_INLINE_MAX_SIZE = 20 * 1024 * 1024
+PREVIEW_MAX_AGE = 365 * 24 * 60 * 60
+
+# content hashing: threads shared by all uploads of a process, and the fast
+# fingerprint stored next to file_hash ('sha256-tree', 'blake3', 'xxh3-128'
+# or None; see mainapp/hashing.py)
+HASH_THREADS = os.cpu_count() or 1
+FILE_FINGERPRINT = 'sha256-tree'
+
+# keep a SHA-256 per 4 MiB block of every stored content (mainapp/manifests.py),
+# for per-block integrity checks and delta re-uploads; hashes every upload a
+# second time, which on a single core halves hashing throughput
+FILE_MANIFEST = True
+
+# bytes every user may store unless UserUsage.quota says otherwise; None for no limit
+STORAGE_QUOTA = 10 * 1024 * 1024 * 1024
+
+# integrity scrubbing (scrub_files): file read rate limit in bytes per second
+# shared by all worker processes (0 for no limit), and where the position of
+# an interrupted pass is kept so the next run resumes there
+SCRUB_RATE_LIMIT = 200 * 1024 * 1024
+SCRUB_CHECKPOINT = os.path.join(BASE_DIR, 'scrub_checkpoint.json')
+
+# uploads are hashed while they are received, before the default handlers store them
+# the quota handler goes first, so an upload over quota is stopped before any
+# other handler sees its bytes
+FILE_UPLOAD_HANDLERS = [
+    'mainapp.uploadhandlers.QuotaUploadHandler',
+    'mainapp.uploadhandlers.HashingUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
@@ -1,8 +1,8 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic.base import RedirectView
-from django.conf import settings
-from django.conf.urls.static import static
+
+from mainapp import views as mainapp_views
 
 urlpatterns = [
     
@@ -14,8 +14,10 @@ urlpatterns = [
 
     # includes the urls from mainapp
     path('mainapp/', include('mainapp.urls')),
+
+    # Prometheus scrapes this
+    path('metrics', mainapp_views.metrics_view, name='metrics'),
 ]
 
-# checks if we are in the development mode or not; T = debug, F = production
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# uploaded files are not served from MEDIA_URL; they are only reachable
+# through the mainapp download view, which checks ownership and sharing
@@ -0,0 +1,81 @@
+# Maintains FileAccess, the effective access index (see models.FileAccess).
+#
+# A (user, file) row exists while at least one share backs it: a direct share
+# (SharedFile) or a share with a group the user belongs to (GroupShare). Every
+# change touches only the rows it can affect: sharing a file with a group adds
+# one row per member for that file, a user joining a group adds one row per file
+# shared with that group, and revoking re-checks just the affected pairs.
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from .listing_cache import invalidate, listing_cache
+from .models import FileAccess, GroupShare, SharedFile
+
+# index rows written per INSERT, and ids per IN list when revoking
+ACCESS_BATCH_SIZE = 1000
+
+Membership = User.groups.through
+
+
+# Records access for (file_id, user_id) pairs; pairs already present are skipped.
+def grant(pairs):
+    user_ids = set()
+
+    def rows():
+        for file_id, user_id in pairs:
+            user_ids.add(user_id)
+            yield FileAccess(uploadedfile_id=file_id, user_id=user_id)
+
+    rows = rows()
+    while batch := list(islice(rows, ACCESS_BATCH_SIZE)):
+        FileAccess.objects.bulk_create(batch, ignore_conflicts=True)
+    # their shared files listings changed
+    invalidate(user_ids)
+
+
+# members of the given groups
+def group_members(group_ids):
+    return list(Membership.objects.filter(group_id__in=group_ids).values_list('user_id', flat=True).distinct())
+
+
+# files shared with the given groups
+def group_files(group_ids):
+    return list(GroupShare.objects.filter(group_id__in=group_ids).values_list('uploadedfile_id', flat=True).distinct())
+
+
+# Grants every member of the groups access to the files.
+def grant_groups(file_ids, group_ids):
+    members = group_members(group_ids)
+    grant((file_id, user_id) for file_id in file_ids for user_id in members)
+
+
+# Removes the rows among file_ids x user_ids that no share backs any more.
+# The check runs in the database, one DELETE per batch of ids.
+def refresh(file_ids, user_ids):
+    file_ids, user_ids = list(file_ids), list(user_ids)
+    direct = SharedFile.objects.filter(uploadedfile=OuterRef('uploadedfile'), user=OuterRef('user'))
+    via_group = GroupShare.objects.filter(uploadedfile=OuterRef('uploadedfile'), group__user=OuterRef('user'))
+
+    for f in range(0, len(file_ids), ACCESS_BATCH_SIZE):
+        for u in range(0, len(user_ids), ACCESS_BATCH_SIZE):
+            FileAccess.objects.filter(
+                uploadedfile_id__in=file_ids[f:f + ACCESS_BATCH_SIZE],
+                user_id__in=user_ids[u:u + ACCESS_BATCH_SIZE],
+            ).filter(~Exists(direct), ~Exists(via_group)).delete()
+    invalidate(user_ids)
+
+
+# Rebuilds the whole index from the shares; used after imports or raw SQL
+# changes that bypassed the signals.
+def rebuild():
+    # every shared listing may change
+    transaction.on_commit(listing_cache().clear)
+    FileAccess.objects.all().delete()
+    grant(SharedFile.objects.values_list('uploadedfile_id', 'user_id').iterator())
+    grant(
+        GroupShare.objects.filter(group__user__isnull=False)
+        .values_list('uploadedfile_id', 'group__user').iterator()
+    )
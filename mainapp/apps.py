@@ -4,3 +4,17 @@ from django.apps import AppConfig
 class MainappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mainapp'
+
+    def ready(self):
+        # keeps the effective access index in step with shares and groups
+        from . import signals  # noqa: F401
+        # registers the background tasks with the queue
+        from . import processing  # noqa: F401
+
+        # times the queries of every database connection
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+        from .metrics import instrument_connection
+        connection_created.connect(instrument_connection)
+        for connection in connections.all(initialized_only=True):
+            instrument_connection(None, connection)
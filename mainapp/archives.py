@@ -0,0 +1,132 @@
+# ZIP archives of many files, streamed while they are written.
+#
+# zipfile writes the archive into a sink that cannot seek, so every entry
+# gets a data descriptor after its content instead of sizes patched into its
+# header, and the response sends whatever the sink collected after every
+# block read. Neither a temporary file nor the archive is ever kept; memory
+# stays at about one block plus a few hundred bytes per entry for the central
+# directory. Entries that could pass 4 GiB are written as ZIP64, and zipfile
+# switches the end of the archive to ZIP64 when it needs to.
+#
+# Content that is compressed already (see compression.compressible) is
+# stored; everything else is deflated at a low level, since it is done while
+# the client waits.
+import logging
+import os
+import zipfile
+
+from django.core.files.storage import storages
+from django.http import StreamingHttpResponse
+from django.utils.http import content_disposition_header
+
+from . import metrics
+from .compression import compressible, open_decoded
+from .storage import stored_name
+
+logger = logging.getLogger(__name__)
+
+# bytes read from a stored file at a time
+BLOCK_SIZE = 1024 * 1024
+
+DEFLATE_LEVEL = 1
+
+# entries from this size on are written as ZIP64; zipfile allows 5% of growth
+# through compression before it needs to know in advance
+ZIP64_THRESHOLD = int(zipfile.ZIP64_LIMIT / 1.05)
+
+
+# The output zipfile writes to: collects the bytes until they are taken.
+class Sink:
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+# Name of a file inside the archive: its upload name without directories,
+# below the owner's username for files of other users, made unique in used.
+def entry_name(uploaded_file, user, used):
+    name = (uploaded_file.name or uploaded_file.file_url).replace('\\', '/').rsplit('/', 1)[-1]
+    name = name.strip(' .') or f'file-{uploaded_file.id}'
+    if uploaded_file.user_id != user.id:
+        name = f'{uploaded_file.user.username}/{name}'
+
+    stem, extension = os.path.splitext(name)
+    candidate, number = name, 2
+    while candidate.lower() in used:
+        candidate, number = f'{stem} ({number}){extension}', number + 1
+    used.add(candidate.lower())
+    return candidate
+
+
+# (entry name, path, encoding, size) of the files to archive; files whose
+# stored bytes are missing are left out and logged, so one lost file does not
+# keep the others from being downloaded.
+def archive_entries(files, user):
+    fs = storages['uploads']
+    entries, used = [], set()
+    for uploaded_file in files:
+        name = stored_name(uploaded_file)
+        blob = uploaded_file.blob
+        try:
+            size = os.stat(fs.path(name)).st_size if name else None
+        except FileNotFoundError:
+            size = None
+        if size is None:
+            logger.warning('file %s is missing from the storage, left out of the archive', uploaded_file.id)
+            continue
+        encoding = blob.encoding if blob else ''
+        if encoding:
+            size = uploaded_file.size
+        entries.append((entry_name(uploaded_file, user, used), fs.path(name), encoding, size))
+    return entries
+
+
+# Yields the ZIP archive of entries piece by piece.
+def stream_zip(entries):
+    sink = Sink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=DEFLATE_LEVEL) as archive:
+        for name, path, encoding, size in entries:
+            with open_decoded(path, encoding) as source:
+                data = source.read(BLOCK_SIZE)
+                archive.compression = zipfile.ZIP_DEFLATED if compressible(data) else zipfile.ZIP_STORED
+                with archive.open(name, 'w', force_zip64=size >= ZIP64_THRESHOLD) as entry:
+                    while data:
+                        entry.write(data)
+                        if piece := sink.take():
+                            yield piece
+                        data = source.read(BLOCK_SIZE)
+            # the data descriptor
+            if piece := sink.take():
+                yield piece
+    # the central directory
+    yield sink.take()
+
+
+def counted(pieces):
+    for piece in pieces:
+        metrics.download_bytes.inc(len(piece), 'zip')
+        yield piece
+
+
+# Streaming response with the ZIP archive of files, for user.
+def zip_response(files, user, filename):
+    response = StreamingHttpResponse(counted(stream_zip(archive_entries(files, user))), content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
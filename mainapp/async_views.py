@@ -0,0 +1,148 @@
+# async versions of the file views, for serving the project through hosting/asgi.py
+#
+# Under ASGI a sync view holds a worker thread for its whole run, including
+# every byte of a slow download. These views only hold the event loop while
+# they wait: reads use Django's async ORM, writes that need a transaction and
+# all file I/O run in worker threads, and downloads stream through an async
+# iterator. mainapp/urls.py routes to them when settings.ASYNC_FILE_VIEWS is on.
+import asyncio
+import functools
+import os
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import Group, User
+from django.contrib.auth.views import redirect_to_login
+from django.core.files.storage import storages
+from django.http import Http404, HttpResponseBadRequest
+from django.shortcuts import render, redirect
+
+from .downloads import file_response
+from .forms import SharedFileForm
+from .models import UploadedFile
+from . import views
+from .routers import afrom_replica
+from .storage import stored_name
+from .quotas import QuotaExceeded
+from .uploadhandlers import received_digests, quota_error
+from .uploads import store_upload, delete_upload
+
+
+# login_required for coroutine views.
+# request.user is loaded lazily with a sync query, so it is resolved once in a
+# worker thread; afterwards it is a plain attribute read.
+def async_login_required(view):
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if not await sync_to_async(lambda: request.user.is_authenticated)():
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+# upload view; same page and behaviour as views.upload
+@async_login_required
+async def upload(request):
+    context = {}
+    status = 200
+
+    try:
+        owned_before, shared_before = views.dashboard_cursors(request)
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
+
+    if request.method == 'POST':
+        # parsing the multipart body writes the upload to a temp file, unless
+        # the quota handler stops it
+        files = await sync_to_async(lambda: request.FILES)()
+        uploaded_file = files.get('document')
+
+        if uploaded_file is None:
+            context['error'] = quota_error(request) or 'No file was uploaded'
+            status = 413 if quota_error(request) else 400
+        else:
+            try:
+                # storing is one transaction plus file moves, so it runs in a worker
+                # thread, as does waiting for the last blocks to be hashed
+                uploaded_file_obj = await sync_to_async(lambda: store_upload(
+                    request.user, uploaded_file, uploaded_file.name, received_digests(request, 'document'),
+                ))()
+                context['url'] = uploaded_file_obj.file_url
+            except QuotaExceeded as error:
+                context['error'] = str(error)
+                status = 413
+
+    # cache lookups and, on a miss, the list queries run in a worker thread
+    context.update(await sync_to_async(views.dashboard_fragments)(request.user, owned_before, shared_before))
+
+    # the lists are already rendered, so rendering does no queries
+    return render(request, 'upload.html', context, status=status)
+
+
+# download view; same checks and headers as views.download_file
+@async_login_required
+async def download_file(request, file_id):
+    file_to_download = await afrom_replica(
+        UploadedFile.objects.accessible_by(request.user).select_related('blob').filter(pk=file_id).afirst
+    )
+    if file_to_download is None:
+        raise Http404('File not found')
+
+    fs = storages['uploads']
+    name = stored_name(file_to_download)
+    if name is None or not await asyncio.to_thread(fs.exists, name):
+        raise Http404('File not found')
+
+    # opening the file happens in a worker thread; the body is read in worker
+    # threads block by block as the client consumes it
+    blob = file_to_download.blob
+    return await asyncio.to_thread(
+        file_response, request, fs, name, file_to_download.file_hash,
+        file_to_download.name or os.path.basename(name), asynchronous=True,
+        encoding=blob.encoding if blob else '', size=file_to_download.size,
+    )
+
+
+# share view; same form as views.share_file, limited to the owner's files
+@async_login_required
+async def share_file(request, file_id):
+    file_to_share = await UploadedFile.objects.filter(pk=file_id, user=request.user).afirst()
+    if file_to_share is None:
+        raise Http404('File not found')
+
+    if request.method == 'POST':
+        form = SharedFileForm(request.POST)
+
+        if form.is_valid():
+            if form.cleaned_data['share_with']:
+                shared_user = await User.objects.filter(username=form.cleaned_data['share_with']).afirst()
+                if shared_user is not None:
+                    await file_to_share.shared_with.aadd(shared_user)
+                else:
+                    form.add_error('share_with', 'User does not exist')
+
+            if form.cleaned_data['share_with_group']:
+                group = await Group.objects.filter(name=form.cleaned_data['share_with_group']).afirst()
+                if group is not None:
+                    await file_to_share.shared_with_groups.aadd(group)
+                else:
+                    form.add_error('share_with_group', 'Group does not exist')
+
+            if not form.errors:
+                return redirect('upload')
+    else:
+        form = SharedFileForm()
+
+    return render(request, 'share_file.html', {'form': form, 'file_to_share': file_to_share})
+
+
+# delete view; same behaviour as views.delete_file, limited to the owner's files
+@async_login_required
+async def delete_file(request, file_id):
+    file_to_delete = await UploadedFile.objects.filter(pk=file_id, user=request.user).afirst()
+    if file_to_delete is None:
+        raise Http404('File not found')
+
+    # releasing the blob is transactional and may remove a file
+    await sync_to_async(delete_upload)(file_to_delete)
+
+    return redirect('upload')
@@ -0,0 +1,160 @@
+# The authentication hot path: a per-process cache of logged in users, and
+# rate limits on login attempts.
+#
+# Every request of a logged in user used to load the User row by the id in
+# its session. CachedAuthenticationMiddleware keeps recently seen users in
+# process memory instead, tagged with a version token per user in the
+# settings.AUTH_CACHE cache; saving or deleting a user gives it a new token
+# (see signals.py), so every process loads it again on its next request. The
+# session hash is checked on every request as django.contrib.auth does, so a
+# changed password still logs out other sessions. The tokens only reach every
+# worker process through a shared cache (redis, files), so with a local memory
+# or dummy AUTH_CACHE users are loaded on every request as before.
+#
+# Login attempts are counted per client address and per username in fixed
+# windows (settings.LOGIN_RATE_LIMITS); over the limit, user_login answers 429
+# before authenticate() runs the password hasher. Behind a reverse proxy the
+# client address comes from X-Forwarded-For (settings.TRUSTED_PROXIES).
+import copy
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+
+# (backend path, user id) -> (version, user), least recently used first
+_users = OrderedDict()
+_lock = threading.Lock()
+
+
+# whether every worker process sees the version tokens
+def shared_cache(cache):
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def version_key(user_id):
+    return f'auth-user-version:{user_id}'
+
+
+# the current version token of a user
+def user_version(user_id):
+    cache = caches[settings.AUTH_CACHE]
+    version = cache.get(version_key(user_id))
+    if version is None:
+        cache.add(version_key(user_id), uuid.uuid4().hex, None)
+        version = cache.get(version_key(user_id))
+    return version
+
+
+# Gives a user a new version token right away, so no process serves its old
+# row from now on, and again when the transaction commits, so a request that
+# read the row in between does not keep it either.
+def invalidate_user(user_id):
+    def bump():
+        caches[settings.AUTH_CACHE].set(version_key(user_id), uuid.uuid4().hex, None)
+        with _lock:
+            for key in [key for key in _users if key[1] == str(user_id)]:
+                del _users[key]
+    bump()
+    transaction.on_commit(bump)
+
+
+# The user of the request's session, as django.contrib.auth.get_user() returns
+# it, from the process cache when its version is current.
+def get_cached_user(request):
+    try:
+        user_id = str(request.session[SESSION_KEY])
+        backend_path = request.session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return auth.get_user(request)
+    if not settings.AUTH_USER_CACHE_SIZE or not shared_cache(caches[settings.AUTH_CACHE]):
+        return auth.get_user(request)
+
+    key = (backend_path, user_id)
+    version = user_version(user_id)
+    with _lock:
+        entry = _users.get(key)
+        if entry is not None:
+            _users.move_to_end(key)
+
+    if entry is not None and entry[0] == version:
+        # every request gets its own copy to set attributes on
+        user = copy.copy(entry[1])
+        session_hash = request.session.get(HASH_SESSION_KEY)
+        if session_hash and constant_time_compare(session_hash, user.get_session_auth_hash()):
+            return user
+        # a session of an old password, or signed with an old secret key
+        return auth.get_user(request)
+
+    user = auth.get_user(request)
+    if user.is_authenticated:
+        with _lock:
+            _users[key] = (version, copy.copy(user))
+            while len(_users) > settings.AUTH_USER_CACHE_SIZE:
+                _users.popitem(last=False)
+    return user
+
+
+# django.contrib.auth.middleware.AuthenticationMiddleware, with request.user
+# from get_cached_user
+class CachedAuthenticationMiddleware(AuthenticationMiddleware):
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_cached_user(request))
+
+
+# The address of the client: REMOTE_ADDR, or when that is one of
+# TRUSTED_PROXIES, the last address in X-Forwarded-For not added by one of
+# them. Addresses further left are whatever the client sent.
+def client_address(request):
+    address = request.META.get('REMOTE_ADDR', '')
+    if address not in settings.TRUSTED_PROXIES:
+        return address
+    forwarded = [part.strip() for part in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+    for hop in reversed(forwarded):
+        if not hop:
+            break
+        address = hop
+        if address not in settings.TRUSTED_PROXIES:
+            break
+    return address
+
+
+def attempts_key(scope, value):
+    return f'login-attempts:{scope}:' + hashlib.sha256(value.encode()).hexdigest()
+
+
+# Counts a login attempt for the client address and the username; returns the
+# seconds to wait when either is over its limit, else None.
+def throttle_login(request, username):
+    cache = caches[settings.LOGIN_RATE_LIMIT_CACHE]
+    retry_after = None
+    for scope, value in (('address', client_address(request)), ('username', username.lower())):
+        limit, window = settings.LOGIN_RATE_LIMITS[scope]
+        key = attempts_key(scope, value)
+        cache.add(key, 0, window)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # expired between add() and incr()
+            cache.set(key, 1, window)
+            count = 1
+        if count > limit:
+            retry_after = max(retry_after or 0, window)
+    return retry_after
+
+
+# A successful login forgets the failed attempts for the username.
+def reset_login_attempts(username):
+    caches[settings.LOGIN_RATE_LIMIT_CACHE].delete(attempts_key('username', username.lower()))
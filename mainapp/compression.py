@@ -0,0 +1,128 @@
+# Compression at rest for blobs (settings.STORAGE_COMPRESSION):
+#   'gzip'  zlib from the standard library; always available
+#   'zstd'  Zstandard, several times faster at a similar ratio; needs the
+#           zstandard package
+# Blob.encoding records how a blob is stored ('' for raw bytes). file_hash,
+# the fingerprint and the block manifest always describe the original bytes.
+#
+# Content that is already compressed (archives, images, video, ...) is found
+# by its magic number or by a trial compression of its first block and stored
+# raw, as is content that did not shrink by COMPRESSION_MIN_SAVING in the end.
+import gzip
+import zlib
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# prefixes of formats that are compressed already
+COMPRESSED_SIGNATURES = (
+    b'\x1f\x8b',                # gzip
+    b'\x28\xb5\x2f\xfd',        # zstd
+    b'PK\x03\x04',              # zip, docx, xlsx, jar, apk, epub
+    b'BZh',                     # bzip2
+    b'\xfd7zXZ\x00',            # xz
+    b"7z\xbc\xaf'\x1c",         # 7-zip
+    b'Rar!\x1a\x07',            # rar
+    b'\x89PNG',                 # png
+    b'\xff\xd8\xff',            # jpeg
+    b'GIF8',                    # gif
+    b'\x1aE\xdf\xa3',           # matroska, webm
+    b'OggS',                    # ogg
+    b'fLaC',                    # flac
+    b'ID3',                     # mp3
+    b'wOF2',                    # woff2
+)
+
+# bytes of the first block compressed on trial
+SNIFF_SIZE = 64 * 1024
+
+# the smallest saving, as a fraction of the original size, worth storing
+# compressed content for
+COMPRESSION_MIN_SAVING = 0.1
+
+# compression happens while the upload request waits; gzip -1 keeps most of
+# the saving of -6 at four times the speed (benchmarks/bench_compression.py)
+DEFAULT_LEVELS = {'gzip': 1, 'zstd': 3}
+
+# what reading a damaged compressed file raises
+DECODE_ERRORS = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def available_encodings():
+    names = ['gzip']
+    if zstandard is not None:
+        names.append('zstd')
+    return names
+
+
+# Decides from the first bytes of some content whether compressing it pays.
+def compressible(head):
+    if head.startswith(COMPRESSED_SIGNATURES):
+        return False
+    # mp4, mov, heic
+    if head[4:8] == b'ftyp':
+        return False
+    # webp, avi
+    if head[:4] == b'RIFF' and head[8:12] in (b'WEBP', b'AVI '):
+        return False
+    # encrypted or random data has no magic number; a quick trial on the
+    # first block finds it
+    sample = head[:SNIFF_SIZE]
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - COMPRESSION_MIN_SAVING)
+
+
+# A streaming compressor with compress(data) and flush(), both returning the
+# bytes to write.
+def compressor(encoding, level=None):
+    if encoding not in available_encodings():
+        raise ValueError(f'compression {encoding!r} is not available')
+    level = level or settings.STORAGE_COMPRESSION_LEVEL or DEFAULT_LEVELS[encoding]
+    if encoding == 'gzip':
+        # wbits 31 writes a gzip header and trailer, so the files open with gzip
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+# Opens the stored file at path for reading its original bytes. The result
+# can seek forward only, and does so by decompressing.
+def open_decoded(path, encoding):
+    if not encoding:
+        return open(path, 'rb')
+    if encoding == 'gzip':
+        return gzip.open(path, 'rb')
+    if zstandard is None:
+        raise ValueError('zstd compressed blobs need the zstandard package')
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+
+# The reading side of a decompressing file for responses: only read() and
+# close(), so FileResponse neither sendfile()s the compressed bytes nor seeks
+# to the end to learn the size.
+class DecodedFile:
+
+    def __init__(self, file):
+        self.file = file
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+
+# Whether the Accept-Encoding header of a request allows encoding.
+def accepts(request, encoding):
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = item.strip().partition(';')
+        if name.strip().lower() not in (encoding, '*'):
+            continue
+        quality = params.strip()
+        try:
+            return not quality.startswith('q=') or float(quality[2:]) > 0
+        except ValueError:
+            return False
+    return False
@@ -0,0 +1,174 @@
+import asyncio
+import mimetypes
+import os
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import content_disposition_header, parse_etags
+
+from . import metrics
+from .compression import DecodedFile, accepts, open_decoded
+
+# read size when Django itself has to stream the file
+BLOCK_SIZE = 1024 * 1024
+
+
+# A file limited to one byte range. It keeps fileno() so a WSGI server's
+# file_wrapper can still sendfile() it: the file is positioned at the start of
+# the range and Content-Length tells the server how many bytes to send.
+class FileRange:
+
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+# Streams length bytes of file for async views. Every read runs in a worker
+# thread, so a slow disk never blocks the event loop, and only one block is
+# held in memory at a time however slow the client is.
+async def aiter_file(file, length, block_size=BLOCK_SIZE):
+    try:
+        while length > 0:
+            data = await asyncio.to_thread(file.read, min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        await asyncio.to_thread(file.close)
+
+
+# Parses a "Range: bytes=..." header into an inclusive (start, end) pair.
+# Returns None for no range or a syntax we do not serve (several ranges),
+# which means the whole file is sent, and raises ValueError when the range
+# cannot be satisfied.
+def parse_range(header, size):
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    suffix = not start
+    try:
+        if suffix:
+            # suffix range: the last N bytes
+            length = int(end)
+        else:
+            start = int(start)
+            end = int(end) if end else size - 1
+    except ValueError:
+        return None
+
+    if suffix:
+        # an empty file has no last bytes to send
+        if length <= 0 or size == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+
+# Builds the response for downloading one stored file.
+# file_hash is the file's SHA-256; the content never changes for a hash, so it
+# doubles as a strong ETag. Depending on settings.DOWNLOAD_SENDFILE_HEADER the
+# transfer is handed to a front proxy (X-Accel-Redirect for nginx, X-Sendfile
+# for Apache/lighttpd) or streamed with FileResponse, which the WSGI server's
+# file_wrapper sends with os.sendfile() where it can (gunicorn does).
+# With asynchronous=True the body is an async iterator for ASGI servers; call
+# it from a worker thread then, since it opens the file.
+# A blob compressed at rest (encoding, see compression.py) is sent as it is
+# stored, with Content-Encoding, to clients that accept the encoding; for the
+# others it is decompressed on the fly, without ranges. size is the length
+# of the original content then.
+def file_response(request, storage, name, file_hash, filename, asynchronous=False, encoding='', size=None):
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    passthrough = encoding and accepts(request, encoding)
+    # each representation has its own tag
+    etag = f'"{file_hash}-{encoding}"' if passthrough else f'"{file_hash}"'
+
+    # the client already holds this exact content
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    header = getattr(settings, 'DOWNLOAD_SENDFILE_HEADER', None)
+    if encoding and not passthrough:
+        file = DecodedFile(open_decoded(storage.path(name), encoding))
+        if asynchronous:
+            response = StreamingHttpResponse(aiter_file(file, size), content_type=content_type)
+        else:
+            response = FileResponse(file, content_type=content_type)
+            response.block_size = BLOCK_SIZE
+        response['Content-Length'] = size
+        response['Accept-Ranges'] = 'none'
+        metrics.download_bytes.inc(size or 0, 'decoded')
+    elif header:
+        # the proxy serves the bytes, including Range requests
+        response = HttpResponse(content_type=content_type)
+        if header == 'X-Accel-Redirect':
+            response[header] = settings.DOWNLOAD_ACCEL_REDIRECT_PREFIX + quote(name)
+        else:
+            response[header] = storage.path(name)
+        metrics.download_bytes.inc(size or 0, 'sendfile')
+    else:
+        file = open(storage.path(name), 'rb')
+        size = os.fstat(file.fileno()).st_size
+
+        # ranges only apply to the version the client started with
+        byte_range = request.headers.get('Range')
+        if_range = request.headers.get('If-Range')
+        if if_range and if_range != etag:
+            byte_range = None
+
+        try:
+            byte_range = parse_range(byte_range, size)
+        except ValueError:
+            file.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1
+        status = 206 if byte_range else 200
+
+        if asynchronous:
+            file.seek(start)
+            response = StreamingHttpResponse(aiter_file(file, length), status=status, content_type=content_type)
+        else:
+            body = FileRange(file, start, length) if byte_range else file
+            response = FileResponse(body, status=status, content_type=content_type)
+            response.block_size = BLOCK_SIZE
+
+        response['Content-Length'] = length
+        if byte_range:
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Accept-Ranges'] = 'bytes'
+        metrics.download_bytes.inc(length, 'stream')
+
+    if encoding:
+        if passthrough:
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ['Accept-Encoding'])
+    response['ETag'] = etag
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    return response
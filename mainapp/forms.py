@@ -1,6 +1,7 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
+from .pagination import parse_id
 
 class SignupForm(UserCreationForm):
     
@@ -25,4 +26,44 @@ class LoginForm(forms.Form):
         print(f'login password is: {self.fields["password"]}')
 
 class SharedFileForm(forms.Form):
-     share_with = forms.CharField(max_length=150)
\ No newline at end of file
+     share_with = forms.CharField(max_length=150, required=False)
+     # or share with every member of a group (team)
+     share_with_group = forms.CharField(max_length=150, required=False)
+
+     def clean(self):
+         cleaned_data = super().clean()
+         if not cleaned_data.get('share_with') and not cleaned_data.get('share_with_group'):
+             raise forms.ValidationError('Enter a user or a group to share with')
+         return cleaned_data
+
+
+# splits "a, b c" style input into its non-empty items; names that may contain
+# spaces (group names) are only split on commas and new lines
+def split_items(value, on_spaces=True):
+    if on_spaces:
+        return value.replace(',', ' ').split()
+    return [item.strip() for item in value.replace('\n', ',').split(',') if item.strip()]
+
+
+class BulkShareForm(forms.Form):
+    file_ids = forms.CharField(widget=forms.Textarea, help_text='File ids, separated by commas or spaces')
+    usernames = forms.CharField(widget=forms.Textarea, required=False, help_text='Usernames to share with')
+    groups = forms.CharField(widget=forms.Textarea, required=False, help_text='Groups whose members get access')
+
+    def clean_file_ids(self):
+        try:
+            return [parse_id(item) for item in split_items(self.cleaned_data['file_ids'])]
+        except ValueError:
+            raise forms.ValidationError('File ids must be positive numbers')
+
+    def clean_usernames(self):
+        return split_items(self.cleaned_data['usernames'])
+
+    def clean_groups(self):
+        return split_items(self.cleaned_data['groups'], on_spaces=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('usernames') and not cleaned_data.get('groups'):
+            raise forms.ValidationError('Enter at least one username or group')
+        return cleaned_data
@@ -0,0 +1,199 @@
+# Content hashing for uploads.
+#
+# file_hash stays a plain SHA-256 of the content, for compatibility with every
+# stored row. SHA-256 cannot be split across cores, so ContentHasher at least
+# takes it off the receiving thread: content is cut into blocks and hashed in
+# a thread pool (hashlib releases the GIL) while the next block is received.
+#
+# Optionally a fingerprint is computed next to it with a faster, parallel
+# algorithm (settings.FILE_FINGERPRINT):
+#   'sha256-tree'  SHA-256 of every TREE_BLOCK_SIZE block, hashed in parallel,
+#                  and a SHA-256 over the block digests; always available
+#   'blake3'       BLAKE3, multithreaded; needs the blake3 package
+#   'xxh3-128'     xxHash XXH3, 128 bit, not cryptographic; needs the xxhash package
+# Blob.fingerprint_algorithm records which one made Blob.fingerprint.
+#
+# The SHA-256 of every TREE_BLOCK_SIZE block is also kept as the content's
+# block manifest (settings.FILE_MANIFEST, see mainapp/manifests.py), so single
+# damaged blocks can be found and unchanged blocks re-used by later uploads.
+# The block digests are a second SHA-256 pass over the content: with one core
+# hashing takes about twice as long as file_hash alone, with more cores it
+# runs next to it. sha256-tree is made from the same digests at no extra cost.
+import hashlib
+import struct
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import metrics
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# size of the leaves of the sha256-tree fingerprint; also the unit in which
+# content is handed to the thread pool
+TREE_BLOCK_SIZE = 4 * 1024 * 1024
+
+# blocks a hasher may have queued for their block digest; every one holds up
+# to TREE_BLOCK_SIZE of received content, whatever the number of threads
+MAX_QUEUED_BLOCKS = 4
+
+_pool = None
+
+# everything a ContentHasher computed: the SHA-256 hex digest, the
+# (algorithm, hex digest) fingerprint or None, and the block manifest (list of
+# SHA-256 digests of block_size blocks) or None
+Digests = namedtuple('Digests', ['sha256', 'fingerprint', 'manifest', 'block_size'])
+
+
+# thread pool shared by all hashers of the process
+def hash_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(settings.HASH_THREADS, thread_name_prefix='hash')
+    return _pool
+
+
+# SHA-256 over the block digests, prefixed with the block size so trees over
+# different block sizes never compare equal
+def tree_root(leaves, block_size):
+    root = hashlib.sha256(b'sha256-tree' + struct.pack('>Q', block_size))
+    for leaf in leaves:
+        root.update(leaf)
+    return root.hexdigest()
+
+
+def leaf_digest(pieces):
+    leaf = hashlib.sha256()
+    update_all(leaf, pieces, 'sha256-block')
+    return leaf.digest()
+
+
+# feeds the pieces of a block to a running hash
+def update_all(hash_object, pieces, algorithm=None):
+    start = time.perf_counter()
+    for piece in pieces:
+        hash_object.update(piece)
+    algorithm = algorithm or getattr(hash_object, 'name', 'fingerprint')
+    metrics.hash_seconds.inc(time.perf_counter() - start, algorithm)
+    metrics.hash_bytes.inc(sum(len(piece) for piece in pieces), algorithm)
+
+
+# Fingerprint algorithms this process can compute.
+def available_fingerprints():
+    names = ['sha256-tree']
+    if blake3 is not None:
+        names.append('blake3')
+    if xxhash is not None:
+        names.append('xxh3-128')
+    return names
+
+
+# Hashes content fed to it with update() into its SHA-256 and, optionally, a
+# fingerprint and the block manifest. Blocks are hashed in the shared pool; at most a few blocks per
+# hasher are in flight, so memory stays bounded however large the content is.
+class ContentHasher:
+
+    def __init__(self, fingerprint=None, manifest=None):
+        if fingerprint is None:
+            fingerprint = settings.FILE_FINGERPRINT
+        if fingerprint and fingerprint not in available_fingerprints():
+            raise ValueError(f'fingerprint algorithm {fingerprint!r} is not available')
+        self.fingerprint_algorithm = fingerprint or ''
+        self.with_manifest = settings.FILE_MANIFEST if manifest is None else manifest
+
+        self.sha256_hash = hashlib.sha256()
+        self.block_size = TREE_BLOCK_SIZE
+        self.size = 0
+        # pieces of the block being filled; they are hashed as they are,
+        # never copied into one buffer
+        self._pieces = []
+        self._buffered = 0
+        self._sha256_pending = None
+        # block digests for the manifest and the sha256-tree, in content order
+        self._leaves = []
+        self._leaves_done = 0
+
+        if self.fingerprint_algorithm == 'blake3':
+            self._fingerprint_hash = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        elif self.fingerprint_algorithm == 'xxh3-128':
+            self._fingerprint_hash = xxhash.xxh3_128()
+        else:
+            self._fingerprint_hash = None
+        self._fingerprint_pending = None
+
+    # data must not be modified afterwards; it is hashed later, in the pool
+    def update(self, data):
+        self.size += len(data)
+        view = memoryview(data)
+        while view:
+            piece = view[:self.block_size - self._buffered]
+            self._pieces.append(piece)
+            self._buffered += len(piece)
+            view = view[len(piece):]
+            if self._buffered == self.block_size:
+                self._dispatch(self._pieces)
+                self._pieces, self._buffered = [], 0
+
+    # hands one block to the pool; the sequential hashes wait for their
+    # previous block, so they overlap with receiving the next one
+    def _dispatch(self, pieces):
+        pool = hash_pool()
+
+        if self._sha256_pending is not None:
+            self._sha256_pending.result()
+        self._sha256_pending = pool.submit(update_all, self.sha256_hash, pieces)
+
+        if self._fingerprint_hash is not None:
+            if self._fingerprint_pending is not None:
+                self._fingerprint_pending.result()
+            self._fingerprint_pending = pool.submit(update_all, self._fingerprint_hash, pieces)
+
+        if self.with_manifest or self.fingerprint_algorithm == 'sha256-tree':
+            self._leaves.append(pool.submit(leaf_digest, pieces))
+            # bounds the blocks held by queued leaves
+            while len(self._leaves) - self._leaves_done > MAX_QUEUED_BLOCKS:
+                self._leaves[self._leaves_done].result()
+                self._leaves_done += 1
+
+    # hashes what is still buffered and waits for the pool
+    def _finish(self):
+        if self._pieces:
+            self._dispatch(self._pieces)
+            self._pieces, self._buffered = [], 0
+        for pending in (self._sha256_pending, self._fingerprint_pending):
+            if pending is not None:
+                pending.result()
+        self._sha256_pending = self._fingerprint_pending = None
+
+    def hexdigest(self):
+        self._finish()
+        return self.sha256_hash.hexdigest()
+
+    # (algorithm, hex digest) of the fingerprint, or None without one
+    def fingerprint(self):
+        self._finish()
+        if self.fingerprint_algorithm == 'sha256-tree':
+            return self.fingerprint_algorithm, tree_root(self.manifest(), self.block_size)
+        if self._fingerprint_hash is not None:
+            return self.fingerprint_algorithm, self._fingerprint_hash.hexdigest()
+        return None
+
+    # SHA-256 digests of the blocks, or None without a manifest
+    def manifest(self):
+        self._finish()
+        if not self.with_manifest and self.fingerprint_algorithm != 'sha256-tree':
+            return None
+        return [leaf.result() for leaf in self._leaves]
+
+    def digests(self):
+        return Digests(self.hexdigest(), self.fingerprint(), self.manifest(), self.block_size)
@@ -0,0 +1,114 @@
+# Moves stored files to the sharded blob layout.
+#
+# Blobs used to be stored flat as blobs/<hash>, and files from before the
+# blob store lie directly in MEDIA_ROOT under their client-supplied names.
+# Both kinds end up at blobs/ab/cd/<hash> (see ContentAddressedStorage.blob_name),
+# with UploadedFile.file_url rewritten to match. Rows are read in batches of
+# ids; every file is moved in its own transaction, the rename last, so an
+# interrupted run leaves consistent rows behind and can simply be repeated.
+import os
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.core.files.storage import storages
+from django.db import transaction
+
+from .hashing import ContentHasher
+from .listing_cache import listing_cache
+from .models import Blob, UploadedFile, digest_from_hex
+from .quotas import add_usage
+from .storage import CHUNK_SIZE, stored_name
+
+# rows read per query
+BATCH_SIZE = 500
+
+
+@dataclass
+class LayoutReport:
+    blobs_moved: int = 0
+    files_adopted: int = 0
+    # (UploadedFile id, storage name) of legacy files left where they are
+    missing: list = field(default_factory=list)
+    mismatched: list = field(default_factory=list)
+
+
+# Moves one blob to its sharded name, if it is not there yet.
+def move_blob(blob_id):
+    fs = storages['uploads']
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().get(pk=blob_id)
+        name = fs.blob_name(blob.file_hash)
+        if blob.name == name:
+            return False
+
+        old_name, blob.name = blob.name, name
+        blob.save(update_fields=['name'])
+        UploadedFile.objects.filter(blob=blob).update(file_url=fs.url(name))
+
+        # when the old file is gone, a previous run renamed it and then failed
+        # to commit, or it was lost; the scrubber reports the latter
+        if fs.exists(old_name):
+            fs.place(fs.path(old_name), blob)
+    return True
+
+
+# Hashes a legacy file and moves it into the blob store.
+# Returns None on success, else 'missing' or 'mismatched' when the file is
+# gone or no longer matches its recorded file_hash.
+def adopt_file(uploaded_file):
+    fs = storages['uploads']
+    name = stored_name(uploaded_file)
+    path = fs.path(name)
+
+    hasher = ContentHasher()
+    try:
+        with open(path, 'rb') as stored:
+            while data := stored.read(CHUNK_SIZE):
+                hasher.update(data)
+    except FileNotFoundError:
+        return 'missing'
+    digests = hasher.digests()
+    # a damaged file would otherwise be passed off as good content
+    if uploaded_file.file_hash and uploaded_file.file_hash != digests.sha256:
+        return 'mismatched'
+
+    with transaction.atomic():
+        blob = fs.adopt_blob(path, digests)
+        # downloads keep offering the name the file was uploaded under
+        UploadedFile.objects.filter(pk=uploaded_file.pk).update(
+            blob=blob, file_hash=blob.file_hash, file_digest=digest_from_hex(blob.file_hash), file_url=fs.url(blob.name),
+            name=uploaded_file.name or os.path.basename(name), size=hasher.size,
+        )
+        # the file was counted with the size it had on record, 0 for most
+        if hasher.size != uploaded_file.size:
+            add_usage(uploaded_file.user_id, hasher.size - uploaded_file.size, 0)
+        # the same content was already stored
+        if os.path.exists(path):
+            transaction.on_commit(lambda: fs.delete(name))
+
+
+# Moves every blob and legacy file to the sharded layout.
+def shard_media():
+    report = LayoutReport()
+
+    last = 0
+    while ids := list(Blob.objects.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:BATCH_SIZE]):
+        for blob_id in ids:
+            report.blobs_moved += move_blob(blob_id)
+        last = ids[-1]
+
+    # files kept outside the upload storage stay where they are
+    legacy = UploadedFile.objects.filter(blob__isnull=True, file_url__startswith=settings.MEDIA_URL)
+    last = 0
+    while batch := list(legacy.filter(pk__gt=last).order_by('pk').only('id', 'user', 'file_url', 'file_hash', 'name', 'size', 'blob')[:BATCH_SIZE]):
+        for uploaded_file in batch:
+            problem = adopt_file(uploaded_file)
+            if problem:
+                getattr(report, problem).append((uploaded_file.id, stored_name(uploaded_file)))
+            else:
+                report.files_adopted += 1
+        last = batch[-1].pk
+
+    # listings show file_url
+    listing_cache().clear()
+    return report
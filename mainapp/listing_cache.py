@@ -0,0 +1,114 @@
+# Caching of the per-user file listings and of the dashboard fragments
+# rendered from them, in the settings.LISTING_CACHE cache.
+#
+# Every key includes the user's listing version. Anything that changes what a
+# user sees (an upload, a delete, a share or unshare, directly or through a
+# group) gives the affected users a new version once the transaction commits
+# (see signals.py and access.py), so their old entries are never read again
+# and simply expire. Nothing is ever served stale, and nobody else's cache is
+# touched.
+#
+# A version records when it was made. Right after a change the listing is
+# read from the primary database rather than a replica (see routers.py) that
+# may still lack the change, which would otherwise be cached as the new state.
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import UploadedFile
+from .pagination import PAGE_SIZE, keyset_page
+from .routers import replica_reads
+
+# hits and misses per layer ('data', 'fragment') in this process
+stats = Counter()
+
+_missing = object()
+
+
+def listing_cache():
+    return caches[settings.LISTING_CACHE]
+
+
+def version_key(user_id):
+    return f'listing-version:{user_id}'
+
+
+def new_version():
+    return f'{int(time.time())}-{uuid.uuid4().hex}'
+
+
+# whether a version was made long enough ago for the replicas to have caught
+# up; versions from before they carried their time count as old
+def settled(version):
+    made, _, _ = str(version).partition('-')
+    return not made.isdigit() or time.time() - int(made) > settings.REPLICA_PIN_SECONDS
+
+
+# the current listing version of a user
+def listing_version(user_id):
+    cache = listing_cache()
+    version = cache.get(version_key(user_id))
+    if version is None:
+        cache.add(version_key(user_id), new_version(), None)
+        version = cache.get(version_key(user_id))
+    return version
+
+
+# Gives the users new listing versions when the current transaction commits;
+# bumping earlier would let a request cache the not yet committed state.
+def invalidate(user_ids):
+    user_ids = set(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: listing_cache().set_many(
+            {version_key(user_id): new_version() for user_id in user_ids}, None
+        ))
+
+
+# Returns the cached value for (user, layer, parts), computing and storing it
+# on a miss.
+def cached(user_id, version, layer, parts, compute):
+    cache = listing_cache()
+    key = ':'.join(['listing', str(user_id), str(version), layer, *map(str, parts)])
+
+    value = cache.get(key, _missing)
+    if value is _missing:
+        stats[f'{layer}_misses'] += 1
+        value = compute()
+        cache.set(key, value, settings.LISTING_CACHE_TIMEOUT)
+    else:
+        stats[f'{layer}_hits'] += 1
+    return value
+
+
+# One keyset page of user's owned or shared files, as pagination.keyset_page
+# returns it: (files, next cursor). Served from the cache while the user's
+# listing version stays the same.
+def listing_page(user, kind, before=None, limit=PAGE_SIZE, version=None):
+    version = version or listing_version(user.id)
+
+    def page():
+        if kind == 'owned':
+            queryset = UploadedFile.objects.owned_by(user).only('id', 'name', 'file_url', 'file_hash', 'user_id')
+        else:
+            queryset = UploadedFile.objects.shared_with_user(user).only('id', 'name', 'file_url', 'file_hash', 'user__username')
+        with replica_reads(enabled=settled(version)):
+            return keyset_page(queryset, before, limit)
+
+    return cached(user.id, version, 'data', (kind, before, limit), page)
+
+
+# hit rate per layer since the process started
+def hit_rates():
+    rates = {}
+    for layer in ('data', 'fragment'):
+        hits, misses = stats[f'{layer}_hits'], stats[f'{layer}_misses']
+        rates[layer] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else None,
+        }
+    return rates
@@ -0,0 +1,22 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mainapp.uploads import collect_abandoned_sessions
+
+
+# deletes resumable upload sessions (and their chunks) nobody touched for a while;
+# run it periodically, e.g. hourly from cron
+class Command(BaseCommand):
+    help = 'Deletes abandoned resumable upload sessions and their stored chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=int, default=settings.UPLOAD_SESSION_TTL,
+            help='seconds without a new chunk after which a session is abandoned',
+        )
+
+    def handle(self, *args, **options):
+        count = collect_abandoned_sessions(timedelta(seconds=options['max_age']))
+        self.stdout.write(f'Deleted {count} abandoned upload sessions.')
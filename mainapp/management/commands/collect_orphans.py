@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mainapp.orphans import collect_orphans
+
+
+# removes stored files no upload references any more; run it periodically,
+# e.g. daily from cron
+class Command(BaseCommand):
+    help = 'Deletes files in MEDIA_ROOT that no uploaded file or blob references.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age', type=int, default=settings.ORPHAN_MIN_AGE,
+            help='seconds since the last change before an unreferenced file is removed',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='only count the orphans')
+
+    def handle(self, *args, **options):
+        report = collect_orphans(options['min_age'], options['dry_run'])
+        action = 'Found' if options['dry_run'] else f'Removed {report.removed} of'
+        self.stdout.write(
+            f'Scanned {report.scanned} files. {action} {report.orphans} orphans ({report.bytes} bytes).'
+        )
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mainapp import access
+from mainapp.models import FileAccess
+
+
+# recomputes the effective access index from the user and group shares; only
+# needed after changes that bypassed the signals, such as raw SQL imports
+class Command(BaseCommand):
+    help = 'Rebuilds the effective file access index from user and group shares.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            access.rebuild()
+        self.stdout.write(f'Indexed {FileAccess.objects.count()} file access entries.')
@@ -0,0 +1,50 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from mainapp import tasks
+
+
+# background worker for the database task queue; start as many as needed, on
+# any number of machines, e.g. one per host under systemd
+class Command(BaseCommand):
+    help = 'Runs queued background tasks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue', action='append', help='only run tasks of this queue (repeatable)')
+        parser.add_argument('--threads', type=int, default=1, help='tasks run at once by this worker')
+        parser.add_argument('--burst', action='store_true', help='exit once no task is due')
+        parser.add_argument('--poll', type=float, default=settings.TASK_POLL_INTERVAL, help='seconds between looks for new tasks')
+
+    def handle(self, *args, **options):
+        counts = [0] * options['threads']
+
+        def work(number):
+            while True:
+                ran = tasks.run_pending(options['queue'])
+                counts[number] += ran
+                if not ran:
+                    if options['burst']:
+                        return
+                    time.sleep(options['poll'])
+                    # drops connections that broke or expired while idle
+                    close_old_connections()
+
+        def work_in_thread(number):
+            try:
+                work(number)
+            finally:
+                connection.close()
+
+        if options['threads'] == 1:
+            work(0)
+        else:
+            threads = [threading.Thread(target=work_in_thread, args=(number,)) for number in range(options['threads'])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.stdout.write(f'Ran {sum(counts)} tasks.')
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mainapp.scrub import scrub
+
+
+# re-verifies stored files against their recorded SHA-256; run it from cron
+# with --max-seconds to scrub a slice at a time, or with --loop as a
+# long-running background worker
+class Command(BaseCommand):
+    help = 'Re-hashes stored files and reports the ones that are corrupted or missing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='hashing processes (default: one per core)')
+        parser.add_argument('--rate', type=int, help='read limit in bytes per second, 0 for none (default: SCRUB_RATE_LIMIT)')
+        parser.add_argument('--max-seconds', type=float, help='stop after this long; the next run resumes')
+        parser.add_argument('--checkpoint', help='checkpoint file (default: SCRUB_CHECKPOINT)')
+        parser.add_argument('--loop', action='store_true', help='keep scrubbing, one pass after the other')
+        parser.add_argument('--interval', type=int, default=24 * 60 * 60, help='seconds to wait between passes with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            report = scrub(options['checkpoint'], options['workers'], options['rate'], options['max_seconds'])
+
+            for kind, pk, name in report.corrupted:
+                self.stderr.write(f'CORRUPTED {kind} {pk}: {name}')
+                for index, start, end in report.damaged_ranges.get(pk, []) if kind == 'blob' else []:
+                    self.stderr.write(f'  block {index}: bytes {start}-{end - 1}')
+            for kind, pk, name in report.missing:
+                self.stderr.write(f'MISSING {kind} {pk}: {name}')
+            self.stdout.write(
+                f'Checked {report.checked} files, {report.bytes / 1e9:.2f} GB in {report.seconds:.1f}s '
+                f'({report.gb_per_min:.2f} GB/min): {len(report.corrupted)} corrupted, {len(report.missing)} missing'
+                + ('' if report.complete else ', pass not finished')
+            )
+
+            if not options['loop']:
+                break
+            if report.complete:
+                time.sleep(options['interval'])
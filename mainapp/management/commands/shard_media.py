@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from mainapp.layout import shard_media
+
+
+# one-off migration to the sharded blobs/ab/cd/<hash> layout; safe to repeat
+# after an interruption. Downloads of a file may fail with 404 during the
+# instant it is renamed, so run it when traffic is low.
+class Command(BaseCommand):
+    help = 'Moves stored blobs and files uploaded before the blob store into the sharded blob layout.'
+
+    def handle(self, *args, **options):
+        report = shard_media()
+        for uploaded_file_id, name in report.missing:
+            self.stderr.write(f'MISSING file {uploaded_file_id}: {name}')
+        for uploaded_file_id, name in report.mismatched:
+            self.stderr.write(f'CORRUPTED file {uploaded_file_id}: {name}')
+        self.stdout.write(f'Moved {report.blobs_moved} blobs and adopted {report.files_adopted} files.')
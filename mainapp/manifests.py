@@ -0,0 +1,74 @@
+# Block manifests: the SHA-256 of every fixed-size block of a blob, stored as
+# BlobBlock rows next to the whole-content file_hash.
+#
+# They let the integrity checks re-hash and report single damaged blocks
+# instead of only "the file is corrupted", and let a client re-uploading an
+# edited file send only the blocks the server does not have yet (see
+# uploads.reuse_chunks). Blocks are fixed-size rather than content-defined so
+# they line up with the chunks of resumable upload sessions; edits in place
+# keep all other blocks, insertions shift the blocks after them.
+import hashlib
+from itertools import islice
+
+from django.core.files.storage import storages
+from django.db.models import Exists, OuterRef
+
+from .compression import DECODE_ERRORS, open_decoded
+from .models import BlobBlock, UploadedFile
+
+# manifest rows written per INSERT
+MANIFEST_BATCH_SIZE = 1000
+
+
+# Records the manifest of a blob; returns its block size.
+def write_manifest(blob, manifest, block_size):
+    rows = (BlobBlock(blob=blob, index=index, digest=digest) for index, digest in enumerate(manifest))
+    while batch := list(islice(rows, MANIFEST_BATCH_SIZE)):
+        BlobBlock.objects.bulk_create(batch, ignore_conflicts=True)
+    return block_size
+
+
+# hex digests of a blob's blocks, in order
+def block_manifest(blob):
+    return [bytes(digest).hex() for digest in blob.blocks.order_by('index').values_list('digest', flat=True)]
+
+
+# Re-hashes the blocks of a blob, or only the given block indices, and returns
+# the damaged ones as (index, start, end) byte ranges, end exclusive.
+# Only the requested blocks are read.
+def damaged_blocks(blob, indices=None):
+    blocks = blob.blocks.order_by('index')
+    if indices is not None:
+        blocks = blocks.filter(index__in=indices)
+
+    damaged = []
+    readable = True
+    # blocks come in order, so a compressed blob only ever seeks forward
+    with open_decoded(storages['uploads'].path(blob.name), blob.encoding) as stored:
+        for index, digest in blocks.values_list('index', 'digest').iterator():
+            start = index * blob.block_size
+            if readable:
+                try:
+                    stored.seek(start)
+                    readable = hashlib.sha256(stored.read(blob.block_size)).digest() == bytes(digest)
+                except DECODE_ERRORS:
+                    readable = False
+                if readable:
+                    continue
+                # the rest of a compressed blob cannot be told apart from here
+                readable = not blob.encoding
+            damaged.append((index, start, start + blob.block_size))
+    return damaged
+
+
+# Finds stored blocks with the given digests among the blobs user can
+# download; returns {digest: (blob name, blob encoding, offset)}. Blobs of
+# files the user cannot access are never used, so knowing a digest reveals
+# nothing.
+def find_blocks(user, digests, block_size):
+    accessible = UploadedFile.objects.accessible_by(user).filter(blob=OuterRef('blob'))
+    rows = (
+        BlobBlock.objects.filter(digest__in=set(digests), blob__block_size=block_size)
+        .filter(Exists(accessible)).values_list('digest', 'blob__name', 'blob__encoding', 'index')
+    )
+    return {bytes(digest): (name, encoding, index * block_size) for digest, name, encoding, index in rows}
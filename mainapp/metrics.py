@@ -0,0 +1,254 @@
+# Request, query and I/O instrumentation, exposed in the Prometheus text
+# format on /metrics.
+#
+# MetricsMiddleware times every request and labels it with the name of the
+# view's URL pattern. Database queries are timed by an execute wrapper on
+# every connection (installed in MainappConfig.ready()) and charged to the
+# request running them, also across sync_to_async; queries outside requests
+# (tasks, commands) are counted under view="". Storage, hashing and the
+# upload and download paths add to the byte and time counters below.
+#
+# Values are kept per process, like listing_cache.stats: with several worker
+# processes every one of them has to be scraped (or run a single process per
+# container). Recording is a dict update under a lock, cheap enough to leave
+# on in production.
+#
+# With METRICS_PROFILE_RATE a sample of the requests is run under cProfile,
+# and the profiles of those that took longer than METRICS_PROFILE_SLOW are
+# written to METRICS_PROFILE_DIR for `python -m pstats`.
+import cProfile
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+# methods with a label of their own; clients can send any verb, so the others
+# share "other"
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# every metric of the process, in the order they are exposed
+registry = []
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+# A value per combination of labels that only goes up.
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield self.name, format_labels(self.labels, labels), value
+
+
+# Counts observations per bucket of values, with their sum.
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (the last for +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', format_labels(self.labels, labels, [('le', bound)]), cumulative
+            yield f'{self.name}_sum', format_labels(self.labels, labels), total
+            yield f'{self.name}_count', format_labels(self.labels, labels), cumulative
+
+
+requests_total = Counter('sharefile_http_requests_total', 'Requests answered.', ['view', 'method', 'status'])
+request_seconds = Histogram('sharefile_http_request_duration_seconds', 'Time to answer a request.', ['view'])
+queries_total = Counter('sharefile_db_queries_total', 'Database queries run.', ['view'])
+query_seconds = Counter('sharefile_db_query_seconds_total', 'Time spent in database queries.', ['view'])
+uploaded_bytes = Counter('sharefile_uploaded_bytes_total', 'Bytes of files stored by uploads.')
+chunk_bytes = Counter('sharefile_upload_chunk_bytes_total', 'Bytes received in resumable upload chunks.')
+download_bytes = Counter(
+    'sharefile_download_bytes_total', 'Bytes of download responses, by how they are sent.', ['mode'],
+)
+hash_bytes = Counter('sharefile_hash_bytes_total', 'Bytes hashed, by hash.', ['algorithm'])
+hash_seconds = Counter('sharefile_hash_seconds_total', 'Time spent hashing, by hash.', ['algorithm'])
+write_bytes = Counter('sharefile_storage_write_bytes_total', 'Bytes written to stored files.')
+write_seconds = Counter('sharefile_storage_write_seconds_total', 'Time spent writing stored files.')
+profiles_total = Counter('sharefile_slow_request_profiles_total', 'Profiles of slow requests written.')
+
+
+# queries and query time of the request being answered: [count, seconds]
+_current = ContextVar('metrics_request', default=None)
+
+
+# Execute wrapper timing every query of a connection.
+def observe_query(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        current = _current.get()
+        if current is None:
+            queries_total.inc(1, '')
+            query_seconds.inc(elapsed, '')
+        else:
+            current[0] += 1
+            current[1] += elapsed
+
+
+# connected to connection_created; a connection that reconnects keeps its
+# wrapper
+def instrument_connection(sender, connection, **kwargs):
+    if observe_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(observe_query)
+
+
+# Writes data to the open file, counting the bytes and the time taken.
+def timed_write(file, data):
+    start = time.perf_counter()
+    file.write(data)
+    write_seconds.inc(time.perf_counter() - start)
+    write_bytes.inc(len(data))
+
+
+# All metrics in the Prometheus text exposition format.
+def render():
+    from .listing_cache import stats
+
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(f'{name}{labels} {value}' for name, labels, value in metric.samples())
+
+    lines.append('# HELP sharefile_listing_cache_requests_total Listing cache lookups, by layer and result.')
+    lines.append('# TYPE sharefile_listing_cache_requests_total counter')
+    for layer in ('data', 'fragment'):
+        for result in ('hits', 'misses'):
+            lines.append(
+                f'sharefile_listing_cache_requests_total{{layer="{layer}",result="{result}"}} {stats[f"{layer}_{result}"]}'
+            )
+    return '\n'.join(lines) + '\n'
+
+
+# one request profiled at a time; cProfile does not nest
+_profiling = threading.Lock()
+
+
+# Writes the profile of a slow request, unless METRICS_PROFILE_MAX_FILES are
+# there already.
+def save_profile(profiler, view, elapsed):
+    directory = settings.METRICS_PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    if len(os.listdir(directory)) >= settings.METRICS_PROFILE_MAX_FILES:
+        return
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{view.replace(':', '-') or 'unmatched'}-{int(elapsed * 1000)}ms.prof"
+    profiler.dump_stats(os.path.join(directory, name))
+    profiles_total.inc()
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else ''
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.asynchronous = iscoroutinefunction(get_response)
+        if self.asynchronous:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.asynchronous:
+            return self.__acall__(request)
+
+        current = [0, 0.0]
+        token = _current.set(current)
+        profiler = None
+        # the event loop would mix other requests into an async profile
+        if settings.METRICS_PROFILE_RATE and random.random() < settings.METRICS_PROFILE_RATE:
+            if _profiling.acquire(blocking=False):
+                profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            response = self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                _profiling.release()
+            _current.reset(token)
+
+        view = view_name(request)
+        self.record(request, response, view, elapsed, current)
+        if profiler is not None and elapsed >= settings.METRICS_PROFILE_SLOW:
+            save_profile(profiler, view, elapsed)
+        return response
+
+    async def __acall__(self, request):
+        current = [0, 0.0]
+        token = _current.set(current)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - start
+            _current.reset(token)
+        self.record(request, response, view_name(request), elapsed, current)
+        return response
+
+    def record(self, request, response, view, elapsed, current):
+        method = request.method if request.method in METHODS else 'other'
+        requests_total.inc(1, view, method, response.status_code)
+        request_seconds.observe(elapsed, view)
+        queries_total.inc(current[0], view)
+        query_seconds.inc(current[1], view)
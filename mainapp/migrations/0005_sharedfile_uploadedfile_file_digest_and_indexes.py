@@ -0,0 +1,107 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# fills file_digest for existing rows from their hex file_hash
+def populate_file_digest(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        # a single set-based update is far faster on big tables
+        schema_editor.execute(
+            "UPDATE mainapp_uploadedfile SET file_digest = decode(file_hash, 'hex') "
+            "WHERE file_hash ~ '^[0-9a-f]{64}$'"
+        )
+        return
+
+    UploadedFile = apps.get_model('mainapp', 'UploadedFile')
+    table = schema_editor.quote_name(UploadedFile._meta.db_table)
+    last_id = 0
+    while True:
+        # walk the table in id order, one batch at a time
+        batch = list(
+            UploadedFile.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'file_hash')[:10000]
+        )
+        if not batch:
+            break
+        updates = []
+        for row_id, file_hash in batch:
+            try:
+                digest = bytes.fromhex(file_hash)
+            except ValueError:
+                continue
+            if len(digest) == 32:
+                updates.append((digest, row_id))
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(f'UPDATE {table} SET file_digest = %s WHERE id = %s', updates)
+        last_id = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mainapp', '0004_blob_uploadedfile_name_uploadedfile_blob'),
+    ]
+
+    operations = [
+        # adopt the table Django created for shared_with as an explicit model;
+        # the database already matches, so only the migration state changes
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='SharedFile',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('uploadedfile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='mainapp.uploadedfile')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'mainapp_uploadedfile_shared_with',
+                        'unique_together': {('uploadedfile', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='uploadedfile',
+                    name='shared_with',
+                    field=models.ManyToManyField(blank=True, related_name='shared_files', through='mainapp.SharedFile', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        # the single column indexes are covered by the composite ones
+        migrations.AlterField(
+            model_name='sharedfile',
+            name='uploadedfile',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='mainapp.uploadedfile'),
+        ),
+        migrations.AlterField(
+            model_name='sharedfile',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='sharedfile',
+            index=models.Index(fields=['user', 'uploadedfile'], name='mainapp_shared_user_file_idx'),
+        ),
+        migrations.AlterField(
+            model_name='uploadedfile',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['user', 'id'], name='mainapp_upl_user_id_idx'),
+        ),
+        # compact hash column, filled before its index is built
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='file_digest',
+            field=models.BinaryField(max_length=32, null=True),
+        ),
+        migrations.RunPython(populate_file_digest, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='uploadedfile',
+            index=models.Index(fields=['file_digest'], name='mainapp_upl_digest_idx'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from itertools import islice
+
+
+# existing direct shares become the first rows of the access index
+def fill_access_index(apps, schema_editor):
+    SharedFile = apps.get_model('mainapp', 'SharedFile')
+    FileAccess = apps.get_model('mainapp', 'FileAccess')
+
+    rows = (
+        FileAccess(uploadedfile_id=file_id, user_id=user_id)
+        for file_id, user_id in SharedFile.objects.values_list('uploadedfile_id', 'user_id').iterator()
+    )
+    while batch := list(islice(rows, 1000)):
+        FileAccess.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('mainapp', '0006_uploadsession_uploadchunk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupShare',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='auth.group')),
+                ('uploadedfile', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='mainapp.uploadedfile')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FileAccess',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uploadedfile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='access', to='mainapp.uploadedfile')),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='shared_with_groups',
+            field=models.ManyToManyField(blank=True, related_name='shared_files', through='mainapp.GroupShare', to='auth.group'),
+        ),
+        migrations.AddIndex(
+            model_name='groupshare',
+            index=models.Index(fields=['group', 'uploadedfile'], name='mainapp_gshare_group_file_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='groupshare',
+            unique_together={('uploadedfile', 'group')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='fileaccess',
+            unique_together={('user', 'uploadedfile')},
+        ),
+        migrations.RunPython(fill_access_index, migrations.RunPython.noop),
+    ]
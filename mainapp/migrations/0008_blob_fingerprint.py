@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0007_groupshare_fileaccess'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=128),
+        ),
+        migrations.AddField(
+            model_name='blob',
+            name='fingerprint_algorithm',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mainapp', '0008_blob_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='block_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='BlobBlock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('digest', models.BinaryField(db_index=True, max_length=32)),
+                ('blob', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='blocks', to='mainapp.blob')),
+            ],
+            options={
+                'unique_together': {('blob', 'index')},
+            },
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import os
+from urllib.parse import unquote, urlsplit
+
+
+# Sizes of the files stored so far, read from disk once, and the usage
+# counters summed from them; from here on both are kept up to date.
+def fill_sizes_and_usage(apps, schema_editor):
+    UploadedFile = apps.get_model('mainapp', 'UploadedFile')
+    UserUsage = apps.get_model('mainapp', 'UserUsage')
+
+    def stored_path(uploaded_file):
+        if uploaded_file.blob_id:
+            return os.path.join(settings.MEDIA_ROOT, uploaded_file.blob.name)
+        path = unquote(urlsplit(uploaded_file.file_url).path)
+        if path.startswith(settings.MEDIA_URL):
+            return os.path.join(settings.MEDIA_ROOT, path[len(settings.MEDIA_URL):])
+        return None
+
+    changed = []
+    for uploaded_file in UploadedFile.objects.select_related('blob').only('id', 'file_url', 'blob__name').iterator():
+        path = stored_path(uploaded_file)
+        if path and os.path.isfile(path):
+            uploaded_file.size = os.path.getsize(path)
+            changed.append(uploaded_file)
+    UploadedFile.objects.bulk_update(changed, ['size'], batch_size=1000)
+
+    totals = UploadedFile.objects.values('user_id').annotate(bytes_used=models.Sum('size'), file_count=models.Count('id'))
+    UserUsage.objects.bulk_create(
+        [UserUsage(user_id=row['user_id'], bytes_used=row['bytes_used'], file_count=row['file_count']) for row in totals],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('mainapp', '0009_blob_manifest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='usage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('bytes_used', models.PositiveBigIntegerField(default=0)),
+                ('file_count', models.PositiveIntegerField(default=0)),
+                ('quota', models.PositiveBigIntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='uploadedfile',
+            name='size',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_sizes_and_usage, migrations.RunPython.noop),
+    ]
@@ -1,21 +1,273 @@
+import uuid
+
 from django.db import models
-from django.contrib.auth.models import User
-import hashlib
+from django.contrib.auth.models import User, Group
+from django.utils import timezone
 
 # Create your models here.
 
+# one physical file per distinct content, stored under its SHA-256 hash
+class Blob(models.Model):
+    file_hash = models.CharField(max_length=64, unique=True)
+
+    # storage name of the blob, relative to MEDIA_ROOT
+    name = models.CharField(max_length=255)
+
+    # number of UploadedFile rows pointing at this blob
+    ref_count = models.PositiveIntegerField(default=0)
+
+    # fast content fingerprint and the algorithm that made it (mainapp.hashing)
+    fingerprint = models.CharField(max_length=128, blank=True)
+    fingerprint_algorithm = models.CharField(max_length=32, blank=True)
+
+    # block size of the manifest in BlobBlock; null until one was recorded
+    block_size = models.PositiveIntegerField(null=True, blank=True)
+
+    # how the file is compressed at rest ('gzip', 'zstd'); empty for raw bytes
+    encoding = models.CharField(max_length=10, blank=True)
+
+    def __str__(self):
+        return f"blob {self.file_hash} ({self.ref_count} refs)"
+
+
+# One entry of a blob's block manifest: the SHA-256 of the block_size bytes
+# starting at index * block_size. The digest index finds stored blocks by
+# content, for delta re-uploads.
+class BlobBlock(models.Model):
+    blob = models.ForeignKey(Blob, on_delete=models.CASCADE, related_name='blocks', db_index=False)
+    index = models.PositiveIntegerField()
+    digest = models.BinaryField(max_length=32, db_index=True)
+
+    class Meta:
+        unique_together = [('blob', 'index')]
+
+
+# converts a hex SHA-256 into the 32 byte value stored in file_digest
+def digest_from_hex(file_hash):
+    try:
+        digest = bytes.fromhex(file_hash)
+    except (TypeError, ValueError):
+        return None
+    return digest if len(digest) == 32 else None
+
+
+class UploadedFileQuerySet(models.QuerySet):
+
+    # looks files up by hash through the compact, indexed binary column
+    def with_hash(self, file_hash):
+        return self.filter(file_digest=digest_from_hex(file_hash))
+
+    # files uploaded by user, newest first
+    def owned_by(self, user):
+        return self.filter(user=user).order_by('-id')
+
+    # files user may download: their own and those shared with them directly
+    # or through a group; one probe of the FileAccess unique index
+    def accessible_by(self, user):
+        shared = FileAccess.objects.filter(uploadedfile=models.OuterRef('pk'), user=user)
+        return self.filter(models.Q(user=user) | models.Exists(shared))
+
+    # files other users shared with user, directly or through a group, newest
+    # first, with their owners; one range scan of the FileAccess index
+    def shared_with_user(self, user):
+        return (
+            self.filter(access__user=user).exclude(user=user)
+            .select_related('user').order_by('-id')
+        )
+
+
 class UploadedFile(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # indexed together with id below, which also serves plain user lookups
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     file_url = models.URLField()
 
+    # original name of the file as uploaded by the user
+    name = models.CharField(max_length=255, blank=True)
+
+    # deduplicated content; empty for files uploaded before the blob store
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.PROTECT)
+
     # field to store the SHA-256 hash of the file
     file_hash = models.CharField(max_length=64, default='')
 
+    # the same hash as 32 raw bytes; half the size of file_hash in rows and indexes
+    file_digest = models.BinaryField(max_length=32, null=True, editable=False)
+
+    # size of the content in bytes, recorded at upload
+    size = models.PositiveBigIntegerField(default=0)
+
+    # progress of the work queued after the upload (see processing.py)
+    PENDING, PROCESSING, PROCESSED, FAILED = 'pending', 'processing', 'processed', 'failed'
+    PROCESSING_CHOICES = [
+        (PENDING, 'Pending'), (PROCESSING, 'Processing'), (PROCESSED, 'Processed'), (FAILED, 'Failed'),
+    ]
+    processing_status = models.CharField(max_length=10, choices=PROCESSING_CHOICES, default=PENDING)
+
     # new field to store shared users on Posgre
-    shared_with = models.ManyToManyField(User, related_name = 'shared_files', blank = True)
+    shared_with = models.ManyToManyField(User, related_name = 'shared_files', blank = True, through='SharedFile')
+
+    # groups (teams) whose members can access the file
+    shared_with_groups = models.ManyToManyField(Group, related_name='shared_files', blank=True, through='GroupShare')
+
+    objects = UploadedFileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # a user's files in upload order
+            models.Index(fields=['user', 'id'], name='mainapp_upl_user_id_idx'),
+            # hash lookups
+            models.Index(fields=['file_digest'], name='mainapp_upl_digest_idx'),
+        ]
+
+    # keeps the binary digest in step with file_hash
+    def save(self, *args, **kwargs):
+        self.file_digest = digest_from_hex(self.file_hash)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'file_hash' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'file_digest'}
+        super().save(*args, **kwargs)
 
     # for debugging
     def __str__(self):
         return f"{self.user.username}'s file"
-    
 
+
+# through table of UploadedFile.shared_with; the table Django created for the
+# plain many-to-many field, declared here so it can carry its own indexes
+class SharedFile(models.Model):
+    uploadedfile = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, db_index=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+
+    class Meta:
+        db_table = 'mainapp_uploadedfile_shared_with'
+        # the unique index also answers "who is this file shared with"
+        unique_together = [('uploadedfile', 'user')]
+        indexes = [
+            # "which files are shared with this user", answered from the index alone
+            models.Index(fields=['user', 'uploadedfile'], name='mainapp_shared_user_file_idx'),
+        ]
+
+
+
+# through table of UploadedFile.shared_with_groups
+class GroupShare(models.Model):
+    uploadedfile = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, db_index=False)
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, db_index=False)
+
+    class Meta:
+        unique_together = [('uploadedfile', 'group')]
+        indexes = [
+            # "which files are shared with this group"
+            models.Index(fields=['group', 'uploadedfile'], name='mainapp_gshare_group_file_idx'),
+        ]
+
+
+# Effective access index: one row per (user, file) the user may open because
+# the file was shared with them directly or with one of their groups.
+# It is kept up to date incrementally by mainapp.access (see signals.py), so
+# both the shared-files listing and the download check are a single lookup on
+# its (user, uploadedfile) unique index, however many groups the user is in.
+class FileAccess(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
+    uploadedfile = models.ForeignKey(UploadedFile, on_delete=models.CASCADE, related_name='access')
+
+    class Meta:
+        unique_together = [('user', 'uploadedfile')]
+
+
+# Storage used by a user, kept up to date on every upload and delete (see
+# quotas.py) so it is never computed by scanning files or rows.
+class UserUsage(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='usage')
+    bytes_used = models.PositiveBigIntegerField(default=0)
+    file_count = models.PositiveIntegerField(default=0)
+
+    # bytes the user may store; null for settings.STORAGE_QUOTA
+    quota = models.PositiveBigIntegerField(null=True, blank=True)
+
+
+# a resumable upload in progress; chunks arrive as separate requests
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    # name and total size of the file being uploaded
+    name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+
+    # every chunk has this size except the last one
+    chunk_size = models.PositiveIntegerField()
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    # last time a chunk arrived; idle sessions are garbage collected
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    # set while a request assembles the file (see uploads.finish_session)
+    finishing = models.BooleanField(default=False)
+
+    @property
+    def total_chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    # expected size of chunk number index
+    def chunk_length(self, index):
+        if index == self.total_chunks - 1:
+            return self.size - index * self.chunk_size
+        return self.chunk_size
+
+
+# a chunk of an UploadSession that has been received and stored
+class UploadChunk(models.Model):
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = [('session', 'index')]
+
+
+# A job for the background workers (see tasks.py and the run_tasks command).
+# Finished jobs are deleted; failed ones stay for inspection.
+class Task(models.Model):
+    QUEUED, RUNNING, FAILED = 'queued', 'running', 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (FAILED, 'Failed')]
+
+    # registered name of the task function and its JSON arguments
+    name = models.CharField(max_length=100)
+    args = models.JSONField(default=list)
+
+    # tasks of a queue share its concurrency limit (settings.TASK_QUEUES)
+    queue = models.CharField(max_length=50, default='default')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+
+    # not run before this time; pushed back after a failed attempt
+    run_after = models.DateTimeField(default=timezone.now)
+
+    # a running task holds one of its queue's slots until the lease runs
+    # out; a worker that died loses its tasks to the others then
+    slot = models.PositiveSmallIntegerField(null=True, blank=True)
+    lease_until = models.DateTimeField(null=True, blank=True)
+
+    # traceback of the last failed attempt
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # the next due tasks
+            models.Index(fields=['status', 'run_after'], name='mainapp_task_due_idx'),
+        ]
+        constraints = [
+            # no two running tasks of a queue hold the same slot, so a queue
+            # never runs more tasks at once than it has slots
+            models.UniqueConstraint(
+                fields=['queue', 'slot'], condition=models.Q(status='running'), name='mainapp_task_running_slot',
+            ),
+        ]
+
+    def __str__(self):
+        return f"task {self.name} ({self.status})"
@@ -0,0 +1,118 @@
+# Orphan collection: removes files below MEDIA_ROOT that no Blob or
+# UploadedFile references any more, e.g. the bytes of files deleted before
+# deletes removed them, or incoming files left behind by a crashed upload.
+#
+# MEDIA_ROOT is walked with os.scandir one directory at a time and the names
+# are checked against the database in batches, so memory stays flat however
+# many entries a directory holds. Only files older than a grace period are
+# considered, so uploads whose rows are not committed yet are left alone.
+import os
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.files.storage import storages
+
+from .models import Blob, UploadedFile
+
+# names checked against the database per query
+BATCH_SIZE = 1000
+
+# directories below MEDIA_ROOT that other code manages; chunks of resumable
+# uploads are removed by cleanup_upload_sessions, previews by their cache
+SKIP_DIRS = {'chunks', 'previews'}
+
+
+@dataclass
+class OrphanReport:
+    scanned: int = 0
+    orphans: int = 0
+    bytes: int = 0
+    removed: int = 0
+
+
+# Yields (storage name, path, stat) for every file below root, without ever
+# listing a whole tree or directory at once.
+def walk(root):
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        try:
+            entries = os.scandir(os.path.join(root, relative))
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                name = f'{relative}/{entry.name}' if relative else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if name not in SKIP_DIRS:
+                        pending.append(name)
+                elif entry.is_file(follow_symlinks=False):
+                    try:
+                        yield name, entry.path, entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+
+
+# the names in names that a Blob or an UploadedFile still points at
+def referenced(names):
+    fs = storages['uploads']
+    found = set(Blob.objects.filter(name__in=names).values_list('name', flat=True))
+    urls = {fs.url(name): name for name in names}
+    found.update(urls[url] for url in UploadedFile.objects.filter(file_url__in=urls).values_list('file_url', flat=True))
+    return found
+
+
+# Removes the file at path, stored as name, if it is still the one that was
+# scanned and still unreferenced. It is first renamed aside; if an upload put
+# a new file under the same name in the meantime, the inode differs, and if
+# an upload adopted the file as its blob since the batch was checked, a row
+# references it now. Either way the file is put back.
+def remove(name, path, scanned):
+    aside = f'{path}.orphan'
+    try:
+        os.rename(path, aside)
+    except FileNotFoundError:
+        return False
+    kept = os.stat(aside).st_ino != scanned.st_ino or referenced([name])
+    if kept:
+        try:
+            os.link(aside, path)
+        except FileExistsError:
+            # an even newer file is in place already
+            pass
+    os.remove(aside)
+    return not kept
+
+
+# checks one batch of (name, path, stat) and removes the orphans among them
+def collect_batch(batch, report, dry_run):
+    found = referenced([name for name, path, stat in batch])
+    for name, path, stat in batch:
+        if name in found:
+            continue
+        report.orphans += 1
+        report.bytes += stat.st_size
+        if not dry_run and remove(name, path, stat):
+            report.removed += 1
+
+
+# Walks MEDIA_ROOT and removes unreferenced files last modified more than
+# min_age seconds ago. With dry_run the orphans are only counted.
+def collect_orphans(min_age=None, dry_run=False):
+    min_age = settings.ORPHAN_MIN_AGE if min_age is None else min_age
+    cutoff = time.time() - min_age
+
+    report = OrphanReport()
+    batch = []
+    for name, path, stat in walk(storages['uploads'].location):
+        report.scanned += 1
+        if stat.st_mtime > cutoff:
+            continue
+        batch.append((name, path, stat))
+        if len(batch) >= BATCH_SIZE:
+            collect_batch(batch, report, dry_run)
+            batch = []
+    if batch:
+        collect_batch(batch, report, dry_run)
+    return report
@@ -0,0 +1,57 @@
+# keyset (cursor) pagination for the file listings
+#
+# A page is "the newest files with an id below the cursor". The database walks
+# the (user, id) indexes straight to the cursor, so page 1000 costs the same as
+# page 1, unlike OFFSET which has to skip every earlier row.
+
+# number of files per page on the dashboard and the default for the api
+PAGE_SIZE = 50
+
+# upper bound for the api's limit parameter
+MAX_PAGE_SIZE = 500
+
+# the largest id a BigAutoField holds; larger numbers do not fit a query
+MAX_ID = 2 ** 63 - 1
+
+
+# Reads a cursor (a file id) from query parameters; a missing or non-numeric
+# one means "start from the newest file". Raises ValueError for numbers too
+# large to be an id.
+def parse_cursor(value):
+    try:
+        cursor = int(value)
+    except (TypeError, ValueError):
+        return None
+    if cursor > MAX_ID:
+        raise ValueError(f'cursor must be at most {MAX_ID}')
+    return cursor if cursor > 0 else None
+
+
+# Reads an id sent by a client; raises ValueError (TypeError for values that
+# are not numbers at all) unless it is one an id can be.
+def parse_id(value):
+    number = int(value)
+    if not 0 < number <= MAX_ID:
+        raise ValueError(f'ids must be between 1 and {MAX_ID}')
+    return number
+
+
+# Reads a page size, falling back to PAGE_SIZE and capped at MAX_PAGE_SIZE.
+def parse_limit(value):
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+# Returns one page of a newest-first queryset and the cursor of the next page,
+# which is None on the last page. One extra row is fetched to tell if there is
+# another page without a COUNT query.
+def keyset_page(queryset, before=None, limit=PAGE_SIZE):
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+
+    items = list(queryset.order_by('-id')[:limit + 1])
+    next_cursor = items[limit - 1].id if len(items) > limit else None
+    return items[:limit], next_cursor
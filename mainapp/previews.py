@@ -0,0 +1,238 @@
+# Previews of uploaded files for the dashboard: a thumbnail of images and of
+# the first page of PDFs, the first lines of text files.
+#
+# Previews are keyed by file_hash, so every upload of the same content shares
+# one, and kept in a disk cache (settings.PREVIEW_CACHE_DIR) bounded to
+# PREVIEW_CACHE_SIZE bytes: previews read are touched, and when the cache
+# grows past its size the least recently used ones are removed. A file of the
+# cache is the preview itself: a JPEG thumbnail, UTF-8 text, or empty when
+# the content has no preview, so it is not looked at again.
+#
+# The upload worker makes previews after every upload (a step of
+# UPLOAD_PROCESSORS); the preview view makes missing ones of small files
+# while the client waits.
+#
+# Thumbnails need the Pillow package, PDF pages also the pypdfium2 package;
+# without them only text files get previews.
+import io
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import storages
+
+from .compression import open_decoded
+from .storage import stored_name
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import pypdfium2
+except ImportError:
+    pypdfium2 = None
+
+logger = logging.getLogger(__name__)
+
+# formats Pillow thumbnails
+IMAGE_SIGNATURES = (
+    b'\x89PNG',                 # png
+    b'\xff\xd8\xff',            # jpeg
+    b'GIF8',                    # gif
+    b'BM',                      # bmp
+)
+
+# bytes looked at to tell the kind of content, and the most read for a text
+# preview
+HEAD_SIZE = 8 * 1024
+
+# images with more pixels are not decoded at all
+MAX_IMAGE_PIXELS = 50_000_000
+if Image is not None:
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# what an entry is counted as at least; empty ones still take an inode
+MIN_ENTRY_SIZE = 512
+
+# a preview read this long after its last touch is touched again; LRU order
+# does not need to be finer than that
+TOUCH_INTERVAL = 60
+
+JPEG_QUALITY = 80
+
+# bytes this process believes the cache holds; the directory is only listed
+# again when that passes the size
+_estimated = None
+_lock = threading.Lock()
+
+
+def cache_dir():
+    return settings.PREVIEW_CACHE_DIR or os.path.join(settings.MEDIA_ROOT, 'previews')
+
+
+def preview_path(file_hash):
+    return os.path.join(cache_dir(), file_hash[:2], file_hash)
+
+
+# 'image', 'pdf', 'text' or None, from the first bytes of some content
+def preview_kind(head):
+    if head.startswith(IMAGE_SIGNATURES) or (head[:4] == b'RIFF' and head[8:12] == b'WEBP'):
+        return 'image'
+    if head.startswith(b'%PDF-'):
+        return 'pdf'
+    if b'\x00' in head:
+        return None
+    # a character may be cut off at the end of the head
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as error:
+        if error.start < len(head) - 3:
+            return None
+    return 'text'
+
+
+def thumbnail(image):
+    image.thumbnail((settings.PREVIEW_SIZE, settings.PREVIEW_SIZE))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    return image
+
+
+def jpeg_bytes(image):
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=JPEG_QUALITY)
+    return out.getvalue()
+
+
+# The preview of the stored file at path: JPEG or UTF-8 bytes, b'' for none.
+def render_preview(path, encoding):
+    with open_decoded(path, encoding) as source:
+        head = source.read(HEAD_SIZE)
+        kind = preview_kind(head)
+
+        if kind == 'text':
+            lines = head.decode('utf-8', errors='ignore').splitlines()[:settings.PREVIEW_TEXT_LINES]
+            return '\n'.join(lines).encode()
+
+    if kind == 'image' and Image is not None:
+        # decoding can seek, which compressed blobs only do slowly
+        with open_decoded(path, encoding) as source:
+            with Image.open(source) as image:
+                # JPEGs decode at a fraction of their size right away
+                image.draft('RGB', (settings.PREVIEW_SIZE, settings.PREVIEW_SIZE))
+                return jpeg_bytes(thumbnail(image))
+
+    if kind == 'pdf' and Image is not None and pypdfium2 is not None and not encoding:
+        document = pypdfium2.PdfDocument(path)
+        try:
+            page = document[0]
+            scale = settings.PREVIEW_SIZE / max(page.get_size())
+            return jpeg_bytes(thumbnail(page.render(scale=scale).to_pil()))
+        finally:
+            document.close()
+    return b''
+
+
+# Adds size bytes to what the cache holds and removes the least recently
+# used previews once it holds more than PREVIEW_CACHE_SIZE.
+def account(size):
+    global _estimated
+    with _lock:
+        if _estimated is not None:
+            _estimated += size
+            if _estimated <= settings.PREVIEW_CACHE_SIZE:
+                return
+        _estimated = evict()
+
+
+# Removes previews, least recently used first, until the cache is 10% below
+# its size; returns the bytes left.
+def evict():
+    entries, total = [], 0
+    root = cache_dir()
+    for shard in os.scandir(root) if os.path.isdir(root) else ():
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            # being written
+            if entry.name.endswith('.part'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            size = max(stat.st_size, MIN_ENTRY_SIZE)
+            entries.append((stat.st_mtime, size, entry.path))
+            total += size
+
+    if total > settings.PREVIEW_CACHE_SIZE:
+        target = settings.PREVIEW_CACHE_SIZE * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+    return total
+
+
+# Stores the preview of uploaded_file in the cache; returns its path.
+def make_preview(uploaded_file):
+    path = preview_path(uploaded_file.file_hash)
+    name = stored_name(uploaded_file)
+    fs = storages['uploads']
+    encoding = uploaded_file.blob.encoding if uploaded_file.blob_id else ''
+    try:
+        content = render_preview(fs.path(name), encoding) if name else b''
+    except FileNotFoundError:
+        # the stored file is lost, which is not the same as no preview
+        raise
+    except Exception:
+        # content a decoder chokes on simply has no preview
+        logger.exception('no preview for file %s', uploaded_file.id)
+        content = b''
+
+    # written under a private name and renamed, so readers never see half
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    part = f'{path}.{uuid.uuid4().hex}.part'
+    with open(part, 'wb') as out:
+        out.write(content)
+    os.replace(part, path)
+    account(max(len(content), MIN_ENTRY_SIZE))
+    return path
+
+
+# Path of the cached preview of uploaded_file, made first when create is
+# True; None when there is none yet. Reading a preview marks it used.
+def cached_preview(uploaded_file, create=False):
+    if not uploaded_file.file_hash:
+        return None
+    path = preview_path(uploaded_file.file_hash)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        if not create:
+            return None
+        return make_preview(uploaded_file)
+
+    if time.time() - stat.st_mtime > TOUCH_INTERVAL:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+    return path
+
+
+# UPLOAD_PROCESSORS step; a file without preview is still processed fine.
+def preview_upload(uploaded_file):
+    try:
+        cached_preview(uploaded_file, create=True)
+    except OSError:
+        logger.exception('could not store the preview of file %s', uploaded_file.id)
@@ -0,0 +1,43 @@
+# Work done on a file after its upload request returned: the upload commits
+# the file together with a process_upload task (see uploads.store_upload) and
+# the task queue runs the steps listed in settings.UPLOAD_PROCESSORS, such as
+# re-checking the stored bytes. UploadedFile.processing_status tracks it.
+from django.conf import settings
+from django.core.files.storage import storages
+from django.utils.module_loading import import_string
+
+from .models import UploadedFile
+from .scrub import hash_path
+from .storage import stored_name
+from .tasks import Abort, task
+
+
+def mark_failed(file_id):
+    UploadedFile.objects.filter(pk=file_id).update(processing_status=UploadedFile.FAILED)
+
+
+@task(queue='uploads', on_failure=mark_failed)
+def process_upload(file_id):
+    uploaded_file = UploadedFile.objects.select_related('blob').filter(pk=file_id).first()
+    if uploaded_file is None:
+        # deleted before it was processed
+        return
+
+    UploadedFile.objects.filter(pk=file_id).update(processing_status=UploadedFile.PROCESSING)
+    for processor in settings.UPLOAD_PROCESSORS:
+        import_string(processor)(uploaded_file)
+    UploadedFile.objects.filter(pk=file_id).update(processing_status=UploadedFile.PROCESSED)
+
+
+# Reads the stored bytes back and compares them with the hash and size
+# recorded while they were received.
+def verify_integrity(uploaded_file):
+    name = stored_name(uploaded_file)
+    if name is None:
+        return
+    encoding = uploaded_file.blob.encoding if uploaded_file.blob_id else ''
+    result = hash_path(storages['uploads'].path(name), encoding=encoding)
+    if result is None:
+        raise Abort(f'{name} is missing')
+    if result != (uploaded_file.file_hash, uploaded_file.size):
+        raise Abort(f'{name} does not match the uploaded content')
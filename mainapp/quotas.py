@@ -0,0 +1,61 @@
+# Per-user storage accounting and quotas.
+#
+# UserUsage holds each user's stored bytes and file count. Every UploadedFile
+# that is created or deleted changes it with a single UPDATE ... SET
+# bytes_used = bytes_used + n in the same transaction (see signals.py), so the
+# totals stay exact under concurrent requests and reading them is one primary
+# key lookup.
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import UserUsage
+
+
+# raised when storing a file would take a user over quota
+class QuotaExceeded(Exception):
+    pass
+
+
+# Bytes user may still store, or None without a limit.
+def remaining_quota(user):
+    usage = UserUsage.objects.filter(user=user).values_list('bytes_used', 'quota').first()
+    bytes_used, quota = usage or (0, None)
+    quota = settings.STORAGE_QUOTA if quota is None else quota
+    return None if quota is None else max(quota - bytes_used, 0)
+
+
+# The usage row of a user, created on first use and locked until the end of
+# the transaction.
+def locked_usage(user_id):
+    try:
+        with transaction.atomic():
+            UserUsage.objects.get_or_create(user_id=user_id)
+    except IntegrityError:
+        # created by a concurrent request
+        pass
+    return UserUsage.objects.select_for_update().get(user_id=user_id)
+
+
+# Raises QuotaExceeded when storing size more bytes would take the user over
+# quota. Call inside the transaction that stores the file: the row lock makes
+# concurrent uploads of the same user check the quota one after the other.
+def check_quota(user_id, size):
+    usage = locked_usage(user_id)
+    quota = settings.STORAGE_QUOTA if usage.quota is None else usage.quota
+    if quota is not None and usage.bytes_used + size > quota:
+        raise QuotaExceeded(f'This upload needs {size} bytes but only {max(quota - usage.bytes_used, 0)} are left')
+
+
+# Adds size bytes and files files (negative to remove) to a user's usage.
+def add_usage(user_id, size, files):
+    updated = UserUsage.objects.filter(user_id=user_id).update(
+        bytes_used=F('bytes_used') + size, file_count=F('file_count') + files
+    )
+    if not updated and files > 0:
+        try:
+            with transaction.atomic():
+                UserUsage.objects.create(user_id=user_id, bytes_used=size, file_count=files)
+        except IntegrityError:
+            # created by a concurrent request
+            add_usage(user_id, size, files)
@@ -0,0 +1,155 @@
+# Routing of read-only queries to read replicas (settings.DATABASE_REPLICAS).
+#
+# Everything goes to the primary ('default') unless it runs inside
+# replica_reads(), which the listings and the download access check use:
+# their queries then go to one replica, picked per request. Reads inside a
+# transaction stay on the primary, and so does everything a request reads
+# after it wrote, or when its client wrote within the last
+# REPLICA_PIN_SECONDS: ReplicaRoutingMiddleware remembers that in a cookie,
+# so users always see their own uploads and shares.
+#
+# To try it locally, add a second database as the replica, for instance a
+# copy of db.sqlite3, and list it in DATABASE_REPLICAS:
+#   DATABASES['replica1'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'replica.sqlite3'}
+#   DATABASE_REPLICAS = ['replica1']
+# Writes then only show up in listings once the copy is refreshed, as they
+# would with a lagging replica.
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'primary_until'
+
+
+# routing state of the request being answered
+class RoutingState:
+
+    def __init__(self, pinned):
+        # reads go to the primary
+        self.pinned = pinned
+        # this request wrote
+        self.wrote = False
+        # inside replica_reads()
+        self.replica_reads = False
+        self.replica = None
+
+
+_state = ContextVar('db_routing', default=None)
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is None or not state.replica_reads or state.pinned or not settings.DATABASE_REPLICAS:
+            return DEFAULT_DB_ALIAS
+        # a transaction reads its own writes
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        if state.replica is None:
+            state.replica = random.choice(settings.DATABASE_REPLICAS)
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.pinned = state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    # replicas get the schema by replication
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+# Lets the read queries run inside it go to a replica, unless enabled is False.
+@contextmanager
+def replica_reads(enabled=True):
+    state = _state.get()
+    if state is None or not enabled:
+        yield
+        return
+    previous, state.replica_reads = state.replica_reads, True
+    try:
+        yield
+    finally:
+        state.replica_reads = previous
+
+
+# whether reads of this request may go to a replica at all
+def replicas_in_use():
+    state = _state.get()
+    return bool(settings.DATABASE_REPLICAS) and state is not None and not state.pinned
+
+
+# Returns lookup() run on a replica, or on the primary when the replica found
+# nothing: it may not have seen a share made a moment ago yet.
+def from_replica(lookup):
+    if not replicas_in_use():
+        return lookup()
+    with replica_reads():
+        result = lookup()
+    return result if result is not None else lookup()
+
+
+# from_replica for a lookup returning an awaitable
+async def afrom_replica(lookup):
+    if not replicas_in_use():
+        return await lookup()
+    with replica_reads():
+        result = await lookup()
+    return result if result is not None else await lookup()
+
+
+# Sets up the routing state of every request and pins clients that wrote to
+# the primary for REPLICA_PIN_SECONDS.
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.asynchronous = iscoroutinefunction(get_response)
+        if self.asynchronous:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.asynchronous:
+            return self.__acall__(request)
+        state, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(state, response)
+
+    async def __acall__(self, request):
+        state, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(state, response)
+
+    def start(self, request):
+        try:
+            pinned = float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            pinned = False
+        state = RoutingState(pinned)
+        return state, _state.set(state)
+
+    def finish(self, state, response):
+        if state.wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(
+                PIN_COOKIE, str(int(time.time() + settings.REPLICA_PIN_SECONDS) + 1),
+                max_age=settings.REPLICA_PIN_SECONDS + 1, httponly=True, samesite='Lax',
+            )
+        return response
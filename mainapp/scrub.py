@@ -0,0 +1,176 @@
+# Integrity scrubbing: re-hashes stored files and compares them with the
+# SHA-256 recorded at upload time, to find content that was corrupted or lost
+# on disk after it was stored.
+#
+# Every blob is read once however many UploadedFile rows share it; files from
+# before the blob store are checked against their own file_hash. For a
+# corrupted blob with a block manifest the damaged byte ranges are reported. Files are
+# hashed in a pool of worker processes, one per core, so hashing is not bound
+# by a single core, while an overall read rate limit keeps the disks free for
+# downloads. The position is checkpointed after every batch, so an
+# interrupted or time-boxed run resumes where it stopped.
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import storages
+
+from .compression import DECODE_ERRORS, open_decoded
+from .manifests import damaged_blocks
+from .models import Blob, UploadedFile
+from .storage import stored_name
+
+# bytes per read; large reads into one reused buffer keep the syscall count
+# and allocations low. Plain reads rather than mmap, since a file truncated
+# under an mmap kills the worker with SIGBUS instead of raising an error.
+READ_SIZE = 8 * 1024 * 1024
+
+# files handed to the pool between checkpoints
+BATCH_SIZE = 256
+
+
+# Hashes the file at path, sleeping as needed to stay under rate bytes per
+# second (0 for no limit). A compressed blob (see compression.py) is hashed
+# as its original bytes. Returns (hex digest, size), or None if the file is
+# missing. Runs in the worker processes.
+def hash_path(path, rate=0, encoding=''):
+    try:
+        source = open_decoded(path, encoding) if encoding else open(path, 'rb', buffering=0)
+    except FileNotFoundError:
+        return None
+
+    sha256_hash = hashlib.sha256()
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+    size = 0
+    start = time.monotonic()
+    try:
+        with source:
+            while read := source.readinto(buffer):
+                sha256_hash.update(view[:read])
+                size += read
+                if rate:
+                    ahead = size / rate - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+    except DECODE_ERRORS:
+        # a compressed file too damaged to decompress
+        return '', size
+    return sha256_hash.hexdigest(), size
+
+
+# pool entry point: (kind, id, name, expected hash, path, rate, encoding) -> result
+def check(item):
+    kind, pk, name, expected, path, rate, encoding = item
+    return kind, pk, name, expected, hash_path(path, rate, encoding)
+
+
+class ScrubReport:
+    def __init__(self):
+        self.checked = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.corrupted = []
+        self.missing = []
+        # blob id -> [(block index, start, end)] for corrupted blobs with a manifest
+        self.damaged_ranges = {}
+        # True when the pass reached the last file
+        self.complete = False
+
+    @property
+    def gb_per_min(self):
+        return self.bytes / 1e9 / (self.seconds / 60) if self.seconds else 0.0
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as checkpoint:
+            return json.load(checkpoint)
+    except (FileNotFoundError, ValueError):
+        return {'blob': 0, 'file': 0}
+
+
+# written under a temp name and renamed, so a crash never leaves half a file
+def save_checkpoint(path, position):
+    with open(f'{path}.tmp', 'w') as checkpoint:
+        json.dump(position, checkpoint)
+    os.replace(f'{path}.tmp', path)
+
+
+# next batch after position: blobs first, then files stored before the blob store
+def next_batch(position, rate):
+    fs = storages['uploads']
+
+    blobs = Blob.objects.filter(id__gt=position['blob']).order_by('id').values_list('id', 'name', 'file_hash', 'encoding')
+    batch = [
+        ('blob', pk, name, file_hash, fs.path(name), rate, encoding)
+        for pk, name, file_hash, encoding in blobs[:BATCH_SIZE]
+    ]
+    if batch:
+        return batch
+
+    # files kept outside the upload storage cannot be checked here
+    files = (
+        UploadedFile.objects.filter(blob__isnull=True, id__gt=position['file'], file_url__startswith=settings.MEDIA_URL)
+        .exclude(file_hash='').order_by('id').only('id', 'file_url', 'file_hash', 'blob')
+    )
+    for uploaded_file in files[:BATCH_SIZE]:
+        name = stored_name(uploaded_file)
+        batch.append(('file', uploaded_file.id, name, uploaded_file.file_hash, fs.path(name), rate, ''))
+    return batch
+
+
+# Runs one scrub pass from the checkpoint, or stops at the first checkpoint
+# after max_seconds.
+# workers defaults to the number of cores; 1 hashes in this process.
+def scrub(checkpoint=None, workers=None, rate=None, max_seconds=None):
+    checkpoint = checkpoint or settings.SCRUB_CHECKPOINT
+    workers = workers or os.cpu_count() or 1
+    rate = settings.SCRUB_RATE_LIMIT if rate is None else rate
+
+    report = ScrubReport()
+    position = load_checkpoint(checkpoint)
+    start = time.monotonic()
+
+    # every worker gets its share of the overall rate limit
+    worker_rate = rate / workers if rate else 0
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        while True:
+            batch = next_batch(position, worker_rate)
+            if not batch:
+                report.complete = True
+                break
+
+            results = pool.map(check, batch) if pool else map(check, batch)
+            for kind, pk, name, expected, result in results:
+                if result is None:
+                    report.missing.append((kind, pk, name))
+                else:
+                    digest, size = result
+                    report.checked += 1
+                    report.bytes += size
+                    if digest != expected:
+                        report.corrupted.append((kind, pk, name))
+                        if kind == 'blob':
+                            blob = Blob.objects.get(pk=pk)
+                            if blob.block_size:
+                                report.damaged_ranges[pk] = damaged_blocks(blob)
+                position[kind] = pk
+            save_checkpoint(checkpoint, position)
+
+            # checked between batches, so every run makes progress
+            if max_seconds is not None and time.monotonic() - start >= max_seconds:
+                break
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+    # a finished pass starts over next time
+    if report.complete:
+        save_checkpoint(checkpoint, {'blob': 0, 'file': 0})
+    report.seconds = time.monotonic() - start
+    return report
@@ -0,0 +1,76 @@
+from itertools import islice
+
+from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.db.models import Q
+
+from . import access
+from .models import UploadedFile, SharedFile, GroupShare
+
+# through-table rows written per INSERT
+SHARE_BATCH_SIZE = 1000
+
+
+# Shares many of owner's files with many users and groups in a fixed number of
+# queries, however many pairs that makes: one for the files, one IN query
+# resolving every username and group member, one for the groups and batched
+# INSERTs of SHARE_BATCH_SIZE rows (smaller batches on backends that limit
+# query parameters, such as SQLite) for the user shares, the group shares and
+# the access index. Groups are shared as groups, so later membership changes
+# only touch the rows of the member who joined or left.
+# Pairs that are already shared are skipped by the database (ignore_conflicts),
+# so repeating a bulk share is harmless.
+#
+# Returns per-item results:
+#   {'files': {id: 'shared' | 'not found'},
+#    'users': {username: 'shared' | 'not found'},
+#    'groups': {name: 'shared with N users' | 'not found'},
+#    'pairs': number of (file, user) pairs with access written or already present}
+def bulk_share(owner, file_ids, usernames=(), group_names=()):
+    file_ids, usernames, group_names = set(file_ids), set(usernames), set(group_names)
+
+    # only the owner's own files can be shared
+    owned_ids = set(
+        UploadedFile.objects.filter(user=owner, id__in=file_ids).values_list('id', flat=True)
+    )
+
+    # every named user and every member of the named groups, in one query
+    found_users = {}
+    group_members = {name: set() for name in group_names}
+    if usernames or group_names:
+        rows = (
+            User.objects.filter(Q(username__in=usernames) | Q(groups__name__in=group_names))
+            .values_list('id', 'username', 'groups__name')
+        )
+        for user_id, username, group_name in rows:
+            if username in usernames:
+                found_users[username] = user_id
+            if group_name in group_members:
+                group_members[group_name].add(user_id)
+
+    groups = dict(Group.objects.filter(name__in=group_names).values_list('name', 'id')) if group_names else {}
+
+    # sharing with yourself means nothing
+    direct = set(found_users.values()) - {owner.id}
+    recipients = direct.union(*group_members.values()) - {owner.id}
+
+    # streams the rows into batched INSERTs, all or nothing
+    with transaction.atomic():
+        for model, rows in [
+            (SharedFile, (SharedFile(uploadedfile_id=f, user_id=u) for f in owned_ids for u in direct)),
+            (GroupShare, (GroupShare(uploadedfile_id=f, group_id=g) for f in owned_ids for g in groups.values())),
+        ]:
+            while batch := list(islice(rows, SHARE_BATCH_SIZE)):
+                model.objects.bulk_create(batch, ignore_conflicts=True)
+        # bulk_create sends no m2m signals, so the access index is written here
+        access.grant((f, u) for f in owned_ids for u in recipients)
+
+    return {
+        'files': {file_id: 'shared' if file_id in owned_ids else 'not found' for file_id in sorted(file_ids)},
+        'users': {name: 'shared' if name in found_users else 'not found' for name in sorted(usernames)},
+        'groups': {
+            name: f'shared with {len(group_members[name])} users' if name in groups else 'not found'
+            for name in sorted(group_names)
+        },
+        'pairs': len(owned_ids) * len(recipients),
+    }
@@ -0,0 +1,112 @@
+# Keeps the effective access index (mainapp.access), the cached listings
+# (mainapp.listing_cache) and the storage usage (mainapp.quotas) in step with
+# files, shares and group membership, and the cached users (mainapp.auth)
+# with the user rows.
+# Connected in MainappConfig.ready().
+#
+# Bulk writes that skip these signals (bulk_create, queryset.delete) must call
+# mainapp.access themselves, as sharing.bulk_share does.
+from django.contrib.auth.models import Group, User
+from django.db.models.signals import m2m_changed, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from . import access
+from .auth import invalidate_user
+from .quotas import add_usage
+from .listing_cache import invalidate
+from .models import FileAccess, GroupShare, SharedFile, UploadedFile
+
+
+# The ids on both sides of an m2m change: (ids of the instance side, pk_set).
+# pre_clear remembers what is about to be cleared, so post_clear knows it.
+def changed_ids(instance, action, pk_set, related):
+    if action == 'pre_clear':
+        instance._cleared_pks = set(related.values_list('pk', flat=True))
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_pks', set())
+    return [instance.pk], list(pk_set or ())
+
+
+# UploadedFile.shared_with / User.shared_files
+@receiver(m2m_changed, sender=SharedFile)
+def direct_share_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    related = instance.shared_files if reverse else instance.shared_with
+    ids, others = changed_ids(instance, action, pk_set, related)
+    file_ids, user_ids = (others, ids) if reverse else (ids, others)
+
+    if action == 'post_add':
+        access.grant((file_id, user_id) for file_id in file_ids for user_id in user_ids)
+    elif action in ('post_remove', 'post_clear'):
+        access.refresh(file_ids, user_ids)
+
+
+# UploadedFile.shared_with_groups / Group.shared_files
+@receiver(m2m_changed, sender=GroupShare)
+def group_share_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    related = instance.shared_files if reverse else instance.shared_with_groups
+    ids, others = changed_ids(instance, action, pk_set, related)
+    file_ids, group_ids = (others, ids) if reverse else (ids, others)
+
+    if action == 'post_add':
+        access.grant_groups(file_ids, group_ids)
+    elif action in ('post_remove', 'post_clear'):
+        access.refresh(file_ids, access.group_members(group_ids))
+
+
+# User.groups / Group.user_set
+@receiver(m2m_changed, sender=User.groups.through)
+def membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    related = instance.user_set if reverse else instance.groups
+    ids, others = changed_ids(instance, action, pk_set, related)
+    group_ids, user_ids = (ids, others) if reverse else (others, ids)
+
+    if action == 'post_add':
+        files = access.group_files(group_ids)
+        access.grant((file_id, user_id) for file_id in files for user_id in user_ids)
+    elif action in ('post_remove', 'post_clear'):
+        access.refresh(access.group_files(group_ids), user_ids)
+
+
+# deleting a group drops its shares and memberships by cascade, without m2m
+# signals; what its members could open through it is re-checked afterwards
+@receiver(pre_delete, sender=Group)
+def group_deleting(sender, instance, **kwargs):
+    instance._access_pairs = (access.group_files([instance.pk]), access.group_members([instance.pk]))
+
+
+@receiver(post_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    file_ids, user_ids = instance.__dict__.pop('_access_pairs', ((), ()))
+    access.refresh(file_ids, user_ids)
+
+
+# users who see a file in their shared listing
+def recipients(uploaded_file):
+    return list(FileAccess.objects.filter(uploadedfile=uploaded_file).values_list('user_id', flat=True))
+
+
+# an upload shows up in its owner's listing; a changed file everywhere it is listed
+@receiver(post_save, sender=UploadedFile)
+def file_saved(sender, instance, created, **kwargs):
+    invalidate([instance.user_id] + ([] if created else recipients(instance)))
+    if created:
+        add_usage(instance.user_id, instance.size, 1)
+
+
+# the access rows are gone by post_delete, so the recipients are read before
+@receiver(pre_delete, sender=UploadedFile)
+def file_deleting(sender, instance, **kwargs):
+    instance._recipients = recipients(instance)
+
+
+@receiver(post_delete, sender=UploadedFile)
+def file_deleted(sender, instance, **kwargs):
+    invalidate([instance.user_id] + instance.__dict__.pop('_recipients', []))
+    add_usage(instance.user_id, -instance.size, -1)
+
+
+# a changed password, a deactivated or deleted user takes effect in every process
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
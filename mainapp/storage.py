@@ -0,0 +1,242 @@
+import itertools
+import os
+import uuid
+from urllib.parse import unquote, urlsplit
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+
+from . import orphans
+from .compression import COMPRESSION_MIN_SAVING, compressible, compressor
+from .hashing import ContentHasher
+from .manifests import write_manifest
+from .metrics import timed_write
+from .models import Blob
+
+# size of each read from the uploaded file; bigger chunks mean fewer syscalls
+# while still keeping memory use flat no matter how large the upload is
+CHUNK_SIZE = 1024 * 1024
+
+
+# Streams an uploaded file into a FileSystemStorage while hashing it.
+# Every chunk is read exactly once: it is written to disk and fed to the
+# hasher in the same loop, so large uploads are never re-read just to be
+# hashed. Pass a hashing.ContentHasher as hasher to also get its fingerprint.
+# When file_hash was already computed while the upload was received (see
+# uploadhandlers.HashingUploadHandler) the content is saved as is, which lets
+# FileSystemStorage simply move the upload temp file into place.
+# Returns the stored name and the hex digest of the content.
+def save_and_hash(storage, name, content, file_hash=None, hasher=None):
+    if file_hash:
+        return storage.save(name, content), file_hash
+
+    hasher = hasher or ContentHasher(fingerprint='')
+
+    # pick a free name the same way FileSystemStorage.save() does
+    name = storage.get_available_name(name)
+    full_path = storage.path(name)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+    # O_EXCL guards against another request grabbing the same name in between
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        try:
+            fd = os.open(full_path, flags, 0o666)
+            break
+        except FileExistsError:
+            name = storage.get_available_name(name)
+            full_path = storage.path(name)
+
+    try:
+        with os.fdopen(fd, 'wb') as destination:
+            for chunk in content.chunks(CHUNK_SIZE):
+                timed_write(destination, chunk)
+                hasher.update(chunk)
+    except BaseException:
+        # never leave a half written file behind
+        os.remove(full_path)
+        raise
+
+    if storage.file_permissions_mode is not None:
+        os.chmod(full_path, storage.file_permissions_mode)
+
+    return name, hasher.hexdigest()
+
+
+# Storage name of an UploadedFile's bytes: its blob, or for files uploaded
+# before the blob store, the path its file_url points at below MEDIA_URL.
+# Returns None when the file is not kept in the upload storage.
+def stored_name(uploaded_file):
+    if uploaded_file.blob_id:
+        return uploaded_file.blob.name
+
+    path = unquote(urlsplit(uploaded_file.file_url).path)
+    if path.startswith(settings.MEDIA_URL):
+        return path[len(settings.MEDIA_URL):]
+    return None
+
+
+# Content-addressed storage: every distinct content is stored once, under its
+# SHA-256 hash, and shared by all UploadedFile rows with that hash.
+# It is configured as the "uploads" entry of settings.STORAGES and plugs in
+# wherever the views used a plain FileSystemStorage.
+class ContentAddressedStorage(FileSystemStorage):
+
+    # storage name of the blob holding the content with this hash; two levels
+    # of hash-prefixed directories keep every directory small (at most 65536
+    # subdirectories per level), so lookups and listings stay fast however
+    # many blobs there are, and names never collide, so nothing is probed
+    def blob_name(self, file_hash):
+        return f'blobs/{file_hash[:2]}/{file_hash[2:4]}/{file_hash}'
+
+    # private name for content that is still being written; a fresh uuid
+    # never collides, so no name probing is needed
+    def incoming_name(self):
+        return f'incoming/{uuid.uuid4().hex}'
+
+    # Writes content under an incoming name, ready for save_blob(), and
+    # returns (incoming, encoding, digests). Call it outside any transaction:
+    # this is the slow part of storing a file and it takes no locks.
+    # digests are the hashing.Digests of the content when they were already
+    # computed; when the blob exists then, nothing is written and incoming is
+    # None. With settings.STORAGE_COMPRESSION new content is compressed while
+    # it is written. Content without digests is read once, hashed in the same
+    # loop that writes it.
+    def receive(self, content, digests=None):
+        compression = settings.STORAGE_COMPRESSION
+        if digests is None:
+            hasher = ContentHasher()
+            incoming, encoding = self.save_encoded(content, compression, hasher)
+            return incoming, encoding, hasher.digests()
+        if Blob.objects.filter(file_hash=digests.sha256).exists() and self.exists(self.blob_name(digests.sha256)):
+            return None, '', digests
+        return *self.save_encoded(content, compression), digests
+
+    # Removes what receive() wrote when it was not moved into the blob store.
+    def discard(self, received):
+        if received[0] is not None:
+            self.delete(received[0])
+
+    # Stores content and returns its Blob with one more reference taken.
+    # received is what receive() returned for content; without it the
+    # content is received first. Either way the incoming file is moved into
+    # place, or removed when the same content was already stored.
+    def save_blob(self, content, digests=None, received=None):
+        incoming, encoding, digests = received or self.receive(content, digests)
+        try:
+            with transaction.atomic():
+                blob, needs_file = self.lock_blob(digests.sha256)
+                if needs_file:
+                    if incoming is None:
+                        # the stored copy went away after receive() looked
+                        incoming, encoding = self.save_encoded(content, settings.STORAGE_COMPRESSION)
+                    self.place(self.path(incoming), blob)
+                    incoming = None
+                self.take_reference(blob, digests, encoding if needs_file else None)
+        finally:
+            # the same content was already stored
+            if incoming is not None:
+                self.delete(incoming)
+
+        return blob
+
+    # Saves content under an incoming name, compressed with encoding when it
+    # is worth it, and feeds it to hasher if given while it is written.
+    # Returns the name and the encoding used, '' for raw bytes.
+    def save_encoded(self, content, encoding, hasher=None):
+        if encoding:
+            chunks = content.chunks(CHUNK_SIZE)
+            head = next(chunks, b'')
+            if compressible(head):
+                name = self.incoming_name()
+                path = self.path(name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                packer = compressor(encoding)
+                try:
+                    with open(path, 'wb') as destination:
+                        for chunk in itertools.chain([head], chunks):
+                            if hasher is not None:
+                                hasher.update(chunk)
+                            timed_write(destination, packer.compress(chunk))
+                        timed_write(destination, packer.flush())
+                except BaseException:
+                    # never leave a half written file behind
+                    if os.path.exists(path):
+                        os.remove(path)
+                    raise
+                if os.path.getsize(path) <= content.size * (1 - COMPRESSION_MIN_SAVING):
+                    return name, encoding
+                # it did not shrink enough after all; the hasher has seen it all
+                os.remove(path)
+                hasher = None
+        if hasher is not None:
+            return save_and_hash(self, self.incoming_name(), content, hasher=hasher)[0], ''
+        return self.save(self.incoming_name(), content), ''
+
+    # Moves the file at path, whose content has these digests, into the blob
+    # store and returns its Blob with one more reference taken. When the blob
+    # is already stored the file is left where it is.
+    def adopt_blob(self, path, digests):
+        with transaction.atomic():
+            blob, needs_file = self.lock_blob(digests.sha256)
+            if needs_file:
+                self.place(path, blob)
+            self.take_reference(blob, digests, '' if needs_file else None)
+        return blob
+
+    # Gets or creates the Blob for file_hash under a row lock, which
+    # serialises us with release_blob() for the same hash.
+    # Returns the blob and whether its file still has to be put in place.
+    # A file found under the name of a new blob is never reused: it is an
+    # orphan that collect_orphans may be removing right now, and putting a new
+    # file in place gives it a new inode, which the collector leaves alone.
+    def lock_blob(self, file_hash):
+        blob, created = Blob.objects.select_for_update().get_or_create(
+            file_hash=file_hash, defaults={'name': self.blob_name(file_hash)}
+        )
+        return blob, created or not self.exists(blob.name)
+
+    # renames the file at path to the blob's name
+    def place(self, path, blob):
+        os.makedirs(os.path.dirname(self.path(blob.name)), exist_ok=True)
+        os.replace(path, self.path(blob.name))
+
+    # counts one more reference to a locked blob and records whatever the
+    # digests add to it; encoding is given when a new file was put in place
+    def take_reference(self, blob, digests, encoding=None):
+        blob.ref_count = F('ref_count') + 1
+        update_fields = ['ref_count']
+        if encoding is not None and encoding != blob.encoding:
+            blob.encoding = encoding
+            update_fields.append('encoding')
+        if digests.fingerprint and not blob.fingerprint:
+            blob.fingerprint_algorithm, blob.fingerprint = digests.fingerprint
+            update_fields += ['fingerprint', 'fingerprint_algorithm']
+        if digests.manifest is not None and blob.block_size is None:
+            blob.block_size = write_manifest(blob, digests.manifest, digests.block_size)
+            update_fields.append('block_size')
+        blob.save(update_fields=update_fields)
+        blob.refresh_from_db()
+
+    # Drops one reference to a blob and removes the file with the last one.
+    # Call inside the transaction that deletes the referencing UploadedFile.
+    def release_blob(self, blob_id):
+        with transaction.atomic():
+            blob = Blob.objects.select_for_update().get(pk=blob_id)
+            blob.ref_count -= 1
+            if blob.ref_count > 0:
+                blob.save(update_fields=['ref_count'])
+                return
+
+            blob.delete()
+            path = self.path(blob.name)
+            try:
+                scanned = os.stat(path)
+            except FileNotFoundError:
+                return
+            # removed once the delete is committed, so a rollback never loses
+            # the bytes; an upload of the same content in between puts a new
+            # file (another inode) in place, which orphans.remove() keeps
+            transaction.on_commit(lambda: orphans.remove(blob.name, path, scanned))
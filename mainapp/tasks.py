@@ -0,0 +1,150 @@
+# A small task queue kept in the database, so work can be moved out of
+# requests without running a broker.
+#
+# Functions decorated with @task are enqueued as Task rows, in the caller's
+# transaction: a task becomes visible to workers only when the work that
+# queued it is committed, and is dropped with it on a rollback. Workers (the
+# run_tasks command) claim due tasks under row locks, skipping rows other
+# workers hold. Every queue has a cluster-wide concurrency limit, enforced by
+# the slots running tasks hold. Failed attempts are retried with exponential
+# backoff; a task whose worker died is retried once its lease runs out.
+import logging
+import traceback
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+TaskSpec = namedtuple('TaskSpec', 'func queue max_attempts on_failure')
+
+# registered tasks by name
+registry = {}
+
+# due tasks looked at per claim
+CLAIM_BATCH = 20
+
+
+# raised by a task that cannot succeed, so it fails without further retries
+class Abort(Exception):
+    pass
+
+
+# Registers func as a task. on_failure is called with the task's arguments
+# once its last attempt failed.
+def task(queue='default', max_attempts=3, on_failure=None):
+    def register(func):
+        func.task_name = f'{func.__module__}.{func.__name__}'
+        registry[func.task_name] = TaskSpec(func, queue, max_attempts, on_failure)
+        return func
+    return register
+
+
+# Queues func(*args) to run in a worker, after delay seconds if given.
+# args must be JSON serialisable.
+def enqueue(func, *args, delay=0):
+    spec = registry[func.task_name]
+    return Task.objects.create(
+        name=func.task_name, args=list(args), queue=spec.queue, max_attempts=spec.max_attempts,
+        run_after=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+# concurrency limit of a queue
+def queue_limit(queue):
+    return settings.TASK_QUEUES.get(queue, 1)
+
+
+# Calls the on_failure hook of a task that is not tried again.
+def give_up(failed):
+    spec = registry.get(failed.name)
+    if spec is not None and spec.on_failure is not None:
+        spec.on_failure(*failed.args)
+
+
+# Puts tasks whose lease ran out back in the queue, or fails them when that
+# was their last attempt.
+def expire_leases(now):
+    expired = Task.objects.filter(status=Task.RUNNING, lease_until__lt=now)
+    for stale in expired.filter(attempts__gte=F('max_attempts')):
+        # only the worker that marks it failed calls its hook
+        if expired.filter(pk=stale.pk, attempts=stale.attempts).update(
+            status=Task.FAILED, slot=None, lease_until=None, error='the worker running the task stopped',
+        ):
+            give_up(stale)
+    expired.update(status=Task.QUEUED, slot=None, lease_until=None)
+
+
+# Claims the next due task of queues (all when None) that its queue has a
+# free slot for; returns it, marked running, or None.
+def claim(queues=None):
+    now = timezone.now()
+    expire_leases(now)
+
+    with transaction.atomic():
+        due = Task.objects.filter(status=Task.QUEUED, run_after__lte=now)
+        if queues:
+            due = due.filter(queue__in=queues)
+
+        for candidate in due.select_for_update(skip_locked=True).order_by('run_after', 'id')[:CLAIM_BATCH]:
+            busy = set(
+                Task.objects.filter(queue=candidate.queue, status=Task.RUNNING).values_list('slot', flat=True)
+            )
+            slot = next((slot for slot in range(queue_limit(candidate.queue)) if slot not in busy), None)
+            if slot is None:
+                continue
+
+            candidate.status = Task.RUNNING
+            candidate.slot = slot
+            candidate.attempts += 1
+            candidate.lease_until = now + timedelta(seconds=settings.TASK_LEASE)
+            try:
+                # another worker took the slot in the meantime
+                with transaction.atomic():
+                    candidate.save(update_fields=['status', 'slot', 'attempts', 'lease_until'])
+            except IntegrityError:
+                continue
+            return candidate
+    return None
+
+
+# Runs a claimed task and records the outcome: finished tasks are deleted,
+# failed ones are retried later or marked failed.
+def run(claimed):
+    spec = registry.get(claimed.name)
+    try:
+        if spec is None:
+            raise Abort(f'unknown task {claimed.name}')
+        spec.func(*claimed.args)
+    except Exception as error:
+        logger.exception('task %s (%s) failed', claimed.pk, claimed.name)
+        final = isinstance(error, Abort) or claimed.attempts >= claimed.max_attempts
+        retry_in = settings.TASK_RETRY_DELAY * 2 ** (claimed.attempts - 1)
+        # unless the lease ran out and another worker has the task by now
+        Task.objects.filter(pk=claimed.pk, attempts=claimed.attempts).update(
+            status=Task.FAILED if final else Task.QUEUED,
+            run_after=timezone.now() + timedelta(seconds=retry_in),
+            slot=None, lease_until=None, error=traceback.format_exc(),
+        )
+        if final:
+            give_up(claimed)
+        return False
+
+    # the same guard: a task re-claimed by another worker is left to it
+    Task.objects.filter(pk=claimed.pk, attempts=claimed.attempts).delete()
+    return True
+
+
+# Runs due tasks until none is left that can be claimed; returns how many ran.
+def run_pending(queues=None):
+    count = 0
+    while (claimed := claim(queues)) is not None:
+        run(claimed)
+        count += 1
+    return count
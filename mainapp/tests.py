@@ -1,7 +1,10 @@
-from django.test import TestCase, Client
+from django.test import (
+    TestCase, TransactionTestCase, Client, RequestFactory, AsyncRequestFactory, override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 
 # these imports are for testing authentication
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import authenticate
 from mainapp.forms import SignupForm, LoginForm
@@ -9,8 +12,53 @@ from mainapp.forms import SignupForm, LoginForm
 # these imports are for testing file integrity
 import hashlib
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.contrib.auth.models import User
-from mainapp.models import UploadedFile
+from mainapp.models import UploadedFile, Blob, UploadSession, SharedFile, GroupShare, FileAccess, UserUsage, Task
+
+# these imports are for testing the upload pipeline
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import StopUpload
+from django.core.management import call_command
+from django.db import connection, connections
+from django.http import Http404
+from django.utils import timezone
+from mainapp import async_views, previews, tasks
+from mainapp.auth import client_address
+from mainapp.hashing import ContentHasher, tree_root
+from mainapp.layout import shard_media
+from mainapp.listing_cache import listing_cache, listing_version, stats as listing_stats
+from mainapp.manifests import damaged_blocks
+from mainapp.orphans import collect_orphans, remove as remove_orphan
+from mainapp.quotas import QuotaExceeded
+from mainapp.scrub import scrub
+from mainapp.sharing import bulk_share
+from mainapp.storage import save_and_hash
+from mainapp.uploadhandlers import QuotaUploadHandler
+from mainapp.uploads import store_upload
+
+
+# Gives every test its own MEDIA_ROOT in a temporary directory, so stored
+# files never end up in the real media folder.
+class TempMediaMixin:
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
 
 '''
 The following section is for "1. User Registration and Authentication (3 marks)"
@@ -129,8 +177,9 @@ Objective: Ensure unauthorized users cannot download files.
 Approach:
 Attempt to access the file download endpoint without authentication or as a different user.
 '''
-class FileUploadDownloadTest(TestCase):
+class FileUploadDownloadTest(TempMediaMixin, TestCase):
     def setUp(self):
+        super().setUp()
         # Create and authenticate a test user
         self.user = User.objects.create_user(username='testuser', password='12345')
         self.client = Client()
@@ -181,8 +230,9 @@ Files can be shared only between authenticated users.
 Only authorized users appointed by the uploader can access the shared file.
 Unauthorized users cannot access the shared file.
 '''
-class FileSharingTest(TestCase):
+class FileSharingTest(TempMediaMixin, TestCase):
     def setUp(self):
+        super().setUp()
         # Create three users
         self.uploader = User.objects.create_user(username='uploader', password='uploader123')
         self.shared_user = User.objects.create_user(username='shared_user', password='shared123')
@@ -241,8 +291,9 @@ Finally, it checks if the original hash and the new hash are different.
 These tests are simplified and assume that the file content is directly available. 
 In a real-world scenario, we would need to retrieve the file from the location specified in file_url to compute its hash.
 '''
-class FileIntegrityTest(TestCase):
+class FileIntegrityTest(TempMediaMixin, TestCase):
     def setUp(self):
+        super().setUp()
         # Create a test user
         self.user = User.objects.create_user(username='testuser', password='12345')
 
@@ -271,8 +322,9 @@ class FileIntegrityTest(TestCase):
 '''
 The following section is for "4. File Integrity Check (2 marks)"
 '''
-class FileModificationDetectionTest(TestCase):
+class FileModificationDetectionTest(TempMediaMixin, TestCase):
     def setUp(self):
+        super().setUp()
         # Create a test user
         self.user = User.objects.create_user(username='testuser2', password='12345')
 
@@ -299,3 +351,1650 @@ class FileModificationDetectionTest(TestCase):
         self.assertNotEqual(original_hash, uploaded_file.file_hash)
 
 
+
+
+
+'''
+The following section covers the single-pass upload pipeline.
+The SHA-256 hash is computed while the upload is received (or while it is written),
+so the stored file_hash must match the bytes that end up on disk.
+'''
+class SinglePassUploadTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client = Client()
+        self.client.login(username='testuser', password='12345')
+
+    def test_upload_records_hash_of_stored_bytes(self):
+        # larger than FILE_UPLOAD_MAX_MEMORY_SIZE so it goes through a temp file
+        content = os.urandom(3 * 1024 * 1024)
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile("big.bin", content)})
+
+        uploaded_file = UploadedFile.objects.get(user=self.user)
+        self.assertEqual(uploaded_file.file_hash, hashlib.sha256(content).hexdigest())
+
+        stored_path = os.path.join(self.media_root, uploaded_file.blob.name)
+        with open(stored_path, 'rb') as stored:
+            self.assertEqual(stored.read(), content)
+
+    def test_save_and_hash_without_received_hash(self):
+        # without a precomputed hash the chunks are written and hashed in one loop
+        content = b"streamed content" * 1000
+        name, file_hash = save_and_hash(FileSystemStorage(), "streamed.txt", SimpleUploadedFile("streamed.txt", content))
+
+        self.assertEqual(file_hash, hashlib.sha256(content).hexdigest())
+        with open(os.path.join(self.media_root, name), 'rb') as stored:
+            self.assertEqual(stored.read(), content)
+
+
+
+'''
+The following section covers the content-addressed blob store.
+Identical uploads share one stored blob; the blob is only removed
+when the last file referencing it is deleted.
+'''
+class DeduplicatedStorageTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.first = User.objects.create_user(username='first', password='12345')
+        self.second = User.objects.create_user(username='second', password='12345')
+        self.client = Client()
+
+    def upload_as(self, username, content, name="installer.bin"):
+        self.client.login(username=username, password='12345')
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile(name, content)})
+        return UploadedFile.objects.latest('id')
+
+    def test_identical_uploads_share_one_blob(self):
+        first_file = self.upload_as('first', b"same installer bytes")
+        second_file = self.upload_as('second', b"same installer bytes", name="copy.bin")
+
+        self.assertEqual(first_file.blob_id, second_file.blob_id)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+        self.assertEqual(second_file.name, "copy.bin")
+        self.assertEqual(os.listdir(os.path.dirname(os.path.join(self.media_root, first_file.blob.name))), [first_file.file_hash])
+
+    def test_blob_removed_with_last_reference(self):
+        first_file = self.upload_as('first', b"shared content")
+        second_file = self.upload_as('second', b"shared content")
+        blob_path = os.path.join(self.media_root, first_file.blob.name)
+
+        # deleting one reference keeps the bytes for the other file
+        self.client.post(f'/mainapp/delete/{second_file.id}/')
+        self.assertTrue(os.path.exists(blob_path))
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+        # deleting the last reference removes the blob, and its file once
+        # the delete is committed
+        self.client.login(username='first', password='12345')
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(f'/mainapp/delete/{first_file.id}/')
+        self.assertFalse(Blob.objects.exists())
+        self.assertTrue(os.path.exists(blob_path))
+        for callback in callbacks:
+            callback()
+        self.assertFalse(os.path.exists(blob_path))
+
+    def test_content_stored_again_before_commit_is_kept(self):
+        uploaded_file = self.upload_as('first', b"stored twice")
+        blob_path = os.path.join(self.media_root, uploaded_file.blob.name)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(f'/mainapp/delete/{uploaded_file.id}/')
+        # the same content is uploaded again before the delete's file removal runs
+        again = self.upload_as('second', b"stored twice")
+        for callback in callbacks:
+            callback()
+        self.assertTrue(os.path.exists(blob_path))
+        self.assertEqual(again.blob.name, uploaded_file.blob.name)
+
+
+
+'''
+The following section covers the compact binary hash column.
+file_digest mirrors file_hash as 32 raw bytes and backs indexed hash lookups.
+'''
+class FileDigestTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Create a test user
+        self.user = User.objects.create_user(username='testuser', password='12345')
+
+    def test_lookup_by_hash_uses_digest(self):
+        file_hash = hashlib.sha256(b"indexed content").hexdigest()
+        uploaded_file = UploadedFile.objects.create(user=self.user, file_url='/media/indexed.txt', file_hash=file_hash)
+
+        self.assertEqual(bytes(uploaded_file.file_digest), bytes.fromhex(file_hash))
+        self.assertEqual(UploadedFile.objects.with_hash(file_hash).get(), uploaded_file)
+
+    def test_digest_follows_hash_updates(self):
+        uploaded_file = UploadedFile.objects.create(user=self.user, file_url='/media/a.txt', file_hash=hashlib.sha256(b"a").hexdigest())
+
+        # changing only file_hash through update_fields still refreshes the digest
+        new_hash = hashlib.sha256(b"b").hexdigest()
+        uploaded_file.file_hash = new_hash
+        uploaded_file.save(update_fields=['file_hash'])
+
+        self.assertTrue(UploadedFile.objects.with_hash(new_hash).exists())
+
+
+
+'''
+The following section covers the query count of the upload dashboard.
+The owned and shared lists are each loaded with one query, so the number
+of queries does not grow with the number of files.
+'''
+class DashboardQueryCountTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.other = User.objects.create_user(username='other', password='12345')
+        self.client = Client()
+        self.client.login(username='testuser', password='12345')
+
+    def add_files(self, count):
+        for n in range(count):
+            UploadedFile.objects.create(user=self.user, file_url=f'/media/own{n}.txt', name=f'own{n}.txt')
+            shared = UploadedFile.objects.create(user=self.other, file_url=f'/media/shared{n}.txt')
+            shared.shared_with.add(self.user)
+
+    def count_dashboard_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/mainapp/upload/')
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_is_constant(self):
+        self.add_files(1)
+        few = self.count_dashboard_queries()
+
+        self.add_files(20)
+        many = self.count_dashboard_queries()
+
+        self.assertEqual(few, many)
+
+    def test_dashboard_queries(self):
+        self.add_files(5)
+
+        # session, user, owned files and shared files (with their owners)
+        with self.assertNumQueries(4):
+            response = self.client.get('/mainapp/upload/')
+
+        self.assertContains(response, 'Shared by: other', count=5)
+        self.assertContains(response, 'own4.txt')
+
+
+
+'''
+The following section covers keyset pagination of the file listings,
+on the dashboard and through the json api.
+'''
+class FileListPaginationTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.other = User.objects.create_user(username='other', password='12345')
+        self.client = Client()
+        self.client.login(username='testuser', password='12345')
+
+        self.owned_ids = [
+            UploadedFile.objects.create(user=self.user, file_url=f'/media/own{n}.txt', name=f'own{n}.txt').id
+            for n in range(7)
+        ]
+        for n in range(3):
+            shared = UploadedFile.objects.create(user=self.other, file_url=f'/media/shared{n}.txt')
+            shared.shared_with.add(self.user)
+
+    def test_api_pages_through_owned_files(self):
+        seen = []
+        cursor = ''
+        while True:
+            data = self.client.get('/mainapp/api/files/', {'kind': 'owned', 'limit': 3, 'before': cursor}).json()
+            seen += [file['id'] for file in data['files']]
+            if data['next'] is None:
+                break
+            cursor = data['next']
+
+        # every file exactly once, newest first
+        self.assertEqual(seen, sorted(self.owned_ids, reverse=True))
+
+    def test_api_lists_shared_files_with_owner(self):
+        data = self.client.get('/mainapp/api/files/', {'kind': 'shared'}).json()
+
+        self.assertEqual(len(data['files']), 3)
+        self.assertEqual({file['owner'] for file in data['files']}, {'other'})
+        self.assertIsNone(data['next'])
+
+    def test_api_rejects_unknown_kind(self):
+        response = self.client.get('/mainapp/api/files/', {'kind': 'everything'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursors_beyond_any_id_rejected(self):
+        too_large = '9' * 20
+        self.assertEqual(self.client.get('/mainapp/api/files/', {'before': too_large}).status_code, 400)
+        self.assertEqual(self.client.get('/mainapp/upload/', {'shared_before': too_large}).status_code, 400)
+        self.assertEqual(self.client.get('/mainapp/api/files/', {'before': 2 ** 63 - 1}).status_code, 200)
+
+    def test_dashboard_uses_cursor(self):
+        # only files older than the cursor are listed
+        response = self.client.get('/mainapp/upload/', {'owned_before': self.owned_ids[2]})
+
+        self.assertEqual([file.id for file in response.context['owned_files']], self.owned_ids[1::-1])
+        self.assertIsNone(response.context['owned_next'])
+
+
+
+'''
+The following section covers the download view.
+Only the owner and users the file is shared with can download it;
+downloads support ETag revalidation, byte ranges and proxy offloading.
+'''
+class FileDownloadViewTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.owner = User.objects.create_user(username='owner', password='12345')
+        self.shared_user = User.objects.create_user(username='shared_user', password='12345')
+        User.objects.create_user(username='stranger', password='12345')
+        self.client = Client()
+
+        self.content = b"0123456789" * 100
+        self.client.login(username='owner', password='12345')
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile("report.txt", self.content)})
+        self.uploaded_file = UploadedFile.objects.get()
+        self.uploaded_file.shared_with.add(self.shared_user)
+        self.url = f'/mainapp/download/{self.uploaded_file.id}/'
+
+    def test_owner_downloads_file(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['ETag'], f'"{self.uploaded_file.file_hash}"')
+        self.assertIn('report.txt', response['Content-Disposition'])
+
+    def test_shared_user_downloads_file(self):
+        self.client.login(username='shared_user', password='12345')
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_stranger_cannot_download(self):
+        self.client.login(username='stranger', password='12345')
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_stranger_cannot_share_or_delete(self):
+        self.client.login(username='stranger', password='12345')
+        response = self.client.post(f'/mainapp/share/{self.uploaded_file.id}/', {'share_with': 'stranger'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+        self.assertEqual(self.client.post(f'/mainapp/delete/{self.uploaded_file.id}/').status_code, 404)
+        self.assertEqual(self.client.post('/mainapp/delete/999999/').status_code, 404)
+        self.assertTrue(UploadedFile.objects.exists())
+
+    def test_range_request(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_suffix_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[-5:])
+
+        # an empty file has no last bytes
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile("empty.txt", b"")})
+        empty = UploadedFile.objects.get(name='empty.txt')
+        response = self.client.get(f'/mainapp/download/{empty.id}/', HTTP_RANGE='bytes=-5')
+        self.assertEqual(response.status_code, 416)
+
+    def test_etag_revalidation(self):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"{self.uploaded_file.file_hash}"')
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(DOWNLOAD_SENDFILE_HEADER='X-Accel-Redirect')
+    def test_proxy_offload(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.uploaded_file.blob.name}')
+        self.assertEqual(response.content, b'')
+
+
+
+'''
+The following section covers resumable, chunked uploads.
+Chunks can arrive in any order; finishing the session assembles the file,
+hashes it and creates the UploadedFile.
+'''
+@override_settings(UPLOAD_CHUNK_SIZE_MIN=4)
+class ResumableUploadTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client = Client()
+        self.client.login(username='testuser', password='12345')
+
+        self.content = b"resumable upload content!"
+        self.session = self.client.post(
+            '/mainapp/api/uploads/',
+            {'name': 'big.iso', 'size': len(self.content), 'chunk_size': 10},
+            content_type='application/json',
+        ).json()
+        self.base = f"/mainapp/api/uploads/{self.session['id']}/"
+
+    def put_chunk(self, index):
+        data = self.content[index * 10:(index + 1) * 10]
+        return self.client.put(f'{self.base}chunks/{index}/', data, content_type='application/octet-stream')
+
+    def test_chunks_in_any_order(self):
+        self.assertEqual(self.session['total_chunks'], 3)
+
+        self.assertEqual(self.put_chunk(2).status_code, 204)
+        self.assertEqual(self.put_chunk(0).status_code, 204)
+        self.assertEqual(self.client.get(self.base).json()['missing'], [1])
+
+        # finishing too early reports the missing chunks
+        self.assertEqual(self.client.post(f'{self.base}complete/').status_code, 409)
+
+        self.put_chunk(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'{self.base}complete/')
+        self.assertEqual(response.status_code, 201)
+
+        uploaded_file = UploadedFile.objects.get(user=self.user)
+        self.assertEqual(uploaded_file.name, 'big.iso')
+        self.assertEqual(uploaded_file.file_hash, hashlib.sha256(self.content).hexdigest())
+        with open(os.path.join(self.media_root, uploaded_file.blob.name), 'rb') as stored:
+            self.assertEqual(stored.read(), self.content)
+
+        # the session and its chunks are gone
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.listdir(os.path.join(self.media_root, 'chunks')))
+
+    def test_failed_finish_can_be_retried(self):
+        for index in range(3):
+            self.put_chunk(index)
+
+        # a finish already under way turns a second one away
+        UploadSession.objects.update(finishing=True)
+        self.assertEqual(self.client.post(f'{self.base}complete/').status_code, 409)
+        UploadSession.objects.update(finishing=False)
+
+        with patch('mainapp.uploads.check_quota', side_effect=QuotaExceeded('no room')):
+            self.assertEqual(self.client.post(f'{self.base}complete/').status_code, 413)
+        # the session keeps its chunk files and is no longer claimed
+        self.assertFalse(UploadSession.objects.get().finishing)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'chunks', self.session['id']))), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(f'{self.base}complete/').status_code, 201)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'chunks', self.session['id'])))
+
+    def test_malformed_session_requests_rejected(self):
+        for body in ('null', '[]', '42', '{"name": "a.bin"}', 'not json'):
+            response = self.client.post('/mainapp/api/uploads/', body, content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+        self.assertEqual(UploadSession.objects.count(), 1)
+
+    def test_wrong_chunk_size_rejected(self):
+        response = self.client.put(f'{self.base}chunks/0/', b"short", content_type='application/octet-stream')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(self.base).json()['received'], [])
+
+    def test_abandoned_sessions_collected(self):
+        self.put_chunk(0)
+        UploadSession.objects.update(updated=timezone.now() - timedelta(days=2))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('cleanup_upload_sessions', stdout=io.StringIO())
+
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'chunks', self.session['id'])))
+
+
+
+'''
+The following section covers the async versions of the file views,
+used when the project is served through ASGI.
+'''
+class AsyncFileViewsTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.owner = User.objects.create_user(username='owner', password='12345')
+        self.friend = User.objects.create_user(username='friend', password='12345')
+        self.factory = AsyncRequestFactory()
+
+    def request(self, method, path, user, **kwargs):
+        request = getattr(self.factory, method)(path, **kwargs)
+        request.user = user
+        return request
+
+    async def upload(self, content):
+        request = self.request('post', '/mainapp/upload/', self.owner, data={'document': SimpleUploadedFile("notes.txt", content)})
+        response = await async_views.upload(request)
+        self.assertEqual(response.status_code, 200)
+        return await UploadedFile.objects.select_related('blob').alatest('id')
+
+    async def test_upload_and_download(self):
+        uploaded_file = await self.upload(b"async content")
+        self.assertEqual(uploaded_file.file_hash, hashlib.sha256(b"async content").hexdigest())
+
+        response = await async_views.download_file(self.request('get', '/', self.owner), uploaded_file.id)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(body, b"async content")
+
+        # ranges are served from the async stream as well
+        response = await async_views.download_file(self.request('get', '/', self.owner, headers={'Range': 'bytes=6-'}), uploaded_file.id)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), b"content")
+
+    async def test_share_then_delete(self):
+        uploaded_file = await self.upload(b"shared async content")
+
+        # not shared yet
+        with self.assertRaises(Http404):
+            await async_views.download_file(self.request('get', '/', self.friend), uploaded_file.id)
+
+        request = self.request('post', '/', self.owner, data={'share_with': 'friend'})
+        response = await async_views.share_file(request, uploaded_file.id)
+        self.assertEqual(response.status_code, 302)
+
+        response = await async_views.download_file(self.request('get', '/', self.friend), uploaded_file.id)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        await async_views.delete_file(self.request('post', '/', self.owner), uploaded_file.id)
+        self.assertFalse(await UploadedFile.objects.aexists())
+        # the file itself goes once the delete is committed
+        self.assertFalse(await Blob.objects.aexists())
+
+
+
+'''
+The following section covers bulk sharing.
+Many files are shared with many users and groups in a fixed number of queries,
+and every file, user and group gets its own result.
+'''
+class BulkShareTest(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='12345')
+        self.stranger = User.objects.create_user(username='stranger', password='12345')
+        self.team = Group.objects.create(name='data team')
+        self.users = [User.objects.create_user(username=f'user{n}', password='12345') for n in range(20)]
+        for user in self.users[10:]:
+            user.groups.add(self.team)
+
+        self.files = [UploadedFile.objects.create(user=self.owner, file_url=f'/media/f{n}.txt') for n in range(30)]
+        self.foreign_file = UploadedFile.objects.create(user=self.stranger, file_url='/media/theirs.txt')
+
+        self.client = Client()
+        self.client.login(username='owner', password='12345')
+
+    def test_fixed_number_of_queries(self):
+        file_ids = [file.id for file in self.files[:15]]
+        usernames = [user.username for user in self.users[:10]]
+
+        # files, users and group members, groups, one insert each for the user
+        # shares, the group shares and the 300 access pairs, and the savepoint
+        # pair around them (a transaction outside of tests)
+        with self.assertNumQueries(8):
+            results = bulk_share(self.owner, file_ids, usernames, ['data team'])
+
+        self.assertEqual(results['pairs'], 15 * 20)
+        self.assertEqual(SharedFile.objects.count(), 15 * 10)
+        self.assertEqual(GroupShare.objects.count(), 15)
+        self.assertEqual(FileAccess.objects.count(), 15 * 20)
+        self.assertEqual(results['groups'], {'data team': 'shared with 10 users'})
+
+    def test_per_item_results(self):
+        response = self.client.post(
+            '/mainapp/api/share/',
+            {'file_ids': [self.files[0].id, self.foreign_file.id], 'usernames': ['user0', 'nobody'], 'groups': ['ghosts']},
+            content_type='application/json',
+        )
+        results = response.json()
+
+        self.assertEqual(results['files'], {str(self.files[0].id): 'shared', str(self.foreign_file.id): 'not found'})
+        self.assertEqual(results['users'], {'nobody': 'not found', 'user0': 'shared'})
+        self.assertEqual(results['groups'], {'ghosts': 'not found'})
+
+        # files of other users are never shared
+        self.assertFalse(self.foreign_file.shared_with.exists())
+
+    def test_malformed_requests_rejected(self):
+        for body in (
+            {'file_ids': [self.files[0].id], 'usernames': 'user1'},
+            {'file_ids': str(self.files[0].id), 'usernames': ['user1']},
+            {'file_ids': [10 ** 20], 'usernames': ['user1']},
+            {'file_ids': [[1]], 'usernames': ['user1']},
+        ):
+            response = self.client.post('/mainapp/api/share/', body, content_type='application/json')
+            self.assertEqual(response.status_code, 400, body)
+        self.assertFalse(self.files[0].shared_with.exists())
+
+        response = self.client.post('/mainapp/share/bulk/', {'file_ids': '9' * 20, 'usernames': 'user1'})
+        self.assertContains(response, 'File ids must be positive numbers')
+
+    def test_repeated_share_is_harmless(self):
+        self.client.post('/mainapp/share/bulk/', {'file_ids': f'{self.files[0].id}', 'usernames': 'user1, user2'})
+        response = self.client.post('/mainapp/share/bulk/', {'file_ids': f'{self.files[0].id}', 'usernames': 'user1 user2'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'User user2: shared')
+        self.assertEqual(self.files[0].shared_with.count(), 2)
+
+
+'''
+Files can be shared with a group (team). Members get access through the group,
+including members who join later, and the effective access index (FileAccess)
+is kept in step so the shared listing and the download check stay one lookup.
+'''
+class GroupSharingTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user(username='owner', password='12345')
+        self.member = User.objects.create_user(username='member', password='12345')
+        self.team = Group.objects.create(name='team')
+        self.member.groups.add(self.team)
+        self.file = UploadedFile.objects.create(user=self.owner, file_url='/media/team.txt', name='team.txt')
+
+        self.client = Client()
+        self.client.login(username='member', password='12345')
+
+    def can_access(self, user):
+        return UploadedFile.objects.accessible_by(user).filter(pk=self.file.pk).exists()
+
+    def test_share_with_group_form(self):
+        owner_client = Client()
+        owner_client.login(username='owner', password='12345')
+        response = owner_client.post(f'/mainapp/share/{self.file.id}/', {'share_with_group': 'team'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(self.can_access(self.member))
+        self.assertContains(self.client.get('/mainapp/upload/'), 'team.txt')
+
+    def test_only_owner_shares_with_group(self):
+        response = self.client.post(f'/mainapp/share/{self.file.id}/', {'share_with_group': 'team'})
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(self.file.shared_with_groups.exists())
+        self.assertFalse(self.can_access(self.member))
+
+    def test_membership_changes(self):
+        self.file.shared_with_groups.add(self.team)
+        newcomer = User.objects.create_user(username='newcomer', password='12345')
+
+        # joining grants access, leaving takes it away
+        self.team.user_set.add(newcomer)
+        self.assertTrue(self.can_access(newcomer))
+        newcomer.groups.remove(self.team)
+        self.assertFalse(self.can_access(newcomer))
+
+        # a direct share keeps access when the group goes away
+        self.file.shared_with.add(self.member)
+        self.team.delete()
+        self.assertTrue(self.can_access(self.member))
+        self.file.shared_with.clear()
+        self.assertFalse(self.can_access(self.member))
+
+    def test_unsharing_group(self):
+        self.file.shared_with_groups.add(self.team)
+        self.file.shared_with_groups.remove(self.team)
+        self.assertFalse(self.can_access(self.member))
+        self.assertEqual(FileAccess.objects.count(), 0)
+
+    def test_lookups_use_the_index(self):
+        self.file.shared_with_groups.add(self.team)
+        for n in range(30):
+            group = Group.objects.create(name=f'group{n}')
+            self.member.groups.add(group)
+
+        # however many groups, the check is one query and touches no group tables
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.can_access(self.member))
+            list(UploadedFile.objects.shared_with_user(self.member))
+        self.assertEqual(len(queries), 2)
+        for query in queries:
+            self.assertIn('mainapp_fileaccess', query['sql'])
+            self.assertNotIn('auth_user_groups', query['sql'])
+
+    def test_rebuild_command(self):
+        self.file.shared_with_groups.add(self.team)
+        FileAccess.objects.all().delete()
+
+        call_command('rebuild_access_index', stdout=io.StringIO())
+        self.assertTrue(self.can_access(self.member))
+
+
+'''
+The integrity scrubber re-hashes stored files and compares them with the
+file_hash recorded at upload, so files damaged or lost on disk are found
+without anyone downloading them. A time-boxed run resumes from its checkpoint.
+'''
+class IntegrityScrubTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.checkpoint = os.path.join(self.media_root, 'checkpoint.json')
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.files = [store_upload(self.user, ContentFile(f'content {n}'.encode()), f'{n}.txt') for n in range(4)]
+
+    def test_reports_corrupted_and_missing(self):
+        with open(os.path.join(self.media_root, self.files[1].blob.name), 'wb') as damaged:
+            damaged.write(b'flipped bits')
+        os.remove(os.path.join(self.media_root, self.files[2].blob.name))
+
+        report = scrub(self.checkpoint, workers=2, rate=0)
+
+        self.assertTrue(report.complete)
+        self.assertEqual(report.checked, 3)
+        self.assertEqual(report.corrupted, [('blob', self.files[1].blob_id, self.files[1].blob.name)])
+        self.assertEqual(report.missing, [('blob', self.files[2].blob_id, self.files[2].blob.name)])
+
+    def test_checks_files_stored_before_blobs(self):
+        with open(os.path.join(self.media_root, 'legacy.txt'), 'wb') as legacy:
+            legacy.write(b'legacy content')
+        UploadedFile.objects.create(
+            user=self.user, file_url='/media/legacy.txt', file_hash=hashlib.sha256(b'other content').hexdigest()
+        )
+
+        report = scrub(self.checkpoint, workers=1, rate=0)
+        self.assertEqual(report.checked, 5)
+        self.assertEqual([kind for kind, pk, name in report.corrupted], ['file'])
+
+    def test_resumes_from_checkpoint(self):
+        # a run out of time stops after its first batch of three
+        with patch('mainapp.scrub.BATCH_SIZE', 3):
+            first = scrub(self.checkpoint, workers=1, rate=0, max_seconds=0)
+            self.assertFalse(first.complete)
+            self.assertEqual(first.checked, 3)
+
+            # the next run picks up the remaining file
+            second = scrub(self.checkpoint, workers=1, rate=0)
+            self.assertEqual(second.checked, 1)
+            self.assertTrue(second.complete)
+
+    def test_command_output(self):
+        out = io.StringIO()
+        call_command('scrub_files', checkpoint=self.checkpoint, workers=1, stdout=out, stderr=io.StringIO())
+        self.assertIn('Checked 4 files', out.getvalue())
+        self.assertIn('GB/min', out.getvalue())
+
+
+'''
+Uploads are hashed block by block in a thread pool: file_hash stays the plain
+SHA-256 of the content, and the blob also gets a fast fingerprint with the
+name of the algorithm that made it.
+'''
+class ContentHashingTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.content = os.urandom(10000)
+
+    def test_digests_match_reference(self):
+        with patch('mainapp.hashing.TREE_BLOCK_SIZE', 4096):
+            hasher = ContentHasher('sha256-tree')
+        # pieces of uneven sizes, across block boundaries
+        for start in range(0, len(self.content), 3000):
+            hasher.update(self.content[start:start + 3000])
+
+        leaves = [hashlib.sha256(self.content[start:start + 4096]).digest() for start in range(0, 10000, 4096)]
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(hasher.fingerprint(), ('sha256-tree', tree_root(leaves, 4096)))
+
+    def test_upload_stores_fingerprint(self):
+        self.client.login(username='testuser', password='12345')
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile('data.bin', self.content)})
+
+        blob = UploadedFile.objects.get().blob
+        self.assertEqual(blob.file_hash, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(blob.fingerprint_algorithm, 'sha256-tree')
+        # smaller than a block, so the tree has a single leaf
+        self.assertEqual(blob.fingerprint, tree_root([hashlib.sha256(self.content).digest()], 4 * 1024 * 1024))
+
+    @override_settings(FILE_FINGERPRINT=None)
+    def test_fingerprint_disabled(self):
+        uploaded_file = store_upload(self.user, ContentFile(self.content), 'data.bin')
+        self.assertEqual(uploaded_file.blob.fingerprint, '')
+        self.assertEqual(uploaded_file.file_hash, hashlib.sha256(self.content).hexdigest())
+
+    def test_unavailable_algorithm(self):
+        with patch('mainapp.hashing.blake3', None):
+            self.assertRaises(ValueError, ContentHasher, 'blake3')
+
+
+'''
+Every stored content keeps a manifest of per-block SHA-256 digests, so the
+integrity checks can name the damaged byte ranges and an edited file can be
+re-uploaded by sending only the blocks that changed.
+'''
+@override_settings(UPLOAD_CHUNK_SIZE_MIN=4)
+class BlockManifestTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # blocks of 8 bytes instead of 4 MiB
+        block_size_patch = patch('mainapp.hashing.TREE_BLOCK_SIZE', 8)
+        block_size_patch.start()
+        self.addCleanup(block_size_patch.stop)
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client.login(username='testuser', password='12345')
+        self.content = b'block0..block1..block2..'
+        self.uploaded_file = store_upload(self.user, ContentFile(self.content), 'disk.img')
+
+    def block_hashes(self, content):
+        return [hashlib.sha256(content[start:start + 8]).hexdigest() for start in range(0, len(content), 8)]
+
+    def test_manifest_api(self):
+        response = self.client.get(f'/mainapp/api/files/{self.uploaded_file.id}/manifest/')
+        self.assertEqual(response.json()['block_size'], 8)
+        self.assertEqual(response.json()['blocks'], self.block_hashes(self.content))
+
+    def test_damaged_ranges(self):
+        with open(os.path.join(self.media_root, self.uploaded_file.blob.name), 'r+b') as stored:
+            stored.seek(10)
+            stored.write(b'X')
+
+        # only the requested block is read
+        self.assertEqual(damaged_blocks(self.uploaded_file.blob, [0]), [])
+        report = scrub(os.path.join(self.media_root, 'checkpoint.json'), workers=1, rate=0)
+        self.assertEqual(report.damaged_ranges, {self.uploaded_file.blob_id: [(1, 8, 16)]})
+
+    def test_delta_reupload(self):
+        edited = b'block0..EDITED..block2..'
+        session = self.client.post(
+            '/mainapp/api/uploads/', {'name': 'disk.img', 'size': len(edited), 'chunk_size': 8},
+            content_type='application/json',
+        ).json()
+        base = f"/mainapp/api/uploads/{session['id']}/"
+
+        response = self.client.post(f'{base}reuse/', {'blocks': self.block_hashes(edited)}, content_type='application/json')
+        self.assertEqual(response.json()['reused'], [0, 2])
+        self.assertEqual(response.json()['missing'], [1])
+
+        # only the changed block is sent
+        self.client.put(f'{base}chunks/1/', edited[8:16], content_type='application/octet-stream')
+        response = self.client.post(f'{base}complete/')
+        self.assertEqual(response.json()['hash'], hashlib.sha256(edited).hexdigest())
+
+    def test_reuse_needs_access(self):
+        other = User.objects.create_user(username='other', password='12345')
+        self.client.login(username='other', password='12345')
+        session = self.client.post(
+            '/mainapp/api/uploads/', {'name': 'copy.img', 'size': len(self.content), 'chunk_size': 8},
+            content_type='application/json',
+        ).json()
+
+        response = self.client.post(
+            f"/mainapp/api/uploads/{session['id']}/reuse/", {'blocks': self.block_hashes(self.content)},
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['reused'], [])
+        self.assertEqual(self.client.get(f'/mainapp/api/files/{self.uploaded_file.id}/manifest/').status_code, 404)
+
+
+'''
+The dashboard listings and their rendered fragments are cached per user, and
+every upload, delete and share gives exactly the affected users a fresh cache.
+'''
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'listings': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'listing-test'},
+})
+class ListingCacheTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        listing_cache().clear()
+        self.addCleanup(listing_cache().clear)
+        self.owner = User.objects.create_user(username='owner', password='12345')
+        self.friend = User.objects.create_user(username='friend', password='12345')
+        self.bystander = User.objects.create_user(username='bystander', password='12345')
+        self.client.login(username='owner', password='12345')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.file = UploadedFile.objects.create(user=self.owner, file_url='/media/a.txt', name='a.txt')
+
+    def test_repeat_visit_is_served_from_cache(self):
+        self.client.get('/mainapp/upload/')
+        hits = listing_stats['fragment_hits']
+
+        # only the session and the user are loaded
+        with self.assertNumQueries(2):
+            response = self.client.get('/mainapp/upload/')
+        self.assertContains(response, 'a.txt')
+        self.assertEqual(listing_stats['fragment_hits'], hits + 2)
+
+    def test_upload_and_delete_invalidate(self):
+        self.client.get('/mainapp/upload/')
+        with self.captureOnCommitCallbacks(execute=True):
+            UploadedFile.objects.create(user=self.owner, file_url='/media/b.txt', name='b.txt')
+        self.assertContains(self.client.get('/mainapp/upload/'), 'b.txt')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.file.delete()
+        self.assertNotContains(self.client.get('/mainapp/upload/'), 'a.txt')
+
+    def test_share_invalidates_only_recipients(self):
+        friend_version = listing_version(self.friend.id)
+        bystander_version = listing_version(self.bystander.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.file.shared_with.add(self.friend)
+
+        self.assertNotEqual(listing_version(self.friend.id), friend_version)
+        self.assertEqual(listing_version(self.bystander.id), bystander_version)
+
+        # deleting the file drops it from the recipient's cached listing too
+        self.client.login(username='friend', password='12345')
+        self.assertContains(self.client.get('/mainapp/upload/'), 'Shared by: owner')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.file.delete()
+        self.assertNotContains(self.client.get('/mainapp/upload/'), 'Shared by: owner')
+
+    def test_hit_rate_stats(self):
+        self.assertEqual(self.client.get('/mainapp/api/cache/stats/').status_code, 404)
+
+        self.owner.is_staff = True
+        self.owner.save()
+        stats = self.client.get('/mainapp/api/cache/stats/').json()
+        self.assertEqual(set(stats), {'data', 'fragment'})
+        self.assertIn('hit_rate', stats['fragment'])
+
+
+'''
+Every file records its size, and per-user usage counters follow uploads and
+deletes. Uploads over the storage quota are refused while they are received,
+before they are written to disk.
+'''
+@override_settings(STORAGE_QUOTA=100 * 1024, UPLOAD_CHUNK_SIZE_MIN=4)
+class StorageQuotaTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client.login(username='testuser', password='12345')
+
+    def usage(self):
+        return UserUsage.objects.filter(user=self.user).values_list('bytes_used', 'file_count').first()
+
+    def test_usage_follows_uploads_and_deletes(self):
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile('a.txt', b'x' * 30 * 1024)})
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile('b.txt', b'y' * 20 * 1024)})
+        self.assertEqual(UploadedFile.objects.get(name='a.txt').size, 30 * 1024)
+        self.assertEqual(self.usage(), (50 * 1024, 2))
+
+        self.client.get(f"/mainapp/delete/{UploadedFile.objects.get(name='a.txt').id}/")
+        self.assertEqual(self.usage(), (20 * 1024, 1))
+        self.assertEqual(self.client.get('/mainapp/api/usage/').json(), {'bytes_used': 20 * 1024, 'file_count': 1, 'quota': 100 * 1024})
+
+    def test_upload_over_quota_is_refused(self):
+        response = self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile('big.bin', b'z' * 200 * 1024)})
+
+        self.assertEqual(response.status_code, 413)
+        self.assertContains(response, 'storage quota', status_code=413)
+        self.assertFalse(UploadedFile.objects.exists())
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'blobs')))
+
+    def test_content_written_before_quota_lock(self):
+        # the usage row is only locked once the bytes are on disk
+        incoming = os.path.join(self.media_root, 'incoming')
+        written = []
+
+        def refuse(user_id, size):
+            written.extend(os.listdir(incoming))
+            raise QuotaExceeded('no room')
+
+        with patch('mainapp.uploads.check_quota', refuse), self.assertRaises(QuotaExceeded):
+            store_upload(self.user, ContentFile(b'late refusal'), 'a.txt')
+        self.assertEqual(len(written), 1)
+        # what was written for the refused upload is removed again
+        self.assertEqual(os.listdir(incoming), [])
+        self.assertFalse(Blob.objects.exists())
+
+    def test_stopped_while_streaming(self):
+        # no usable Content-Length, as with a chunked request body
+        handler = QuotaUploadHandler(RequestFactory().post('/'))
+        handler.request.user = self.user
+        handler.handle_raw_input(None, {}, 0, b'', None)
+        handler.new_file('document', 'big.bin', 'application/octet-stream', None)
+
+        handler.receive_data_chunk(b'z' * 60 * 1024, 0)
+        with self.assertRaises(StopUpload):
+            handler.receive_data_chunk(b'z' * 60 * 1024, 60 * 1024)
+
+    def test_personal_quota_and_sessions(self):
+        UserUsage.objects.create(user=self.user, quota=1000 * 1024)
+        response = self.client.post(
+            '/mainapp/api/uploads/', {'name': 'big.iso', 'size': 500 * 1024}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client.post(
+            '/mainapp/api/uploads/', {'name': 'huge.iso', 'size': 5000 * 1024}, content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 413)
+
+
+'''
+Deleting a file reclaims its bytes, also for files stored before the blob
+store. collect_orphans removes the files nothing references any more, and
+leaves referenced and recently written files alone.
+'''
+class OrphanCollectionTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client.login(username='testuser', password='12345')
+
+    def write(self, name, age=2 * 60 * 60):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as stored:
+            stored.write(name.encode())
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_delete_removes_legacy_file(self):
+        path = self.write('legacy.txt')
+        legacy = UploadedFile.objects.create(user=self.user, file_url='/media/legacy.txt')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(f'/mainapp/delete/{legacy.id}/')
+        self.assertFalse(os.path.exists(path))
+
+    def test_collects_only_old_unreferenced_files(self):
+        kept = store_upload(self.user, ContentFile(b'kept content'), 'kept.txt')
+        os.utime(os.path.join(self.media_root, kept.blob.name), (0, 0))
+        legacy = self.write('legacy.txt')
+        UploadedFile.objects.create(user=self.user, file_url='/media/legacy.txt')
+        orphans = [self.write('deleted.txt'), self.write('deleted_AbCdEf1.txt'), self.write('incoming/0123abcd')]
+        fresh = self.write('blobs/' + '0' * 64, age=0)
+        chunk = self.write('chunks/session/0')
+
+        # batches of two so several database lookups are needed
+        with patch('mainapp.orphans.BATCH_SIZE', 2):
+            preview = collect_orphans(dry_run=True)
+            self.assertEqual((preview.orphans, preview.removed), (3, 0))
+            self.assertTrue(all(os.path.exists(path) for path in orphans))
+
+            report = collect_orphans()
+        self.assertEqual(report.scanned, 6)
+        self.assertEqual(report.removed, 3)
+        self.assertFalse(any(os.path.exists(path) for path in orphans))
+        self.assertTrue(all(os.path.exists(path) for path in (legacy, fresh, chunk)))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, kept.blob.name)))
+
+    def test_file_adopted_after_the_check_is_kept(self):
+        name = 'blobs/' + '1' * 64
+        path = self.write(name)
+        scanned = os.stat(path)
+        # an upload of the same content claims the file after its batch was checked
+        Blob.objects.create(file_hash='1' * 64, name=name, ref_count=1)
+
+        self.assertFalse(remove_orphan(name, path, scanned))
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(f'{path}.orphan'))
+
+    def test_command_output(self):
+        self.write('deleted.txt')
+        out = io.StringIO()
+        call_command('collect_orphans', stdout=out)
+        self.assertIn('Scanned 1 files. Removed 1 of 1 orphans', out.getvalue())
+
+
+'''
+Blobs are spread over two levels of hash-prefixed directories. shard_media
+moves blobs stored flat and files from before the blob store into that
+layout and rewrites their file_url.
+'''
+class ShardedLayoutTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+
+    def write(self, name, content):
+        with open(os.path.join(self.media_root, name), 'wb') as stored:
+            stored.write(content)
+
+    def test_new_blobs_are_sharded(self):
+        uploaded_file = store_upload(self.user, ContentFile(b'sharded content'), 'a.txt')
+        file_hash = hashlib.sha256(b'sharded content').hexdigest()
+
+        self.assertEqual(uploaded_file.blob.name, f'blobs/{file_hash[:2]}/{file_hash[2:4]}/{file_hash}')
+        self.assertEqual(uploaded_file.file_url, f'/media/{uploaded_file.blob.name}')
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, uploaded_file.blob.name)))
+
+    def test_moves_flat_blobs_and_legacy_files(self):
+        flat = store_upload(self.user, ContentFile(b'flat content'), 'flat.txt')
+        sharded_name = flat.blob.name
+        os.makedirs(os.path.join(self.media_root, 'blobs'), exist_ok=True)
+        os.rename(os.path.join(self.media_root, sharded_name), os.path.join(self.media_root, f'blobs/{flat.file_hash}'))
+        Blob.objects.filter(pk=flat.blob_id).update(name=f'blobs/{flat.file_hash}')
+        UploadedFile.objects.filter(pk=flat.pk).update(file_url=f'/media/blobs/{flat.file_hash}')
+
+        self.write('legacy.txt', b'legacy content')
+        legacy = UploadedFile.objects.create(
+            user=self.user, file_url='/media/legacy.txt', file_hash=hashlib.sha256(b'legacy content').hexdigest(),
+        )
+        # same bytes as a stored blob; the legacy copy is dropped
+        self.write('duplicate.txt', b'flat content')
+        duplicate = UploadedFile.objects.create(user=self.user, file_url='/media/duplicate.txt')
+        self.write('damaged.txt', b'flipped bits')
+        damaged = UploadedFile.objects.create(
+            user=self.user, file_url='/media/damaged.txt', file_hash=hashlib.sha256(b'original').hexdigest(),
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            report = shard_media()
+
+        self.assertEqual((report.blobs_moved, report.files_adopted), (1, 2))
+        self.assertEqual(report.mismatched, [(damaged.id, 'damaged.txt')])
+        flat.refresh_from_db()
+        self.assertEqual(flat.file_url, f'/media/{sharded_name}')
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, sharded_name)))
+
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.name, 'legacy.txt')
+        self.assertEqual(legacy.size, len(b'legacy content'))
+        with open(os.path.join(self.media_root, legacy.blob.name), 'rb') as stored:
+            self.assertEqual(stored.read(), b'legacy content')
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'legacy.txt')))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'duplicate.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'damaged.txt')))
+
+        duplicate.refresh_from_db()
+        self.assertEqual(duplicate.blob_id, flat.blob_id)
+        self.assertEqual(bytes(duplicate.file_digest), bytes.fromhex(flat.file_hash))
+        self.assertEqual(Blob.objects.get(pk=flat.blob_id).ref_count, 2)
+        self.assertEqual(UserUsage.objects.get(user=self.user).bytes_used, 2 * len(b'flat content') + len(b'legacy content'))
+
+        # a second run has nothing left to do
+        self.assertEqual(shard_media().blobs_moved, 0)
+
+
+
+# tasks for TaskQueueTest; failures lists the attempts still to fail
+failures = []
+
+
+@tasks.task(queue='test', max_attempts=2)
+def flaky_task(value):
+    if failures:
+        failures.pop()
+        raise RuntimeError('flaky')
+
+
+'''
+Work after an upload runs in background workers fed by a task queue in the
+database. Uploads return once the file is stored and its processing task is
+queued; processing_status follows the task. Failed tasks are retried with
+backoff, and every queue has a concurrency limit.
+'''
+@override_settings(TASK_QUEUES={'uploads': 4, 'test': 1})
+class TaskQueueTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client.login(username='testuser', password='12345')
+
+    def status(self, uploaded_file):
+        return self.client.get(f'/mainapp/api/files/{uploaded_file.id}/status/').json()['processing_status']
+
+    def test_upload_is_processed_in_background(self):
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile('a.txt', b'processed later')})
+        uploaded_file = UploadedFile.objects.get()
+        self.assertEqual(self.status(uploaded_file), 'pending')
+        self.assertEqual(Task.objects.get().name, 'mainapp.processing.process_upload')
+
+        out = io.StringIO()
+        call_command('run_tasks', burst=True, stdout=out)
+        self.assertIn('Ran 1 tasks', out.getvalue())
+        self.assertEqual(self.status(uploaded_file), 'processed')
+        self.assertFalse(Task.objects.exists())
+
+    def test_damaged_upload_fails_without_retry(self):
+        uploaded_file = store_upload(self.user, ContentFile(b'original bytes'), 'a.txt')
+        with open(os.path.join(self.media_root, uploaded_file.blob.name), 'wb') as damaged:
+            damaged.write(b'flipped bytes!')
+
+        with self.assertLogs('mainapp.tasks', 'ERROR'):
+            self.assertEqual(tasks.run_pending(), 1)
+        self.assertEqual(self.status(uploaded_file), 'failed')
+        task = Task.objects.get()
+        self.assertEqual((task.status, task.attempts), (Task.FAILED, 1))
+        self.assertIn('does not match', task.error)
+
+    def test_retries_with_backoff(self):
+        failures[:] = [1, 1]
+        task = tasks.enqueue(flaky_task, 'x')
+
+        with self.assertLogs('mainapp.tasks', 'ERROR'):
+            self.assertEqual(tasks.run_pending(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.QUEUED, 1))
+        self.assertGreater(task.run_after, timezone.now())
+        # not due yet
+        self.assertEqual(tasks.run_pending(), 0)
+
+        Task.objects.update(run_after=timezone.now())
+        with self.assertLogs('mainapp.tasks', 'ERROR'):
+            tasks.run_pending()
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.FAILED, 2))
+
+    def test_concurrency_limit_and_expired_leases(self):
+        first = tasks.enqueue(flaky_task, 1)
+        tasks.enqueue(flaky_task, 2)
+
+        stale = tasks.claim(['test'])
+        self.assertEqual(stale, first)
+        # the queue's only slot is taken
+        self.assertIsNone(tasks.claim(['test']))
+
+        # the worker holding it stopped; once the lease is over the task runs again
+        Task.objects.filter(pk=first.pk).update(lease_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(tasks.claim(['test']), first)
+        self.assertEqual(Task.objects.get(pk=first.pk).attempts, 2)
+
+        # the first worker finishing late leaves the task to the second one
+        tasks.run(stale)
+        self.assertEqual(Task.objects.get(pk=first.pk).status, Task.RUNNING)
+
+    def test_expired_last_attempt_runs_failure_hook(self):
+        uploaded_file = store_upload(self.user, ContentFile(b'worker died'), 'a.txt')
+        task = Task.objects.get()
+        Task.objects.filter(pk=task.pk).update(
+            status=Task.RUNNING, slot=0, attempts=task.max_attempts, lease_until=timezone.now() - timedelta(seconds=1),
+        )
+        UploadedFile.objects.filter(pk=uploaded_file.pk).update(processing_status='processing')
+
+        self.assertEqual(tasks.run_pending(), 0)
+        self.assertEqual(Task.objects.get().status, Task.FAILED)
+        self.assertEqual(self.status(uploaded_file), 'failed')
+
+
+
+'''
+With STORAGE_COMPRESSION uploads that compress well are stored compressed,
+while file_hash stays the hash of the original bytes. Downloads decompress on
+the fly, or pass the stored bytes through to clients accepting the encoding.
+'''
+@override_settings(STORAGE_COMPRESSION='gzip')
+class CompressedStorageTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client.login(username='testuser', password='12345')
+        self.content = b''.join(b'2024-01-01 12:00:%02d INFO request served\n' % (n % 60) for n in range(5000))
+
+    def stored_size(self, uploaded_file):
+        return os.path.getsize(os.path.join(self.media_root, uploaded_file.blob.name))
+
+    def test_compressible_uploads_are_compressed(self):
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile('app.log', self.content)})
+        log = UploadedFile.objects.get()
+        self.assertEqual(log.blob.encoding, 'gzip')
+        self.assertEqual(log.file_hash, hashlib.sha256(self.content).hexdigest())
+        self.assertLess(self.stored_size(log), len(self.content) / 10)
+
+        # already compressed or random content is stored as it is
+        packed = store_upload(self.user, ContentFile(gzip.compress(self.content)), 'app.log.gz')
+        noise = store_upload(self.user, ContentFile(os.urandom(100000)), 'noise.bin')
+        self.assertEqual((packed.blob.encoding, noise.blob.encoding), ('', ''))
+        self.assertEqual(self.stored_size(noise), 100000)
+
+    def test_content_is_read_once(self):
+        content = ContentFile(self.content)
+        with patch.object(content, 'chunks', wraps=content.chunks) as chunks:
+            log = store_upload(self.user, content, 'app.log')
+        self.assertEqual(chunks.call_count, 1)
+        self.assertEqual((log.blob.encoding, log.file_hash), ('gzip', hashlib.sha256(self.content).hexdigest()))
+
+        # the same content again only adds a reference
+        again = store_upload(self.user, ContentFile(self.content), 'again.log')
+        self.assertEqual(again.blob_id, log.blob_id)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'incoming')), [])
+
+    def test_download_decompresses_or_passes_through(self):
+        log = store_upload(self.user, ContentFile(self.content), 'app.log')
+        self.assertEqual(log.blob.encoding, 'gzip')
+
+        response = self.client.get(f'/mainapp/download/{log.id}/')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(int(response['Content-Length']), len(self.content))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        response = self.client.get(f'/mainapp/download/{log.id}/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(int(response['Content-Length']), self.stored_size(log))
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.content)
+
+    def test_integrity_checks_see_original_bytes(self):
+        log = store_upload(self.user, ContentFile(self.content), 'app.log')
+        self.assertEqual(tasks.run_pending(), 1)
+        self.assertEqual(UploadedFile.objects.get().processing_status, 'processed')
+        self.assertEqual(scrub(os.path.join(self.media_root, 'checkpoint.json'), workers=1, rate=0).corrupted, [])
+
+        with open(os.path.join(self.media_root, log.blob.name), 'r+b') as stored:
+            stored.seek(self.stored_size(log) // 2)
+            stored.write(b'\x00' * 16)
+        report = scrub(os.path.join(self.media_root, 'checkpoint.json'), workers=1, rate=0)
+        self.assertEqual(report.corrupted, [('blob', log.blob_id, log.blob.name)])
+        self.assertEqual(report.damaged_ranges[log.blob_id], [(0, 0, 4 * 1024 * 1024)])
+
+
+'''
+Logged in requests take the user from a per-process cache instead of the
+database, until the user is saved or deleted; the cache needs a default cache
+shared between processes. Login attempts are rate limited per client address
+and per username, before the password is checked.
+'''
+@override_settings(
+    SESSION_ENGINE='django.contrib.sessions.backends.cached_db',
+    LOGIN_RATE_LIMITS={'address': (5, 60), 'username': (3, 60)},
+    TRUSTED_PROXIES=['127.0.0.1'],
+)
+class AuthHotPathTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.settings_override = override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': cache_dir},
+            'listings': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+            'ratelimit': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ratelimit-test'},
+        })
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.addCleanup(caches['ratelimit'].clear)
+
+    def user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/mainapp/api/usage/')
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries if 'auth_user' in query['sql'] or 'django_session' in query['sql']]
+
+    def test_user_and_session_come_from_cache(self):
+        self.client.login(username='testuser', password='12345')
+        self.assertTrue(self.user_queries())
+        self.assertEqual(self.user_queries(), [])
+
+        # a saved user is loaded again
+        self.user.first_name = 'Test'
+        self.user.save()
+        self.assertTrue(self.user_queries())
+
+    def test_local_memory_cache_keeps_no_users(self):
+        local = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'auth-local'}
+        with override_settings(CACHES={**settings.CACHES, 'default': local}):
+            self.client.login(username='testuser', password='12345')
+            self.user_queries()
+            self.assertTrue(self.user_queries())
+
+    def test_password_change_and_deactivation_log_out(self):
+        self.client.login(username='testuser', password='12345')
+        self.user_queries()
+
+        self.user.set_password('54321')
+        self.user.save()
+        self.assertEqual(self.client.get('/mainapp/api/usage/').status_code, 302)
+
+        self.client.login(username='testuser', password='54321')
+        self.user_queries()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/mainapp/api/usage/').status_code, 302)
+
+    # every client comes through the proxy at 127.0.0.1
+    def login(self, username, password, address='10.0.0.1'):
+        return self.client.post(
+            '/mainapp/login/', {'username': username, 'password': password},
+            REMOTE_ADDR='127.0.0.1', HTTP_X_FORWARDED_FOR=f'203.0.113.9, {address}',
+        )
+
+    def test_login_attempts_are_limited_before_hashing(self):
+        with patch('mainapp.views.authenticate', wraps=authenticate) as checked:
+            for _ in range(3):
+                self.assertEqual(self.login('testuser', 'wrong').status_code, 200)
+            response = self.login('testuser', '12345')
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response)
+            self.assertEqual(checked.call_count, 3)
+
+            # the limit per address covers other usernames, but not other clients
+            self.assertEqual(self.login('someone', 'wrong').status_code, 200)
+            self.assertEqual(self.login('someone', 'wrong').status_code, 429)
+            self.assertEqual(self.login('someone', 'wrong', address='10.0.0.2').status_code, 200)
+            self.assertEqual(checked.call_count, 5)
+
+    def test_client_address_behind_proxies(self):
+        factory = RequestFactory()
+        forwarded = {'HTTP_X_FORWARDED_FOR': '198.51.100.7, 10.0.0.5, 127.0.0.1'}
+        self.assertEqual(client_address(factory.get('/', REMOTE_ADDR='192.0.2.1', **forwarded)), '192.0.2.1')
+        self.assertEqual(client_address(factory.get('/', REMOTE_ADDR='127.0.0.1', **forwarded)), '10.0.0.5')
+        self.assertEqual(client_address(factory.get('/', REMOTE_ADDR='127.0.0.1')), '127.0.0.1')
+
+    def test_successful_login_resets_username_attempts(self):
+        for _ in range(2):
+            self.login('testuser', 'wrong')
+        self.assertEqual(self.login('testuser', '12345').status_code, 302)
+        self.client.logout()
+        self.assertEqual(self.login('testuser', 'wrong', address='10.0.0.2').status_code, 200)
+        self.assertEqual(self.login('testuser', '12345', address='10.0.0.2').status_code, 302)
+
+
+'''
+Every request is timed and its database queries are counted per view; uploads,
+downloads, hashing and disk writes add to byte counters. /metrics exposes them
+in the Prometheus text format to staff and scrapers with the token, and a
+sample of slow requests is profiled.
+'''
+@override_settings(METRICS_TOKEN='scrape-token')
+class MetricsTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.client.login(username='testuser', password='12345')
+
+    def scrape(self):
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        values = {}
+        for line in response.content.decode().splitlines():
+            if not line.startswith('#'):
+                name, _, value = line.rpartition(' ')
+                values[name] = float(value)
+        return values
+
+    def test_requests_queries_and_bytes_are_counted(self):
+        before = self.scrape()
+        self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile('a.txt', b'x' * 5000)})
+        uploaded = UploadedFile.objects.get()
+        self.client.get(f'/mainapp/download/{uploaded.id}/')
+        after = self.scrape()
+
+        def grown(name):
+            return after.get(name, 0) - before.get(name, 0)
+
+        self.assertEqual(grown('sharefile_http_requests_total{view="upload",method="POST",status="200"}'), 1)
+        self.assertEqual(grown('sharefile_http_request_duration_seconds_count{view="upload"}'), 1)
+        self.assertGreater(grown('sharefile_db_queries_total{view="upload"}'), 0)
+        self.assertGreater(grown('sharefile_db_query_seconds_total{view="upload"}'), 0)
+        self.assertEqual(grown('sharefile_uploaded_bytes_total'), 5000)
+        self.assertEqual(grown('sharefile_download_bytes_total{mode="stream"}'), 5000)
+        self.assertGreaterEqual(grown('sharefile_hash_bytes_total{algorithm="sha256"}'), 5000)
+        self.assertEqual(
+            after['sharefile_http_request_duration_seconds_bucket{view="upload",le="+Inf"}'],
+            after['sharefile_http_request_duration_seconds_count{view="upload"}'],
+        )
+
+    def test_unknown_methods_share_a_label(self):
+        self.client.generic('BREW', '/mainapp/upload/')
+        self.client.generic('FROBNICATE', '/mainapp/upload/')
+        labels = [name for name in self.scrape() if name.startswith('sharefile_http_requests_total')]
+        self.assertFalse([name for name in labels if 'BREW' in name or 'FROBNICATE' in name])
+        self.assertTrue([name for name in labels if 'method="other"' in name])
+
+    def test_only_scrapers_and_staff_see_metrics(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-token').status_code, 200)
+        with self.settings(METRICS_ALLOWED_ADDRESSES=['10.0.0.2'], TRUSTED_PROXIES=['127.0.0.1']):
+            self.assertEqual(self.client.get('/metrics', HTTP_X_FORWARDED_FOR='10.0.0.9').status_code, 404)
+            self.assertEqual(self.client.get('/metrics', HTTP_X_FORWARDED_FOR='10.0.0.2').status_code, 200)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.login(username='testuser', password='12345')
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.2').status_code, 200)
+
+    def test_slow_requests_are_profiled(self):
+        profiles = os.path.join(self.media_root, 'profiles')
+        with self.settings(METRICS_PROFILE_RATE=1, METRICS_PROFILE_SLOW=0, METRICS_PROFILE_DIR=profiles):
+            self.client.get('/mainapp/upload/')
+        [name] = os.listdir(profiles)
+        self.assertIn('-upload-', name)
+
+        with self.settings(METRICS_PROFILE_RATE=1, METRICS_PROFILE_SLOW=60, METRICS_PROFILE_DIR=profiles):
+            self.client.get('/mainapp/upload/')
+        self.assertEqual(len(os.listdir(profiles)), 1)
+
+
+'''
+With DATABASE_REPLICAS, listings and download access checks read from a
+replica, while a client that just wrote is pinned to the primary so it sees
+its own changes. The replica is a test mirror of the default database, so the
+test commits its data (TransactionTestCase) for the replica connection to see.
+'''
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(TempMediaMixin, TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.file = store_upload(self.user, ContentFile(b'replicated'), 'a.txt')
+        self.client.force_login(self.user)
+        self.client.cookies.pop('primary_until', None)
+
+    def replica_queries(self, path):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries]
+
+    def test_reads_go_to_the_replica(self):
+        listing = self.replica_queries('/mainapp/api/files/')
+        self.assertTrue(listing)
+        self.assertTrue(all('mainapp_uploadedfile' in sql for sql in listing))
+
+        download = self.replica_queries(f'/mainapp/download/{self.file.id}/')
+        self.assertEqual(len(download), 1)
+        self.assertIn('mainapp_fileaccess', download[0])
+
+    def test_writers_read_their_writes_from_the_primary(self):
+        response = self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile('b.txt', b'new')})
+        self.assertIn('primary_until', response.cookies)
+        self.assertEqual(self.replica_queries('/mainapp/api/files/'), [])
+        self.assertEqual(self.replica_queries(f'/mainapp/download/{self.file.id}/'), [])
+
+        # once the pin has run out, the replica is used again
+        self.client.cookies['primary_until'] = str(time.time() - 1)
+        self.assertTrue(self.replica_queries('/mainapp/api/files/'))
+
+    def test_without_replicas_everything_stays_on_the_primary(self):
+        with self.settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.replica_queries('/mainapp/api/files/'), [])
+            response = self.client.post('/mainapp/upload/', {'document': SimpleUploadedFile('b.txt', b'new')})
+        self.assertNotIn('primary_until', response.cookies)
+
+
+'''
+Several files download as one ZIP archive, streamed while it is written:
+a selection of owned and shared files, or everything shared with the user.
+Compressed content is stored as it is, the rest deflated; the whole
+selection is checked in one query.
+'''
+class ZipDownloadTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.other = User.objects.create_user(username='other', password='12345')
+        self.client.login(username='testuser', password='12345')
+
+        self.text = b'a line of text\n' * 2000
+        self.noise = os.urandom(50000)
+        self.notes = store_upload(self.user, ContentFile(self.text), 'notes.txt')
+        self.noise_file = store_upload(self.user, ContentFile(self.noise), 'noise.bin')
+        self.shared = store_upload(self.other, ContentFile(b'shared content'), 'notes.txt')
+        self.shared.shared_with.add(self.user)
+        self.private = store_upload(self.other, ContentFile(b'private'), 'private.txt')
+
+    def archive(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertTrue(response.streaming)
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_selection_is_streamed_as_zip(self):
+        ids = f'{self.notes.id},{self.noise_file.id},{self.shared.id}'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/mainapp/download/zip/', {'file_ids': ids})
+        self.assertEqual(len([query for query in queries if 'mainapp_uploadedfile' in query['sql']]), 1)
+
+        archive = self.archive(response)
+        self.assertEqual(sorted(archive.namelist()), ['noise.bin', 'notes.txt', 'other/notes.txt'])
+        self.assertEqual(archive.read('notes.txt'), self.text)
+        self.assertEqual(archive.read('noise.bin'), self.noise)
+        self.assertEqual(archive.read('other/notes.txt'), b'shared content')
+        self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.getinfo('noise.bin').compress_type, zipfile.ZIP_STORED)
+        self.assertIsNone(archive.testzip())
+
+    def test_inaccessible_files_are_not_found(self):
+        response = self.client.get('/mainapp/download/zip/', {'file_ids': [self.notes.id, self.private.id]})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get('/mainapp/download/zip/', {'file_ids': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/mainapp/download/zip/', {'file_ids': '9' * 20}).status_code, 400)
+
+    def test_everything_shared_with_the_user(self):
+        archive = self.archive(self.client.get('/mainapp/download/zip/', {'shared': 1}))
+        self.assertEqual(archive.namelist(), ['other/notes.txt'])
+
+    @override_settings(STORAGE_COMPRESSION='gzip')
+    def test_compressed_blobs_and_zip64_entries(self):
+        log = store_upload(self.user, ContentFile(self.text * 2), 'app.log')
+        self.assertEqual(log.blob.encoding, 'gzip')
+        # the archive is written while the response is read
+        with patch('mainapp.archives.ZIP64_THRESHOLD', 1000):
+            response = self.client.get('/mainapp/download/zip/', {'file_ids': log.id})
+            content = b''.join(response.streaming_content)
+        archive = zipfile.ZipFile(io.BytesIO(content))
+        self.assertEqual(archive.read('app.log'), self.text * 2)
+
+        # the local header of the entry carries the ZIP64 extra field
+        offset = archive.getinfo('app.log').header_offset
+        name_length = int.from_bytes(content[offset + 26:offset + 28], 'little')
+        self.assertEqual(content[offset + 30 + name_length:offset + 32 + name_length], b'\x01\x00')
+
+
+'''
+Files get previews for the dashboard: the first lines of text, thumbnails of
+images. They are made after the upload or on the first request, kept per
+content in a size-bounded cache that drops the least recently used ones, and
+served with long-lived cache headers.
+'''
+@override_settings(PREVIEW_TEXT_LINES=2, PREVIEW_SIZE=32)
+class PreviewTest(TempMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        previews._estimated = None
+
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.other = User.objects.create_user(username='other', password='12345')
+        self.client.login(username='testuser', password='12345')
+
+    def url(self, uploaded_file):
+        return f'/mainapp/preview/{uploaded_file.id}/'
+
+    def test_text_preview_is_made_on_request_and_cached(self):
+        notes = store_upload(self.user, ContentFile(b'first\nsecond\nthird\n'), 'notes.txt')
+        response = self.client.get(self.url(notes))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertEqual(b''.join(response.streaming_content), b'first\nsecond')
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['X-Frame-Options'], 'SAMEORIGIN')
+        self.assertTrue(os.path.exists(previews.preview_path(notes.file_hash)))
+
+        response = self.client.get(self.url(notes), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_made_after_upload_and_shared_by_duplicates(self):
+        first = store_upload(self.user, ContentFile(b'same content'), 'a.txt')
+        second = store_upload(self.user, ContentFile(b'same content'), 'b.txt')
+        self.assertEqual(tasks.run_pending(), 2)
+        self.assertEqual(UploadedFile.objects.filter(processing_status='processed').count(), 2)
+        shard = os.path.dirname(previews.preview_path(first.file_hash))
+        self.assertEqual(os.listdir(shard), [first.file_hash])
+
+        # too large to be made while the request waits, but there already
+        with override_settings(PREVIEW_INLINE_MAX_SIZE=0):
+            self.assertEqual(self.client.get(self.url(second)).status_code, 200)
+
+    @override_settings(PREVIEW_INLINE_MAX_SIZE=0)
+    def test_large_files_wait_for_the_worker(self):
+        notes = store_upload(self.user, ContentFile(b'made by the worker'), 'notes.txt')
+        response = self.client.get(self.url(notes))
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        tasks.run_pending()
+        self.assertEqual(self.client.get(self.url(notes)).status_code, 200)
+
+    def test_binary_content_has_no_preview(self):
+        noise = store_upload(self.user, ContentFile(b'\x00\x01' * 100), 'noise.bin')
+        response = self.client.get(self.url(noise))
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertEqual(os.path.getsize(previews.preview_path(noise.file_hash)), 0)
+
+    def test_inaccessible_files_are_not_found(self):
+        private = store_upload(self.other, ContentFile(b'private'), 'private.txt')
+        self.assertEqual(self.client.get(self.url(private)).status_code, 404)
+        self.assertFalse(os.path.exists(previews.cache_dir()))
+
+        private.shared_with.add(self.user)
+        self.assertEqual(self.client.get(self.url(private)).status_code, 200)
+
+    @override_settings(PREVIEW_CACHE_SIZE=4 * previews.MIN_ENTRY_SIZE)
+    def test_least_recently_used_previews_are_evicted(self):
+        files = [store_upload(self.user, ContentFile(f'file {n}'.encode()), f'{n}.txt') for n in range(4)]
+        paths = [previews.preview_path(uploaded_file.file_hash) for uploaded_file in files]
+        for age, uploaded_file in zip((400, 300, 200, 100), files):
+            previews.cached_preview(uploaded_file, create=True)
+            os.utime(previews.preview_path(uploaded_file.file_hash), (time.time() - age,) * 2)
+
+        # reading the oldest one makes it the most recent
+        self.assertEqual(previews.cached_preview(files[0]), paths[0])
+        fifth = store_upload(self.user, ContentFile(b'file 4'), '4.txt')
+        previews.cached_preview(fifth, create=True)
+        # down to 90% of the size: the two least recently used go
+        self.assertEqual([os.path.exists(path) for path in paths], [True, False, False, True])
+        self.assertTrue(os.path.exists(previews.preview_path(fifth.file_hash)))
+
+    @skipUnless(previews.Image, 'Pillow is not installed')
+    def test_image_thumbnail(self):
+        image = io.BytesIO()
+        previews.Image.new('RGB', (200, 100), 'red').save(image, 'PNG')
+        picture = store_upload(self.user, ContentFile(image.getvalue()), 'red.png')
+        response = self.client.get(self.url(picture))
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        with previews.Image.open(io.BytesIO(b''.join(response.streaming_content))) as thumbnail:
+            self.assertEqual(thumbnail.size, (32, 16))
@@ -0,0 +1,83 @@
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from .hashing import ContentHasher
+from .quotas import remaining_quota
+
+
+# Content-Length also counts the multipart framing and the other form fields
+FORM_OVERHEAD = 64 * 1024
+
+
+# Stops uploads that do not fit the user's storage quota while Django is
+# still receiving them. It sits first in FILE_UPLOAD_HANDLERS:
+# a body whose Content-Length is over the remaining quota is refused as soon
+# as its first file starts, and any other upload as soon as the bytes
+# received pass the quota, so nothing over quota is written to disk. The form
+# fields before the file (the CSRF token) are still parsed, so the view can
+# answer; it finds the reason with quota_error(request).
+class QuotaUploadHandler(FileUploadHandler):
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        self.body_length = content_length
+        self.remaining = None
+        self.received = 0
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        # looked up once, when the first file starts; forms without files
+        # never query it
+        if self.received == 0 and self.remaining is None:
+            user = getattr(self.request, 'user', None)
+            if user is not None and user.is_authenticated:
+                self.remaining = remaining_quota(user)
+        if self.remaining is not None and self.body_length > self.remaining + FORM_OVERHEAD:
+            self.stop()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.remaining is not None and self.received > self.remaining:
+            self.stop()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+    def stop(self):
+        self.request.quota_error = f'This upload does not fit in the {self.remaining} bytes left of your storage quota'
+        # the rest of the body is not read
+        raise StopUpload(connection_reset=True)
+
+
+# Why QuotaUploadHandler stopped the upload of this request, or None.
+def quota_error(request):
+    return getattr(request, 'quota_error', None)
+
+
+# Hashes every uploaded file while Django is still receiving it.
+# It sits first in FILE_UPLOAD_HANDLERS and passes each chunk on untouched, so
+# the bytes are hashed in the same loop that writes them to the upload temp
+# file and never have to be read back just to compute file_hash.
+class HashingUploadHandler(FileUploadHandler):
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hasher = ContentHasher()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.hasher.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        # hashers are kept per field in upload order, like request.FILES
+        upload_hashes = self.request.__dict__.setdefault('upload_hashes', {})
+        upload_hashes.setdefault(self.field_name, []).append(self.hasher)
+
+        # let the next handler build the file object
+        return None
+
+
+# Returns all hashing.Digests computed while receiving request.FILES[field_name],
+# or None when the hashing handler was not installed for this request.
+def received_digests(request, field_name):
+    hashers = getattr(request, 'upload_hashes', {}).get(field_name)
+    return hashers[-1].digests() if hashers else None
@@ -0,0 +1,256 @@
+import os
+import shutil
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import storages
+from django.db import transaction
+from django.utils import timezone
+
+from . import hashing, metrics
+from .compression import open_decoded
+from .downloads import FileRange
+from .manifests import find_blocks
+from .models import UploadedFile, UploadSession, UploadChunk, digest_from_hex
+from .processing import process_upload
+from .quotas import QuotaExceeded, remaining_quota, check_quota
+from .storage import CHUNK_SIZE, stored_name
+from .tasks import enqueue
+
+
+# Stores uploaded content and records it as an UploadedFile of user.
+# digests are the hashing.Digests computed while the upload was received, if any.
+# Raises quotas.QuotaExceeded, storing nothing, when the user has no room left.
+def store_upload(user, content, name, digests=None):
+    fs = storages['uploads']
+
+    # the bytes are written before any row is locked, so however long that
+    # takes, the user's other uploads and deletes never wait for it
+    received = fs.receive(content, digests)
+    try:
+        with transaction.atomic():
+            uploaded_file = record_upload(user, content, name, received)
+    finally:
+        fs.discard(received)
+    return uploaded_file
+
+
+# Moves content, already written by ContentAddressedStorage.receive(), into
+# the blob store and records it as an UploadedFile of user. Call inside a
+# transaction, which holds the user's usage row from the quota check on.
+def record_upload(user, content, name, received):
+    fs = storages['uploads']
+    check_quota(user.id, content.size)
+
+    # moves the data into place unless the same bytes are already stored
+    blob = fs.save_blob(content, received=received)
+
+    # creates an uploadedfile obj pointing at the shared blob; the signals
+    # add it to the user's usage
+    uploaded_file = UploadedFile.objects.create(
+        user=user, file_url=fs.url(blob.name), file_hash=blob.file_hash,
+        blob=blob, name=name, size=content.size,
+    )
+
+    # everything else happens in a worker once this is committed
+    enqueue(process_upload, uploaded_file.id)
+    metrics.uploaded_bytes.inc(content.size)
+    return uploaded_file
+
+
+# Deletes an UploadedFile; the stored bytes go away with the last file that
+# references them.
+def delete_upload(uploaded_file):
+    fs = storages['uploads']
+    with transaction.atomic():
+        uploaded_file.delete()
+        if uploaded_file.blob_id:
+            fs.release_blob(uploaded_file.blob_id)
+            return
+
+        # a file from before the blob store owns its file; it is removed once
+        # the delete is committed, so a rollback never loses the bytes
+        name = stored_name(uploaded_file)
+        if name is not None and not UploadedFile.objects.filter(file_url=uploaded_file.file_url).exists():
+            transaction.on_commit(lambda: fs.delete(name))
+
+
+# ---- resumable, chunked uploads ----
+
+# raised for requests that do not fit the upload session
+class ChunkError(Exception):
+    pass
+
+
+# storage name of the folder holding the chunks of a session
+def session_dir(session):
+    return f'chunks/{session.id}'
+
+
+# storage name of one received chunk
+def chunk_name(session, index):
+    return f'{session_dir(session)}/{index}'
+
+
+# Starts a session for a file of the given size.
+def create_session(user, name, size, chunk_size=None):
+    chunk_size = chunk_size or settings.UPLOAD_CHUNK_SIZE
+    if size < 0:
+        raise ChunkError('size must not be negative')
+    if not settings.UPLOAD_CHUNK_SIZE_MIN <= chunk_size <= settings.UPLOAD_CHUNK_SIZE_MAX:
+        raise ChunkError(
+            f'chunk_size must be between {settings.UPLOAD_CHUNK_SIZE_MIN} and {settings.UPLOAD_CHUNK_SIZE_MAX}'
+        )
+    # refused before any chunk is sent; finish_session checks again
+    remaining = remaining_quota(user)
+    if remaining is not None and size > remaining:
+        raise QuotaExceeded(f'This upload needs {size} bytes but only {remaining} are left')
+    return UploadSession.objects.create(user=user, name=name[:255], size=size, chunk_size=chunk_size)
+
+
+# Indices of the chunks a session has received, in order.
+def received_chunks(session):
+    return list(session.chunks.order_by('index').values_list('index', flat=True))
+
+
+# Streams one chunk from stream into the session.
+# Chunks may arrive in any order and in parallel; re-sending a chunk replaces it.
+def write_chunk(session, index, stream):
+    if not 0 <= index < session.total_chunks:
+        raise ChunkError(f'chunk index must be between 0 and {session.total_chunks - 1}')
+    expected = session.chunk_length(index)
+
+    fs = storages['uploads']
+    final_path = fs.path(chunk_name(session, index))
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+
+    # written under a private name and renamed into place, so a chunk that is
+    # being re-sent concurrently never leaves a mix of both writes behind
+    part_path = f'{final_path}.{uuid.uuid4().hex}.part'
+    written = 0
+    try:
+        with open(part_path, 'wb') as part:
+            while written <= expected:
+                data = stream.read(min(CHUNK_SIZE, expected + 1 - written))
+                if not data:
+                    break
+                metrics.timed_write(part, data)
+                written += len(data)
+
+        if written != expected:
+            raise ChunkError(f'chunk {index} must be {expected} bytes')
+        os.replace(part_path, final_path)
+        metrics.chunk_bytes.inc(written)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    UploadChunk.objects.update_or_create(session=session, index=index, defaults={'size': written})
+    # marks the session as active for the garbage collector
+    UploadSession.objects.filter(pk=session.pk).update(updated=timezone.now())
+
+
+# Fills chunks of a session from blocks the server already stores, so a
+# client re-uploading an edited file only sends the blocks that changed.
+# digests are the hex SHA-256 of the file's chunks in order ('' where
+# unknown); the session's chunk size must be the manifest block size.
+# Returns the indices that were filled.
+def reuse_chunks(session, digests):
+    block_size = hashing.TREE_BLOCK_SIZE
+    if session.chunk_size != block_size:
+        raise ChunkError(f'chunk_size must be {block_size} to reuse stored blocks')
+    if len(digests) > session.total_chunks:
+        raise ChunkError(f'the session has {session.total_chunks} chunks')
+
+    received = set(received_chunks(session))
+    wanted = {
+        index: digest for index, digest in ((index, digest_from_hex(value)) for index, value in enumerate(digests))
+        if digest and index not in received
+    }
+    found = find_blocks(session.user, wanted.values(), block_size)
+
+    fs = storages['uploads']
+    reused = []
+    for index, digest in wanted.items():
+        if digest not in found:
+            continue
+        name, encoding, offset = found[digest]
+        try:
+            with open_decoded(fs.path(name), encoding) as stored:
+                write_chunk(session, index, FileRange(stored, offset, session.chunk_length(index)))
+        except (ChunkError, FileNotFoundError):
+            # the stored copy is gone or shorter; the client sends this one
+            continue
+        reused.append(index)
+    return reused
+
+
+# The chunks of a session read back in order, shaped like a Django File so
+# they can be handed to the storage pipeline, which hashes while it writes.
+class AssembledChunks:
+
+    def __init__(self, session):
+        self.session = session
+        self.size = session.size
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        fs = storages['uploads']
+        for index in range(self.session.total_chunks):
+            with open(fs.path(chunk_name(self.session, index)), 'rb') as chunk:
+                while data := chunk.read(chunk_size):
+                    yield data
+
+
+# Assembles a complete session into an UploadedFile and removes the session.
+def finish_session(session):
+    # claimed with a single update, so a repeated finish is turned away while
+    # this one assembles the file, and no lock is held during the write
+    session_id = session.pk
+    if not UploadSession.objects.filter(pk=session_id, finishing=False).update(finishing=True):
+        # raises UploadSession.DoesNotExist when it was finished already
+        UploadSession.objects.get(pk=session_id)
+        raise ChunkError('the session is already being finished')
+
+    try:
+        session = UploadSession.objects.select_related('user').get(pk=session_id)
+        missing = session.total_chunks - session.chunks.count()
+        if missing:
+            raise ChunkError(f'{missing} chunks are still missing')
+
+        fs = storages['uploads']
+        content = AssembledChunks(session)
+        received = fs.receive(content)
+        try:
+            with transaction.atomic():
+                # a short lock; raises UploadSession.DoesNotExist when the
+                # session was abandoned in the meantime
+                UploadSession.objects.select_for_update().get(pk=session_id)
+                uploaded_file = record_upload(session.user, content, session.name, received)
+                discard_session(session)
+        finally:
+            fs.discard(received)
+    except BaseException:
+        # the session is kept, so finishing it can be tried again
+        UploadSession.objects.filter(pk=session_id).update(finishing=False)
+        raise
+    return uploaded_file
+
+
+# Deletes a session and its chunk files.
+def discard_session(session):
+    path = storages['uploads'].path(session_dir(session))
+    session.delete()
+    # the chunk files go once the delete is committed, so after a rollback
+    # the session is still complete and can be finished again
+    transaction.on_commit(lambda: shutil.rmtree(path, ignore_errors=True))
+
+
+# Deletes sessions that received nothing for max_age; returns how many.
+def collect_abandoned_sessions(max_age=None):
+    max_age = max_age or timedelta(seconds=settings.UPLOAD_SESSION_TTL)
+    count = 0
+    for session in UploadSession.objects.filter(updated__lt=timezone.now() - max_age).iterator():
+        discard_session(session)
+        count += 1
+    return count
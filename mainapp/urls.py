@@ -5,7 +5,12 @@ from django.urls import path
 from django.views.generic.base import RedirectView
 
 # include views 
-from mainapp import views
+from mainapp import views, async_views
+from django.conf import settings
+
+# the upload, download, share and delete views run as coroutines when the
+# project is served through hosting/asgi.py with ASYNC_FILE_VIEWS turned on
+file_views = async_views if settings.ASYNC_FILE_VIEWS else views
 
 # blocks users from viewing the root directory;
 # users are redirected to the login view
@@ -16,15 +21,50 @@ urlpatterns = [
     # redirects the user to the login page
     path('', RedirectView.as_view(url='login')),
 
-    path('upload/', views.upload, name='upload'),
+    path('upload/', file_views.upload, name='upload'),
     path('login/', views.user_login, name='login'),
     path('signup/', views.user_signup, name='signup'),
     path('logout/', views.user_logout, name='logout'),
 
+    # download file; checks ownership or sharing
+    path('download/<int:file_id>/', file_views.download_file, name='download_file'),
+
+    # thumbnail or first lines of a file, shown on the dashboard
+    path('preview/<int:file_id>/', views.file_preview, name='file_preview'),
+
+    # downloads several files as one streamed ZIP archive
+    path('download/zip/', views.download_zip, name='download_zip'),
+
     # delete file
-    path('delete/<int:file_id>/', views.delete_file, name='delete_file'),
+    path('delete/<int:file_id>/', file_views.delete_file, name='delete_file'),
 
     # sharefile 
-    path('share/<int:file_id>/', views.share_file, name='share_file'),
+    path('share/<int:file_id>/', file_views.share_file, name='share_file'),
+
+    # share many files with many users or groups at once
+    path('share/bulk/', views.bulk_share_file, name='bulk_share_file'),
+    path('api/share/', views.bulk_share_api, name='bulk_share_api'),
+
+    # paginated json listing of owned and shared files
+    path('api/files/', views.file_list_api, name='file_list_api'),
+
+    # storage used and quota
+    path('api/usage/', views.usage_api, name='usage_api'),
+
+    # listing cache hit rates, staff only
+    path('api/cache/stats/', views.cache_stats_api, name='cache_stats_api'),
+
+    # resumable, chunked uploads
+    path('api/uploads/', views.upload_session_create, name='upload_session_create'),
+    path('api/uploads/<uuid:session_id>/', views.upload_session_detail, name='upload_session_detail'),
+    path('api/uploads/<uuid:session_id>/chunks/<int:index>/', views.upload_session_chunk, name='upload_session_chunk'),
+    path('api/uploads/<uuid:session_id>/reuse/', views.upload_session_reuse, name='upload_session_reuse'),
+    path('api/uploads/<uuid:session_id>/complete/', views.upload_session_complete, name='upload_session_complete'),
+
+    # block manifest of a file, for delta re-uploads and partial verification
+    path('api/files/<int:file_id>/manifest/', views.file_manifest_api, name='file_manifest_api'),
+
+    # processing status of a file, while background work on it is pending
+    path('api/files/<int:file_id>/status/', views.file_status_api, name='file_status_api'),
 
 ]
@@ -1,65 +1,444 @@
 # render and redirection
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
+from django.http import (
+    JsonResponse, Http404, HttpResponse, HttpResponseBadRequest, FileResponse, HttpResponseNotFound,
+    HttpResponseNotModified,
+)
+from django.views.decorators.http import require_POST, require_http_methods
+import json
+import os
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
-from .forms import UserCreationForm, LoginForm, SharedFileForm
+from .auth import throttle_login, reset_login_attempts, client_address
+from django.utils.crypto import constant_time_compare
+from .forms import UserCreationForm, LoginForm, SharedFileForm, BulkShareForm, split_items
 from django.contrib.auth.decorators import login_required
-from django.contrib.auth.models import User
-import hashlib
+from django.contrib.auth.models import Group, User
 
 # handling uploaded file
-from .models import UploadedFile
+from .models import UploadedFile, UploadSession, UserUsage
 
 # handling file storage natively
-from django.core.files.storage import FileSystemStorage
+from django.core.files.storage import storages
+from .storage import stored_name
+from .uploadhandlers import received_digests, quota_error
+from .quotas import QuotaExceeded
+from .uploads import (
+    store_upload, delete_upload, ChunkError, create_session, received_chunks, write_chunk,
+    finish_session, discard_session, reuse_chunks,
+)
+
+# serving downloads
+from .downloads import file_response
+from .archives import zip_response
+from .manifests import block_manifest
+
+# previews of files
+from .previews import cached_preview
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from django.views.decorators.clickjacking import xframe_options_sameorigin
+
+# sharing many files at once
+from .sharing import bulk_share
+
+# paging through long file lists
+from .pagination import parse_cursor, parse_id, parse_limit
+
+# request and I/O metrics
+from . import metrics
+
+# access checks on read replicas
+from .routers import from_replica
+
+# cached per-user listings
+from .listing_cache import cached, hit_rates, listing_page, listing_version
+from django.template.loader import render_to_string
 
 # Create your views here.
 
 # upload view; referencing to the html and css for details
-# When a file is uploaded, calculate its SHA-256 hash and store it in the database along with the file.
+# When a file is uploaded, calculate its SHA-256 hash while it is written and store it in the database along with the file.
 @login_required
 def upload(request):
     # dictionary for data exchange between view and upload.html
     context = {}
+    status = 200
+
+    # pages of the file lists
+    try:
+        owned_before, shared_before = dashboard_cursors(request)
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
 
     # if it is a HTTP POST or not
     if request.method == 'POST':
 
-        # contains the user upload
-        uploaded_file = request.FILES['document']
+        # contains the user upload; missing when it was stopped for the quota
+        uploaded_file = request.FILES.get('document')
+
+        if uploaded_file is None:
+            context['error'] = quota_error(request) or 'No file was uploaded'
+            status = 413 if quota_error(request) else 400
+        else:
+            try:
+                # stores the bytes once per distinct content; the SHA-256 hash was
+                # calculated while the upload was received, or is calculated in the
+                # same pass that writes the chunks
+                uploaded_file_obj = store_upload(
+                    request.user, uploaded_file, uploaded_file.name, received_digests(request, 'document'),
+                )
+                file_url = uploaded_file_obj.file_url
+
+                context['url'] = file_url
+            except QuotaExceeded as error:
+                # a concurrent upload took the room that was left
+                context['error'] = str(error)
+                status = 413
+
+    context.update(dashboard_fragments(request.user, owned_before, shared_before))
+
+    return render(request, 'upload.html', context, status=status)
+
+
+# The owned_before and shared_before cursors of a dashboard request; raises
+# ValueError for ones out of range.
+def dashboard_cursors(request):
+    return parse_cursor(request.GET.get('owned_before')), parse_cursor(request.GET.get('shared_before'))
 
-        # creates an object to manipulate uploaded data
-        fs = FileSystemStorage()
 
-        # saves data into the file system
-        name = fs.save(uploaded_file.name, uploaded_file)
+# The rendered owned and shared file lists of the dashboard.
+# Each list is one page fetched with one query and only the columns the
+# fragment shows; pages and fragments are cached until the user's files or
+# shares change (see listing_cache.py), so a repeated visit runs no queries
+# for them and renders nothing but the page around them.
+def dashboard_fragments(user, owned_before, shared_before):
+    version = listing_version(user.id)
+    cursors = {'owned_before': owned_before, 'shared_before': shared_before}
 
-        # generates key-value pair: key being the url 
-        file_url = fs.url(name)
+    def render_list(kind):
+        files, next_cursor = listing_page(user, kind, cursors[f'{kind}_before'], version=version)
+        return render_to_string(f'{kind}_files.html', {f'{kind}_files': files, f'{kind}_next': next_cursor, **cursors})
 
-        # calculate the SHA-256 hash
-        sha256_hash = hashlib.sha256()
-        for chunk in uploaded_file.chunks():
-            sha256_hash.update(chunk)
+    return {
+        f'{kind}_html': cached(user.id, version, 'fragment', (kind, owned_before, shared_before), lambda: render_list(kind))
+        for kind in ('owned', 'shared')
+    }
 
-        # get the hex digest of the hash
-        file_hash = sha256_hash.hexdigest()
 
-        # associate the file URL with the current user
-        # UploadedFile.objects.create(user=request.user, file_url=file_url)
+# json listing of the owned or shared files, one keyset page at a time
+# GET ?kind=owned|shared&before=<cursor>&limit=<n>
+@login_required
+def file_list_api(request):
+    kind = request.GET.get('kind', 'owned')
+    if kind not in ('owned', 'shared'):
+        return JsonResponse({'error': 'kind must be owned or shared'}, status=400)
+
+    try:
+        before = parse_cursor(request.GET.get('before'))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    # the same cached pages the dashboard uses
+    files, next_cursor = listing_page(request.user, kind, before, parse_limit(request.GET.get('limit')))
+
+    return JsonResponse({
+        'files': [
+            {
+                'id': file.id,
+                'name': file.name,
+                'url': reverse('download_file', args=[file.id]),
+                'hash': file.file_hash,
+                **({'owner': file.user.username} if kind == 'shared' else {}),
+            }
+            for file in files
+        ],
+        'next': next_cursor,
+    })
+
+
+# storage used by the user and their quota; one primary key lookup
+@login_required
+def usage_api(request):
+    usage = UserUsage.objects.filter(user=request.user).first() or UserUsage(user=request.user)
+    return JsonResponse({
+        'bytes_used': usage.bytes_used,
+        'file_count': usage.file_count,
+        'quota': settings.STORAGE_QUOTA if usage.quota is None else usage.quota,
+    })
 
-        # creates an uploadedfile obj with the hash
-        uploaded_file_obj = UploadedFile.objects.create(
-            user=request.user, file_url=file_url, file_hash=file_hash
-        )
 
-        context['url'] = file_url
+# hit rates of the listing cache in this process, for staff
+@login_required
+def cache_stats_api(request):
+    if not request.user.is_staff:
+        raise Http404
+    return JsonResponse(hit_rates())
+
 
-    return render(request, 'upload.html', context)
+# Preview of a file for the dashboard, which shows it in a frame: a thumbnail
+# or the first lines. The preview of a file never changes, so browsers keep
+# it. Missing previews of small files are made right away, those of larger
+# ones by the upload worker; until then, and for files without any, the
+# answer is an empty 404.
+@login_required
+@xframe_options_sameorigin
+def file_preview(request, file_id):
+    uploaded_file = from_replica(
+        UploadedFile.objects.accessible_by(request.user).select_related('blob').filter(pk=file_id).first
+    )
+    if uploaded_file is None:
+        raise Http404('File not found')
+
+    etag = f'"preview-{uploaded_file.file_hash}"'
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    try:
+        path = cached_preview(uploaded_file, create=uploaded_file.size <= settings.PREVIEW_INLINE_MAX_SIZE)
+        preview = open(path, 'rb') if path else None
+    except OSError:
+        preview = None
+    if preview is None:
+        response = HttpResponseNotFound()
+        patch_cache_control(response, no_cache=True)
+        return response
+
+    head = preview.read(3)
+    preview.seek(0)
+    if head:
+        response = FileResponse(preview, content_type='image/jpeg' if head == b'\xff\xd8\xff' else 'text/plain; charset=utf-8')
+    else:
+        # the content has no preview
+        preview.close()
+        response = HttpResponseNotFound()
+    patch_cache_control(response, private=True, max_age=settings.PREVIEW_MAX_AGE, immutable=True)
+    response['ETag'] = etag
+    return response
+
+
+# ZIP archive of several files the user may download, streamed as it is
+# written: ?file_ids=1&file_ids=2 (or "1,2") for a selection of owned and
+# shared files, or ?shared=1 for everything shared with the user
+@login_required
+def download_zip(request):
+    if request.GET.get('shared'):
+        files = list(UploadedFile.objects.shared_with_user(request.user).select_related('blob')[:settings.ZIP_MAX_FILES + 1])
+        if len(files) > settings.ZIP_MAX_FILES:
+            return HttpResponse(f'An archive can hold at most {settings.ZIP_MAX_FILES} files', status=400)
+        filename = 'shared-files.zip'
+    else:
+        try:
+            file_ids = {parse_id(item) for item in split_items(' '.join(request.GET.getlist('file_ids')))}
+        except ValueError:
+            return HttpResponse('File ids must be positive numbers', status=400)
+        if not file_ids:
+            return HttpResponse('Select at least one file', status=400)
+        if len(file_ids) > settings.ZIP_MAX_FILES:
+            return HttpResponse(f'An archive can hold at most {settings.ZIP_MAX_FILES} files', status=400)
+
+        # ownership and sharing of the whole selection in one query
+        def selection():
+            found = list(
+                UploadedFile.objects.accessible_by(request.user).filter(pk__in=file_ids)
+                .select_related('blob', 'user').order_by('-id')
+            )
+            return found if len(found) == len(file_ids) else None
+
+        files = from_replica(selection)
+        # answer "not found" for the whole selection, as download_file does
+        if files is None:
+            raise Http404('File not found')
+        filename = 'files.zip'
+
+    return zip_response(files, request.user, filename)
+
+
+# Prometheus metrics of this process, for staff users, scrapers sending
+# METRICS_TOKEN as a bearer token and clients on METRICS_ALLOWED_ADDRESSES
+def metrics_view(request):
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    allowed = (
+        request.user.is_staff
+        or (settings.METRICS_TOKEN and scheme.lower() == 'bearer' and constant_time_compare(token, settings.METRICS_TOKEN))
+        or client_address(request) in settings.METRICS_ALLOWED_ADDRESSES
+    )
+    if not allowed:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# download view; only the owner and users the file is shared with get the bytes
+@login_required
+def download_file(request, file_id):
+    # ownership or sharing is checked in the same single query that loads the file
+    file_to_download = from_replica(
+        UploadedFile.objects.accessible_by(request.user).select_related('blob').filter(pk=file_id).first
+    )
+    # answer "not found" rather than "forbidden" so ids of other files do not leak
+    if file_to_download is None:
+        raise Http404('File not found')
+
+    fs = storages['uploads']
+    name = stored_name(file_to_download)
+    if name is None or not fs.exists(name):
+        raise Http404('File not found')
+
+    blob = file_to_download.blob
+    return file_response(
+        request, fs, name, file_to_download.file_hash,
+        file_to_download.name or os.path.basename(name),
+        encoding=blob.encoding if blob else '', size=file_to_download.size,
+    )
+
+
+# ---- resumable, chunked upload api ----
+#   POST   api/uploads/                         {"name", "size", "chunk_size"?} starts a session
+#   GET    api/uploads/<id>/                    which chunks were received
+#   PUT    api/uploads/<id>/chunks/<index>/     raw chunk bytes, any order, in parallel
+#   POST   api/uploads/<id>/complete/           assembles and hashes the file
+#   DELETE api/uploads/<id>/                    abandons the session
+
+# json description of an upload session
+def session_state(session):
+    received = received_chunks(session)
+    received_set = set(received)
+    return {
+        'id': str(session.id),
+        'name': session.name,
+        'size': session.size,
+        'chunk_size': session.chunk_size,
+        'total_chunks': session.total_chunks,
+        'received': received,
+        'missing': [index for index in range(session.total_chunks) if index not in received_set],
+    }
+
+
+@login_required
+@require_POST
+def upload_session_create(request):
+    try:
+        data = json.loads(request.body)
+        # null, a list or a number instead of an object
+        if not isinstance(data, dict):
+            raise TypeError
+        chunk_size = int(data['chunk_size']) if data.get('chunk_size') else None
+        session = create_session(request.user, str(data['name']), int(data['size']), chunk_size)
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'name and size are required'}, status=400)
+    except ChunkError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    except QuotaExceeded as error:
+        return JsonResponse({'error': str(error)}, status=413)
+
+    return JsonResponse(session_state(session), status=201)
+
+
+@login_required
+@require_http_methods(['GET', 'DELETE'])
+def upload_session_detail(request, session_id):
+    session = get_object_or_404(UploadSession, pk=session_id, user=request.user)
+
+    if request.method == 'DELETE':
+        discard_session(session)
+        return HttpResponse(status=204)
+
+    return JsonResponse(session_state(session))
+
+
+@login_required
+@require_http_methods(['PUT'])
+def upload_session_chunk(request, session_id, index):
+    session = get_object_or_404(UploadSession, pk=session_id, user=request.user)
+
+    try:
+        # the body is streamed to disk, never loaded into memory
+        write_chunk(session, index, request)
+    except ChunkError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    return HttpResponse(status=204)
+
+
+# Delta re-upload: the client posts the SHA-256 of every chunk of its file
+# ({"blocks": [hex, ...]}) and the server fills the chunks it already has from
+# stored files the user can access; the client then only sends what is missing.
+@login_required
+@require_POST
+def upload_session_reuse(request, session_id):
+    session = get_object_or_404(UploadSession, pk=session_id, user=request.user)
+
+    try:
+        blocks = json.loads(request.body)['blocks']
+        if not isinstance(blocks, list):
+            raise TypeError
+        reused = reuse_chunks(session, [str(block or '') for block in blocks])
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'blocks must be a list of chunk hashes'}, status=400)
+    except ChunkError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    return JsonResponse({'reused': reused, **session_state(session)})
+
+
+@login_required
+@require_POST
+def upload_session_complete(request, session_id):
+    session = get_object_or_404(UploadSession, pk=session_id, user=request.user)
+
+    try:
+        uploaded_file = finish_session(session)
+    except ChunkError as error:
+        return JsonResponse({'error': str(error), **session_state(session)}, status=409)
+    except QuotaExceeded as error:
+        # the session is kept; it can be completed once there is room again
+        return JsonResponse({'error': str(error), **session_state(session)}, status=413)
+    except UploadSession.DoesNotExist:
+        # finished by a concurrent request
+        raise Http404('Upload session not found')
+
+    return JsonResponse({
+        'id': uploaded_file.id,
+        'name': uploaded_file.name,
+        'hash': uploaded_file.file_hash,
+        'url': reverse('download_file', args=[uploaded_file.id]),
+        'processing_status': uploaded_file.processing_status,
+    }, status=201)
+
+
+# progress of the work queued after an upload
+@login_required
+def file_status_api(request, file_id):
+    uploaded_file = get_object_or_404(UploadedFile.objects.accessible_by(request.user), pk=file_id)
+    return JsonResponse({'id': uploaded_file.id, 'processing_status': uploaded_file.processing_status})
+
+
+# block manifest of a file: what a client compares with its local copy before
+# a delta re-upload, and what partial integrity checks verify against
+@login_required
+def file_manifest_api(request, file_id):
+    uploaded_file = get_object_or_404(
+        UploadedFile.objects.accessible_by(request.user).select_related('blob'), pk=file_id
+    )
+    blob = uploaded_file.blob
+    if blob is None or blob.block_size is None:
+        raise Http404('No manifest for this file')
+
+    return JsonResponse({
+        'id': uploaded_file.id,
+        'hash': uploaded_file.file_hash,
+        'block_size': blob.block_size,
+        'blocks': block_manifest(blob),
+    })
 
 
 @login_required
 def share_file(request, file_id):
-    file_to_share = UploadedFile.objects.get(pk=file_id)
+    # only the owner may share a file
+    file_to_share = get_object_or_404(UploadedFile, pk=file_id, user=request.user)
 
     if request.method == 'POST':
         form = SharedFileForm(request.POST)
@@ -67,17 +446,28 @@ def share_file(request, file_id):
         if form.is_valid():
             # Get the username from the form
             share_with_username = form.cleaned_data['share_with']
-
-            try:
-                # Get the user object based on the entered username
-                shared_user = User.objects.get(username=share_with_username)
-
-                # Add the user to the shared_with field
-                file_to_share.shared_with.add(shared_user)
+            share_with_group = form.cleaned_data['share_with_group']
+
+            if share_with_username:
+                try:
+                    # Get the user object based on the entered username
+                    shared_user = User.objects.get(username=share_with_username)
+
+                    # Add the user to the shared_with field
+                    file_to_share.shared_with.add(shared_user)
+                except User.DoesNotExist:
+                    # Handle the case where the entered username doesn't exist
+                    form.add_error('share_with', 'User does not exist')
+
+            if share_with_group:
+                try:
+                    # members get access through the group, now and after they join
+                    file_to_share.shared_with_groups.add(Group.objects.get(name=share_with_group))
+                except Group.DoesNotExist:
+                    form.add_error('share_with_group', 'Group does not exist')
+
+            if not form.errors:
                 return redirect('upload')
-            except User.DoesNotExist:
-                # Handle the case where the entered username doesn't exist
-                form.add_error('share_with', 'User does not exist')
 
     else:
         form = SharedFileForm()
@@ -87,18 +477,61 @@ def share_file(request, file_id):
 
 @login_required
 def delete_file(request, file_id):
-    # Get the file object
-    file_to_delete = UploadedFile.objects.get(pk=file_id)
+    # Get the file object, which only its owner may delete
+    file_to_delete = get_object_or_404(UploadedFile, pk=file_id, user=request.user)
 
-    # Check if the user is the owner of the file
-    if request.user == file_to_delete.user:
-        # Delete the file
-        file_to_delete.delete()
+    # Delete the file, and its bytes once nothing else references them
+    delete_upload(file_to_delete)
 
     # Redirect back to the upload page
     return redirect('upload')
 
 
+# bulk share page; shares many of the user's files with many users or groups
+# at once and lists what happened to every file, user and group
+@login_required
+def bulk_share_file(request):
+    results = None
+
+    if request.method == 'POST':
+        form = BulkShareForm(request.POST)
+        if form.is_valid():
+            results = bulk_share(
+                request.user, form.cleaned_data['file_ids'],
+                form.cleaned_data['usernames'], form.cleaned_data['groups'],
+            )
+    else:
+        # files ticked on the dashboard arrive as ?file_ids=1&file_ids=2
+        form = BulkShareForm(initial={'file_ids': ' '.join(request.GET.getlist('file_ids'))})
+
+    return render(request, 'bulk_share.html', {'form': form, 'results': results})
+
+
+# The list under key in a json object, every item passed through convert; a
+# string or an object instead of a list raises TypeError.
+def json_list(data, key, convert):
+    items = data.get(key, [])
+    if not isinstance(items, list):
+        raise TypeError(f'{key} must be a list')
+    return [convert(item) for item in items]
+
+
+# json version of the bulk share page
+# POST {"file_ids": [...], "usernames": [...], "groups": [...]}
+@login_required
+@require_POST
+def bulk_share_api(request):
+    try:
+        data = json.loads(request.body)
+        file_ids = json_list(data, 'file_ids', parse_id)
+        usernames = json_list(data, 'usernames', str)
+        groups = json_list(data, 'groups', str)
+    except (ValueError, TypeError, AttributeError):
+        return JsonResponse({'error': 'file_ids must be a list of ids, usernames and groups lists of names'}, status=400)
+
+    return JsonResponse(bulk_share(request.user, file_ids, usernames, groups))
+
+
 # Signup page
 def user_signup(request):
     if request.method == 'POST':
@@ -118,8 +551,16 @@ def user_login(request):
         if form.is_valid():
             username = form.cleaned_data['username']
             password = form.cleaned_data['password']
+            # bursts are turned away before the password hasher runs
+            retry_after = throttle_login(request, username)
+            if retry_after:
+                form.add_error(None, 'Too many login attempts. Please try again later.')
+                response = render(request, 'login.html', {'form': form}, status=429)
+                response['Retry-After'] = str(retry_after)
+                return response
             user = authenticate(request, username=username, password=password)
             if user:
+                reset_login_attempts(username)
                 login(request, user)
                 return redirect('upload')
     else: